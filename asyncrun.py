@@ -0,0 +1,59 @@
+import asyncio
+import subprocess
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of external commands (ffprobe, ffmpeg, tag) or blocking calls run at once
+DEFAULT_CONCURRENCY = 8
+
+# Single thread running the calls into libraries that are not thread-safe (pymupdf), created on first use
+_serial_executor = None
+
+async def run_command(cmd, limiter=None):
+    """Run a command without blocking the event loop and return a subprocess.CompletedProcess with text output."""
+    async with limiter or nullcontext():
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout.decode("utf-8", "replace"), stderr.decode("utf-8", "replace"))
+
+async def run_blocking(func, *args, limiter=None):
+    """Run a blocking function in the event loop's thread pool."""
+    async with limiter or nullcontext():
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def run_serially(func, *args):
+    """Run a blocking function on a single dedicated thread, so that no two such calls ever overlap."""
+    global _serial_executor
+    if _serial_executor is None:
+        _serial_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="serial")
+    return await asyncio.get_running_loop().run_in_executor(_serial_executor, func, *args)
+
+def map_concurrently(coroutine_function, items, concurrency=DEFAULT_CONCURRENCY):
+    """Await coroutine_function(item, limiter) for every item, at most concurrency of them at once.
+
+    Returns {item: result}, where the result is the exception raised for the items that failed.
+    """
+    items = list(items)
+    if not items:
+        return {}
+
+    async def main():
+        limiter = asyncio.Semaphore(max(1, concurrency))
+        results = await asyncio.gather(*(coroutine_function(item, limiter) for item in items), return_exceptions=True)
+        return dict(zip(items, results))
+
+    return asyncio.run(main())
+
+def run_commands(commands, concurrency=DEFAULT_CONCURRENCY):
+    """Run commands concurrently and return their subprocess.CompletedProcess in the same order.
+
+    A command that cannot be started (for instance because the program is missing) raises OSError.
+    """
+    commands = [tuple(cmd) for cmd in commands]
+    results = map_concurrently(run_command, dict.fromkeys(commands), concurrency)
+    for result in results.values():
+        if isinstance(result, BaseException):
+            raise result
+    return [results[cmd] for cmd in commands]
@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pymupdf
+from manifest import scan_folder
+from tagstore import set_finder_tags_bulk, get_finder_tags_bulk, chunked, BULK_SIZE
+from metrics import metrics, QUIET
+from keywords import TfidfKeywords, DocumentFrequencies
+
+# Marker file recording the parameters a corpus was generated with
+CORPUS_MARKER = ".benchmark_corpus.json"
+
+# Stages in the order they run; each one runs in a fresh process so that its peak RSS is its own
+STAGES = ("walk", "tag read", "text extraction", "keyword extraction", "tfidf keywords", "transcription",
+          "transcription (audio copy)", "metadata write", "sync", "graph build")
+
+# Stages that write tags to the files; they run on a fresh copy of the corpus every time
+WRITING_STAGES = ("metadata write", "sync")
+
+DEFAULT_CORPUS = {
+    "pdfs": 50,
+    "pdf_pages": 5,
+    "texts": 200,
+    "videos": 4,
+    "video_seconds": 5,
+    "depth": 3,
+    "fanout": 3,
+    "tagged": 0.5,
+    "seed": 0,
+}
+
+def make_vocabulary(rng, size=500):
+    """Return size made-up words built from random syllables."""
+    syllables = ["ka", "lo", "mi", "ne", "ra", "tu", "si", "po", "de", "ga", "ve", "zo", "bi", "fa", "hu", "ja"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def make_text(rng, vocabulary, word_count):
+    """Return word_count words drawn with a Zipf-like distribution, so that some words dominate like real keywords."""
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    words = rng.choices(vocabulary, weights=weights, k=word_count)
+    return " ".join(" ".join(words[i:i + 12]) + "." for i in range(0, word_count, 12))
+
+def make_folders(root, depth, fanout):
+    """Create a tree of sub-folders fanout wide and depth deep under root and return all of its folders."""
+    folders = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                folder = os.path.join(parent, f"level{d}_{i}")
+                os.makedirs(folder, exist_ok=True)
+                next_level.append(folder)
+        folders.extend(next_level)
+        level = next_level
+    return folders
+
+def make_pdf(pdf_path, rng, vocabulary, pages):
+    doc = pymupdf.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), make_text(rng, vocabulary, 350), fontsize=9)
+    doc.save(pdf_path)
+    doc.close()
+
+def make_video(video_path, rng, vocabulary, seconds):
+    """Generate a short test-pattern video with a sine tone and two titled chapters with ffmpeg."""
+    metadata_path = video_path + ".ffmetadata"
+    half = seconds * 500
+    with open(metadata_path, "w") as f:
+        f.write(";FFMETADATA1\n")
+        for start, end in ((0, half), (half, seconds * 1000)):
+            title = " ".join(rng.sample(vocabulary, 3))
+            f.write(f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={start}\nEND={end}\ntitle={title}\n")
+    ffmpeg_cmd = [
+        "ffmpeg", "-loglevel", "error", "-y", "-nostdin",
+        "-f", "lavfi", "-i", f"testsrc=size=160x120:rate=10:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency={rng.randint(200, 800)}:duration={seconds}",
+        "-i", metadata_path, "-map", "0", "-map", "1", "-map_metadata", "2", "-map_chapters", "2",
+        "-c:v", "mpeg4", "-c:a", "aac", "-shortest", video_path
+    ]
+    try:
+        subprocess.run(ffmpeg_cmd, check=True)
+    finally:
+        os.remove(metadata_path)
+
+def generate_corpus(root, pdfs, pdf_pages, texts, videos, video_seconds, depth, fanout, tagged, seed):
+    """Generate a synthetic library of PDFs, text files and videos spread over nested folders.
+
+    A tagged fraction of the files get Finder tags. The same parameters always produce the same
+    files, and a corpus that already exists with the same parameters is reused. A corpus made
+    with other parameters is deleted first, but any other folder that is not empty is left alone
+    and raises ValueError.
+    """
+    parameters = dict(pdfs=pdfs, pdf_pages=pdf_pages, texts=texts, videos=videos, video_seconds=video_seconds,
+                      depth=depth, fanout=fanout, tagged=tagged, seed=seed)
+    marker_path = os.path.join(root, CORPUS_MARKER)
+    if os.path.exists(marker_path):
+        with open(marker_path, "r") as f:
+            if json.load(f) == parameters:
+                print(f"Reusing the corpus in {root}", file=sys.stderr)
+                return parameters
+        shutil.rmtree(root)
+    elif os.path.isdir(root) and os.listdir(root):
+        raise ValueError(f"{root} is not empty and holds no {CORPUS_MARKER}: refusing to generate a corpus in it")
+
+    os.makedirs(root, exist_ok=True)
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    folders = make_folders(root, depth, fanout)
+    files = []
+
+    def next_path(i, extension):
+        return os.path.join(folders[i % len(folders)], f"file{i}{extension}")
+
+    print(f"Generating {pdfs} PDFs, {texts} text files and {videos} videos in {root}", file=sys.stderr)
+    for i in range(pdfs):
+        files.append(next_path(len(files), ".pdf"))
+        make_pdf(files[-1], rng, vocabulary, pdf_pages)
+    for i in range(texts):
+        files.append(next_path(len(files), ".txt"))
+        with open(files[-1], "w") as f:
+            f.write(make_text(rng, vocabulary, rng.randint(200, 2000)))
+    if videos and shutil.which("ffmpeg") is None:
+        print("ffmpeg not found, the corpus has no videos", file=sys.stderr)
+        videos = 0
+    for i in range(videos):
+        files.append(next_path(len(files), ".mp4" if i % 2 == 0 else ".mkv"))
+        make_video(files[-1], rng, vocabulary, video_seconds)
+
+    tagged_files = rng.sample(files, int(len(files) * tagged))
+    with contextlib.redirect_stdout(sys.stderr):
+        set_finder_tags_bulk({file_path: rng.sample(vocabulary[:50], 3) for file_path in tagged_files})
+
+    with open(marker_path, "w") as f:
+        json.dump(parameters, f)
+    return parameters
+
+class StubEmbedder:
+    """Stand-in for KeyBERT's sentence-transformer returning deterministic pseudo-embeddings."""
+
+    def embed(self, documents, verbose=False):
+        return np.stack([np.random.default_rng(zlib.crc32(document.encode("utf-8"))).random(384, dtype=np.float32) for document in documents])
+
+class StubKeyBERT:
+    """Stand-in for KeyBERT scoring words by frequency, with the same output shapes as extract_keywords."""
+
+    def __init__(self):
+        self.model = StubEmbedder()
+
+    def extract_keywords(self, docs, top_n=5, doc_embeddings=None, **kwargs):
+        results = []
+        for doc in [docs] if isinstance(docs, str) else docs:
+            words = Counter(word.strip(".,").lower() for word in doc.split() if len(word) > 3)
+            total = sum(words.values()) or 1
+            results.append([(word, count / total) for word, count in words.most_common(top_n)])
+        # Like KeyBERT, return the keywords of a single document (even in a list) as a flat list
+        return results[0] if len(results) == 1 else results
+
+class StubWhisper:
+    """Stand-in for a Whisper model that reads the audio (a file or samples) and returns a fixed transcript."""
+
+    def transcribe(self, audio, **kwargs):
+        if isinstance(audio, str):
+            with open(audio, "rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+        return {"language": "en", "text": "This is a stub transcript. It stands in for Whisper's output."}
+
+def corpus_files(root, extensions):
+    return [file_path for file_path, stat in scan_folder(root) if file_path.endswith(extensions)]
+
+@contextlib.contextmanager
+def scratch_copy(root):
+    """Copy the corpus, with its Finder tags, to a temporary folder removed afterwards, and yield the copy."""
+    with tempfile.TemporaryDirectory(prefix="tagify-benchmark-scratch-") as scratch:
+        copy = os.path.join(scratch, "corpus")
+        shutil.copytree(root, copy)
+        # shutil does not copy extended attributes everywhere (not on macOS), so copy the Finder tags over
+        paths = [file_path for file_path, stat in scan_folder(root)]
+        for chunk in chunked(paths, BULK_SIZE):
+            finder_tags = get_finder_tags_bulk(chunk)
+            set_finder_tags_bulk({os.path.join(copy, os.path.relpath(file_path, root)): tags
+                                  for file_path, tags in finder_tags.items() if tags})
+        yield copy
+
+def run_stage(stage, root, repeat, real_models, onnx_model=None):
+    """Run one stage repeat times over the corpus and return its measurements.
+
+    With real models, KeyBERT embeds with the ONNX export in onnx_model if one is given. The
+    stages that write tags run on a fresh copy of the corpus every time, made outside the
+    timing, so that every run measures the same untouched corpus.
+
+    Everything a stage prints is discarded so that terminal output does not skew the timings.
+    """
+    # Imported here so that only the stages needing them pay for the heavy imports
+    import tag
+    import transcribe
+    metrics.configure(QUIET)
+    tag.use_onnx_model(onnx_model)
+    # Only load the model the stage uses, so that the others do not pay for it in time and memory
+    keyword_model = whisper_model = None
+    if stage == "keyword extraction":
+        keyword_model = tag.get_kw_model() if real_models else StubKeyBERT()
+    elif stage in ("transcription", "transcription (audio copy)"):
+        whisper_model = transcribe.load_whisper_model() if real_models else StubWhisper()
+    pdf_options = {"sampling": tag.DEFAULT_PDF_SAMPLING, "max_pages": None, "max_chars": tag.DEFAULT_PDF_MAX_CHARS}
+
+    texts = []
+    if stage in ("keyword extraction", "tfidf keywords"):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            texts = [tag.extract_text(file_path, pdf_options) for file_path in corpus_files(root, (".pdf", ".txt"))]
+
+    def walk(folder):
+        return len(list(scan_folder(folder)))
+
+    def tag_read(folder):
+        paths = [file_path for file_path, stat in scan_folder(folder)]
+        for chunk in chunked(paths, BULK_SIZE):
+            get_finder_tags_bulk(chunk)
+        return len(paths)
+
+    def text_extraction(folder):
+        paths = corpus_files(folder, (".pdf", ".txt"))
+        for file_path in paths:
+            tag.extract_text(file_path, pdf_options)
+        return len(paths)
+
+    def keyword_extraction(folder):
+        for batch in chunked(texts, tag.DEFAULT_BATCH_SIZE):
+            tag.generate_tags_batch(batch, keyword_model, doc_embeddings=tag.embed_documents(batch, keyword_model))
+        return len(texts)
+
+    def tfidf_keywords(folder):
+        # Start from empty document frequencies on every repeat
+        with tempfile.TemporaryDirectory() as frequencies_dir:
+            model = TfidfKeywords(DocumentFrequencies(os.path.join(frequencies_dir, "frequencies.sqlite3")))
+            for batch in chunked(texts, tag.DEFAULT_BATCH_SIZE):
+                tag.generate_tags_batch(batch, model)
+            model.frequencies.close()
+        return len(texts)
+
+    def transcription(folder):
+        paths = corpus_files(folder, (".mp4", ".mkv", ".webm"))
+        for video_path in paths:
+            chapter_titles, transcription = transcribe.transcribe_video(video_path, whisper_model)
+            tag.video_text(video_path, chapter_titles, transcription)
+        return len(paths)
+
+    def transcription_audio_copy(folder):
+        # With the stub model, this leaves out the decoding of the copy Whisper does with ffmpeg
+        paths = corpus_files(folder, (".mp4", ".mkv", ".webm"))
+        for video_path in paths:
+            chapter_titles, transcription = transcribe.transcribe_video(video_path, whisper_model, keep_audio=True)
+            tag.video_text(video_path, chapter_titles, transcription)
+            # Remove the extracted audio and transcript so that the next repeat does the work again
+            shutil.rmtree(os.path.dirname(transcription))
+        return len(paths)
+
+    def metadata_write(folder):
+        paths = corpus_files(folder, (".pdf", ".txt", ".mp4", ".mkv", ".webm"))
+        for file_path in paths:
+            tag.write_metadata_tags(file_path, ["benchmark", "metadata write"])
+        return len(paths)
+
+    def sync(folder):
+        import sync as sync_module
+        sync_module.sync_tags(folder, full_scan=True)
+        return len(list(scan_folder(folder)))
+
+    def graph_build(folder):
+        import graph
+        files_tags = graph.build_files_tags(folder, full_scan=True)
+        nodes, edges = graph.build_graph(files_tags, folder)
+        graph.compute_layout(list(nodes), edges)
+        return len(list(scan_folder(folder)))
+
+    stage_functions = {
+        "walk": walk, "tag read": tag_read, "text extraction": text_extraction,
+        "keyword extraction": keyword_extraction, "tfidf keywords": tfidf_keywords, "transcription": transcription,
+        "transcription (audio copy)": transcription_audio_copy,
+        "metadata write": metadata_write, "sync": sync, "graph build": graph_build,
+    }
+    seconds = []
+    files = 0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            with scratch_copy(root) if stage in WRITING_STAGES else contextlib.nullcontext(root) as folder:
+                start = time.perf_counter()
+                files = stage_functions[stage](folder)
+                seconds.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    best = min(seconds)
+    return {
+        "files": files,
+        "seconds": round(best, 4),
+        "median_seconds": round(float(np.median(seconds)), 4),
+        "files_per_sec": round(files / best, 2) if best > 0 else None,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+def run_benchmark(root, stages=STAGES, repeat=3, real_models=False, onnx_model=None):
+    """Run every stage in its own spawned process and return {stage: measurements}."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for stage in stages:
+        print(f"Running {stage}...", file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                results[stage] = executor.submit(run_stage, stage, root, repeat, real_models, onnx_model).result()
+            except Exception as e:
+                print(f"Stage {stage} failed: {e}", file=sys.stderr)
+                results[stage] = {"error": str(e)}
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print the change in files/sec of every stage against a baseline and return the regressed stages."""
+    regressions = []
+    for stage, result in results.items():
+        before = baseline.get("stages", {}).get(stage, {}).get("files_per_sec")
+        after = result.get("files_per_sec")
+        if not before or not after:
+            continue
+        change = after / before - 1
+        print(f"{stage:20} {before:12.2f} -> {after:12.2f} files/sec ({change:+.1%})", file=sys.stderr)
+        if change < -tolerance:
+            regressions.append(stage)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of tagify on a synthetic library.")
+    parser.add_argument("--corpus", help="folder of the synthetic library (default: a temporary folder removed afterwards)")
+    for name, default in DEFAULT_CORPUS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default,
+                            help=f"corpus parameter (default: {default})")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), metavar="STAGE",
+                        help=f"stages to run, among: {', '.join(STAGES)}")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each stage; the fastest is reported")
+    parser.add_argument("--real-models", action="store_true", help="use KeyBERT and Whisper instead of the stub models")
+    parser.add_argument("--onnx-model", help="with --real-models, folder of an ONNX export for KeyBERT to embed with")
+    parser.add_argument("--output", help="write the JSON report to this file instead of standard output")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown in files/sec beyond which --compare reports a regression (default: 0.2)")
+    args = parser.parse_args()
+
+    root = args.corpus or tempfile.mkdtemp(prefix="tagify-benchmark-")
+    try:
+        try:
+            corpus = generate_corpus(root, **{name: getattr(args, name) for name in DEFAULT_CORPUS})
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        report = {
+            "corpus": corpus,
+            "repeat": args.repeat,
+            "real_models": args.real_models,
+            "onnx_model": args.onnx_model,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "stages": run_benchmark(root, args.stages, max(1, args.repeat), args.real_models, args.onnx_model),
+        }
+    finally:
+        if not args.corpus:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(report["stages"], json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,177 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import numpy as np
+
+# Default location of the on-disk cache
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".tagify", "cache.sqlite3")
+
+# Default upper bound on the size of the cached texts and embeddings
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Number of cache hits whose access times are kept in memory before being written in one transaction
+ACCESS_FLUSH_EVERY = 500
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Return the BLAKE2b hex digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class TagCache:
+    """SQLite cache of extracted text, document embedding and tags keyed by file content.
+
+    Entries are keyed by content hash, embedding model name and top_n. Writing metadata into a
+    PDF or a video changes its content hash, so the hash of the written file can be registered
+    as an alias of the entry it was tagged from. The least recently used entries are evicted
+    once the stored texts and embeddings exceed max_bytes. The access times of cache hits are
+    written in batches, with the next put, every ACCESS_FLUSH_EVERY hits and on close.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                content_hash TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                top_n INTEGER NOT NULL,
+                text TEXT,
+                embedding BLOB,
+                tags TEXT,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (content_hash, model_name, top_n)
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+            CREATE TABLE IF NOT EXISTS aliases (
+                alias_hash TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS aliases_content_hash ON aliases (content_hash);
+        """)
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # Access times of the cache hits not written yet, by entry key
+        self.accesses = {}
+
+    def _resolve(self, content_hash):
+        row = self.conn.execute("SELECT content_hash FROM aliases WHERE alias_hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else content_hash
+
+    def get(self, content_hash, model_name, top_n):
+        """Return the cached text, embedding and tags of a file, or None on a cache miss."""
+        content_hash = self._resolve(content_hash)
+        row = self.conn.execute(
+            "SELECT text, embedding, tags FROM entries WHERE content_hash = ? AND model_name = ? AND top_n = ?",
+            (content_hash, model_name, top_n)
+        ).fetchone()
+        if row is None:
+            return None
+        self.accesses[(content_hash, model_name, top_n)] = time.time()
+        if len(self.accesses) >= ACCESS_FLUSH_EVERY:
+            self.flush()
+        text, embedding, tags = row
+        return {
+            "text": text,
+            "embedding": np.frombuffer(embedding, dtype=np.float32) if embedding is not None else None,
+            "tags": json.loads(tags) if tags is not None else None,
+        }
+
+    def get_partial(self, content_hash, model_name):
+        """Return the cached text and embedding of a file, whatever top_n it was tagged with."""
+        content_hash = self._resolve(content_hash)
+        row = self.conn.execute(
+            "SELECT text, embedding, model_name FROM entries WHERE content_hash = ? "
+            "ORDER BY model_name = ? DESC, last_access DESC LIMIT 1",
+            (content_hash, model_name)
+        ).fetchone()
+        if row is None:
+            return None
+        text, embedding, cached_model_name = row
+        # An embedding is only reusable with the model that produced it
+        if cached_model_name != model_name:
+            embedding = None
+        return {
+            "text": text,
+            "embedding": np.frombuffer(embedding, dtype=np.float32) if embedding is not None else None,
+        }
+
+    def put(self, content_hash, model_name, top_n, text, embedding, tags):
+        """Store the text, document embedding and tags generated for a file."""
+        content_hash = self._resolve(content_hash)
+        embedding_blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        size = len(text.encode("utf-8")) if text else 0
+        size += len(embedding_blob) if embedding_blob else 0
+        previous = self.conn.execute(
+            "SELECT size FROM entries WHERE content_hash = ? AND model_name = ? AND top_n = ?",
+            (content_hash, model_name, top_n)
+        ).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (content_hash, model_name, top_n, text, embedding, tags, size, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (content_hash, model_name, top_n, text, embedding_blob, json.dumps(tags), size, time.time())
+        )
+        self.total_bytes += size - (previous[0] if previous else 0)
+        # Evict by the latest access times
+        self._write_accesses()
+        self.evict()
+        self.conn.commit()
+
+    def add_alias(self, alias_hash, content_hash):
+        """Make alias_hash resolve to the entries stored for content_hash."""
+        content_hash = self._resolve(content_hash)
+        if alias_hash == content_hash:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO aliases (alias_hash, content_hash) VALUES (?, ?)",
+            (alias_hash, content_hash)
+        )
+        self.conn.commit()
+
+    def _write_accesses(self):
+        if self.accesses:
+            self.conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE content_hash = ? AND model_name = ? AND top_n = ?",
+                [(accessed, *key) for key, accessed in self.accesses.items()]
+            )
+            self.accesses.clear()
+
+    def flush(self):
+        """Write the access times of the cache hits since the last flush in one transaction."""
+        self._write_accesses()
+        self.conn.commit()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes."""
+        while self.total_bytes > self.max_bytes:
+            row = self.conn.execute(
+                "SELECT content_hash, model_name, top_n, size FROM entries ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self.total_bytes = 0
+                break
+            content_hash, model_name, top_n, size = row
+            self.conn.execute(
+                "DELETE FROM entries WHERE content_hash = ? AND model_name = ? AND top_n = ?",
+                (content_hash, model_name, top_n)
+            )
+            # Drop the aliases once no entry is left for the content hash
+            self.conn.execute(
+                "DELETE FROM aliases WHERE content_hash = ? AND NOT EXISTS "
+                "(SELECT 1 FROM entries WHERE entries.content_hash = aliases.content_hash)",
+                (content_hash,)
+            )
+            self.total_bytes -= size
+
+    def close(self):
+        self.flush()
+        self.conn.close()
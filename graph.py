@@ -1,152 +1,320 @@
 import os
 import sys
-import subprocess
-from pyvis.network import Network
+import json
+import math
+import pathlib
+import argparse
+import webbrowser
 from tkinter import Tk, filedialog
+import numpy as np
+from manifest import Manifest
+from tagstore import get_finder_tags_bulk, chunked, BULK_SIZE
+from metrics import metrics, log, add_arguments, configure_from_args
 
-def get_tags(file_path):
-    """Get tags for a file using the tag command line tool."""
-    tag_cmd = ["tag", "--list", file_path]
-    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Failed to get tags for {file_path}: {result.stderr}")
-        return []
-    tags_str = result.stdout.replace(file_path,"").strip()
-    # Split the tags_str based on the first occurrence of multiple spaces
-    tags = [tag.strip() for tag in tags_str.split(",")] if tags_str else []
-    if len(tags) > 0:
-        print(f"Retrieved Finder tags for {file_path}: {', '.join(tags)}")
-    else:
-        print(f"No Finder tags found for {file_path}")
-    return tags
+# The graph page is written next to this script so that it can load the vendored vis-network
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_PATH = os.path.join(SCRIPT_DIR, "tags_graph.html")
+
+# Beyond this many files, --cluster auto collapses files into per-folder nodes
+MAX_FILE_NODES = 2000
+
+# Node colors and shapes of the graph
+FILE_COLOR = "blue"
+TAG_COLOR = "green"
+FOLDER_COLOR = "purple"
+NODE_STYLES = {
+    "file": {"color": FILE_COLOR, "shape": "box"},
+    "folder": {"color": FOLDER_COLOR, "shape": "box"},
+    "tag": {"color": TAG_COLOR, "shape": "ellipse"},
+}
+
+def build_files_tags(folder_path, full_scan=False):
+    """Build the files_tags dictionary, keyed by file path, by recursively visiting all files and sub-folders.
 
-def build_files_tags(folder_path):
-    """Build the files_tags dictionary by recursively visiting all files and sub-folders."""
+    The tags of files that have not changed since the previous run are taken from the
+    folder's manifest instead of being read again, unless full_scan is set.
+    """
+    manifest = Manifest(folder_path, "graph", force=full_scan)
     files_tags = {}
-    for root, dirs, files in os.walk(folder_path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            
-            # Check if it's actually a file
-            if not os.path.isfile(file_path):
-                continue
-            
-            # Skip hidden files and non-supported files
-            if file_name.startswith("._") or not file_name.endswith((".pdf", ".txt", ".mp4", ".mkv", ".webm")):
-                continue
-            
-            tags = get_tags(file_path)
+    for chunk in chunked(manifest.scan(), BULK_SIZE):
+        changed_paths = [file_path for file_path, stat, changed in chunk if changed]
+        with metrics.stage("finder tags", files=len(changed_paths)):
+            finder_tags = get_finder_tags_bulk(changed_paths)
+        for file_path, stat, changed in chunk:
+            file_name = os.path.basename(file_path)
+
+            if changed:
+                tags = finder_tags[file_path]
+                manifest.update(file_path, tags, stat)
+            else:
+                tags = manifest.tags(file_path)
             if len(tags) > 0:
-                files_tags[file_name] = tags
-                print(f"Added tags for {file_name}: {tags}")  # Debugging print statement
+                files_tags[file_path] = tags
+                log(f"Added tags for {file_name}: {tags}")
             else:
-                print(f"No tags found for {file_name}")  # Debugging print statement
+                log(f"No tags found for {file_name}")
+        metrics.file_done(len(chunk))
+    manifest.prune()
+    manifest.save()
     return files_tags
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        folder_path = sys.argv[1]
-    else:
-        # Prompt the user to select a folder if no folder path is provided
-        root = Tk()
-        root.withdraw()  # Hide the root window
-        folder_path = filedialog.askdirectory(title="Select Folder Containing Files to Tag")
-        if not folder_path:
-            print("No folder path provided.")
-            sys.exit()
+def build_graph(files_tags, folder_path, cluster="none"):
+    """Turn files_tags into graph nodes and weighted edges.
 
-    print(f"Selected folder: {folder_path}")
+    cluster selects what the non-tag nodes are: "none" gives one node per file, "folder" one node
+    per folder (with the number of files it holds), and "tag" drops files altogether and links
+    tags that appear on the same files. Returns (nodes, edges) where nodes maps node ids to their
+    attributes and edges maps (source, target) pairs to weights.
+    """
+    nodes = {}
+    edges = {}
 
-    files_tags = build_files_tags(folder_path)
-    print(f"Files and tags: {files_tags}")
+    def add_node(node_id, label, kind):
+        node = nodes.setdefault(node_id, {"label": label, "kind": kind, "count": 0})
+        node["count"] += 1
 
-    # Initialize a PyVis Network object
-    net = Network(height="750px", width="100%", bgcolor="#222222", font_color="white")
+    def add_edge(source, target):
+        edges[(source, target)] = edges.get((source, target), 0) + 1
 
-    # Add nodes and edges
-    for file, tags in files_tags.items():
-        # Add file node (shape: rectangle)
-        net.add_node(file, label=file, color="blue", shape="box", node_type = "file")
+    for file_path, tags in files_tags.items():
+        tags = sorted(set(tags))
+        for tag in tags:
+            add_node(f"tag:{tag}", tag, "tag")
+        if cluster == "tag":
+            for i, tag in enumerate(tags):
+                for other in tags[i + 1:]:
+                    add_edge(f"tag:{tag}", f"tag:{other}")
+            continue
+        if cluster == "folder":
+            folder = os.path.relpath(os.path.dirname(file_path), folder_path)
+            source = f"folder:{folder}"
+            add_node(source, os.path.basename(os.path.abspath(os.path.join(folder_path, folder))), "folder")
+        else:
+            source = f"file:{file_path}"
+            add_node(source, os.path.basename(file_path), "file")
         for tag in tags:
-            # Add tag node (shape: ellipse, if not already added)
-            if tag not in net.node_map:
-                net.add_node(tag, label=tag, color="green", shape="ellipse", node_type = "tag")
-            # Add edge between file and tag
-            net.add_edge(file, tag)
+            add_edge(source, f"tag:{tag}")
+    return nodes, edges
 
-    # Generate the network graph HTML
-    net.write_html("tags_graph.html")
-    print("Generated tags_graph.html")
+def prune_edges(nodes, edges, min_weight):
+    """Drop the edges lighter than min_weight and the nodes they leave unconnected."""
+    if min_weight <= 1:
+        return nodes, edges
+    edges = {pair: weight for pair, weight in edges.items() if weight >= min_weight}
+    connected = {node_id for pair in edges for node_id in pair}
+    nodes = {node_id: node for node_id, node in nodes.items() if node_id in connected}
+    return nodes, edges
+
+def repulsion(positions, k):
+    """Return the displacement every node gets from the repulsion of the nodes less than 2k away.
+
+    Nodes are bucketed into a grid of 2k wide cells and only repel the nodes of their own and the
+    eight neighbouring cells (the grid variant of Fruchterman-Reingold), so a layout step takes
+    time and memory roughly linear in the number of nodes instead of quadratic.
+    """
+    cutoff = 2 * k
+    buckets = {}
+    for i, cell in enumerate(map(tuple, np.floor(positions / cutoff).astype(np.int64))):
+        buckets.setdefault(cell, []).append(i)
+    displacement = np.zeros_like(positions)
+    for (x, y), members in buckets.items():
+        neighbours = [i for dx in (-1, 0, 1) for dy in (-1, 0, 1) for i in buckets.get((x + dx, y + dy), ())]
+        delta = positions[members, None, :] - positions[None, neighbours, :]
+        distance2 = np.maximum((delta ** 2).sum(axis=-1), 1e-6)
+        force = np.where(distance2 < cutoff * cutoff, k * k / distance2, 0.0)
+        displacement[members] += (delta * force[..., None]).sum(axis=1)
+    return displacement
+
+def compute_layout(node_ids, edges, iterations=50, seed=0):
+    """Lay the graph out with the Fruchterman-Reingold algorithm and return {node_id: (x, y)}."""
+    count = len(node_ids)
+    if count == 0:
+        return {}
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    rng = np.random.default_rng(seed)
+    positions = rng.random((count, 2))
+    sources = np.array([index[source] for source, _ in edges], dtype=np.int64)
+    targets = np.array([index[target] for _, target in edges], dtype=np.int64)
+    weights = np.log1p(np.array(list(edges.values()), dtype=np.float64))
+    k = 1.0 / math.sqrt(count)
+    temperature = 0.1
+
+    for iteration in range(iterations):
+        displacement = repulsion(positions, k)
+        if len(sources):
+            delta = positions[sources] - positions[targets]
+            distance = np.sqrt((delta ** 2).sum(axis=-1))
+            force = delta * (distance * weights / k)[:, None]
+            np.subtract.at(displacement, sources, force)
+            np.add.at(displacement, targets, force)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=-1)), 1e-9)
+        positions += displacement / length[:, None] * np.minimum(length, temperature)[:, None]
+        temperature = 0.1 * (1 - (iteration + 1) / iterations) + 1e-3
+
+    # Scale the layout so that nodes keep roughly the same spacing whatever the graph size
+    positions -= positions.mean(axis=0)
+    span = max(np.abs(positions).max(), 1e-9)
+    positions *= 40 * math.sqrt(count) / span
+    return {node_id: (float(x), float(y)) for node_id, (x, y) in zip(node_ids, positions)}
 
-    # Add custom JavaScript for interactivity
-    with open("tags_graph.html", "r") as file:
-        html_content = file.read()
+def adjacency_index(nodes, edges):
+    """Return {node_id: [neighbour ids]} so the page can highlight neighbourhoods without searching."""
+    adjacency = {node_id: [] for node_id in nodes}
+    for source, target in edges:
+        adjacency[source].append(target)
+        adjacency[target].append(source)
+    return adjacency
 
-    custom_js = """
-    <script type="text/javascript">
+def vis_node(node_id, node):
+    """Return the vis-network node of a graph node."""
+    label = node["label"] if node["kind"] == "file" else f"{node['label']} ({node['count']})"
+    return {"id": node_id, "label": label, "value": node["count"], "node_type": node["kind"], **NODE_STYLES[node["kind"]]}
+
+def vis_edges(edges):
+    """Return the vis-network edges of a {(source, target): weight} dictionary."""
+    return [{"from": source, "to": target, "value": weight, "title": str(weight)} for (source, target), weight in edges.items()]
+
+def graph_data(nodes, edges, positions):
+    """Return the vis-network nodes, edges, colors and adjacency index of a laid-out graph."""
+    vis_nodes = []
+    for node_id, node in nodes.items():
+        x, y = positions[node_id]
+        vis_nodes.append({**vis_node(node_id, node), "x": x, "y": y})
+    colors = {node_id: NODE_STYLES[node["kind"]]["color"] for node_id, node in nodes.items()}
+    return {"nodes": vis_nodes, "edges": vis_edges(edges), "colors": colors, "adjacency": adjacency_index(nodes, edges)}
+
+GRAPH_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>Tags graph</title>
+    <link rel="stylesheet" href="lib/vis-9.1.2/vis-network.css">
+    <script src="lib/vis-9.1.2/vis-network.min.js"></script>
+    <style>
+        body { margin: 0; background-color: #222222; }
+        #mynetwork { width: 100%; height: 100vh; }
+    </style>
+</head>
+<body>
+<div id="mynetwork"></div>
+<script type="text/javascript">
+    var graph = __GRAPH_DATA__;
+    var nodes = new vis.DataSet(graph.nodes);
+    var edges = new vis.DataSet(graph.edges);
+    var network = new vis.Network(document.getElementById("mynetwork"), {nodes: nodes, edges: edges}, {
+        physics: false,
+        nodes: {font: {color: "white"}, scaling: {min: 10, max: 40}},
+        edges: {smooth: false, color: {opacity: 0.4}, scaling: {min: 1, max: 8}},
+        interaction: {hideEdgesOnDrag: true, tooltipDelay: 200}
+    });
+    var highlighted = false;
 
     function highlightConnectedNodes(params) {
-        if (params.nodes.length > 0) {
-            var selectedNode = params.nodes[0];
-            var connectedNodes = network.getConnectedNodes(selectedNode);
-            var secondLevelNodes = [];
-            connectedNodes.forEach(function(node) {
-                secondLevelNodes = secondLevelNodes.concat(network.getConnectedNodes(node));
+        // The adjacency index gives each node's neighbours directly, and the sets make the
+        // membership test constant-time per node
+        var selectedNode = params.nodes[0];
+        var connectedNodes = new Set([selectedNode]);
+        (graph.adjacency[selectedNode] || []).forEach(function(node) {
+            connectedNodes.add(node);
+            (graph.adjacency[node] || []).forEach(function(secondLevelNode) {
+                connectedNodes.add(secondLevelNode);
             });
-
-            var allNodes = network.body.nodes;
-            for (var nodeId in allNodes) {
-                if (allNodes.hasOwnProperty(nodeId)) {
-                    var node = allNodes[nodeId];
-                    if (nodeId == selectedNode || connectedNodes.includes(nodeId) || secondLevelNodes.includes(nodeId)) {
-                        node.setOptions({color: 'orange'});
-                    } else {
-                        node.setOptions({color: 'grey'});
-                    }
-                }
-            }
-        }
+        });
+        nodes.update(nodes.getIds().map(function(nodeId) {
+            return {id: nodeId, color: connectedNodes.has(nodeId) ? "orange" : "grey"};
+        }));
+        highlighted = true;
     }
 
     function unhighlightConnectedNodes() {
-        var allNodes = network.body.nodes;
-        for (var nodeId in allNodes) {
-            if (allNodes.hasOwnProperty(nodeId)) {
-                var node = allNodes[nodeId];
-                if (node.options.node_type === "file") {
-                    node.setOptions({color: "blue"});
-                } else if (node.options.node_type === "tag") {
-                    node.setOptions({color: "green"});
-                }
-            }
+        if (!highlighted) {
+            return;
         }
+        nodes.update(nodes.getIds().map(function(nodeId) {
+            return {id: nodeId, color: graph.colors[nodeId]};
+        }));
+        highlighted = false;
     }
-    
-    network.on('click', function(params) {
+
+    network.on("click", function(params) {
         if (params.nodes.length === 0) {
             unhighlightConnectedNodes();
         } else {
             highlightConnectedNodes(params);
         }
     });
-    
-    // Store the original colors of all nodes after the graph is created
-    </script>
-    """
+</script>
+</body>
+</html>
+"""
 
-    # Insert the custom JavaScript before the closing </body> tag
-    html_content = html_content.replace("</body>", custom_js + "</body>")
+def write_graph_html(data, output_path=OUTPUT_PATH):
+    """Write the graph page with its data embedded."""
+    # Escape "</" so that labels cannot close the script element
+    graph_json = json.dumps(data).replace("</", "<\\/")
+    with open(output_path, "w") as file:
+        file.write(GRAPH_PAGE.replace("__GRAPH_DATA__", graph_json))
 
-    with open("tags_graph.html", "w") as file:
-        file.write(html_content)
-    print("Updated tags_graph.html with custom JavaScript")
+def main(argv=None):
+    """Open the tags graph of the folder given on the command line (or in argv) and return the exit status."""
+    parser = argparse.ArgumentParser(description="Open a graph of the files in a folder and their tags.")
+    parser.add_argument("folder_path", nargs="?", help="folder containing the tagged files")
+    parser.add_argument("--full", action="store_true", help="read the tags of every file, even those unchanged since the last run")
+    parser.add_argument("--cluster", choices=("auto", "none", "folder", "tag"), default="auto",
+                        help=f"show files (none), per-folder nodes (folder) or only tags (tag); auto shows files up to {MAX_FILE_NODES} of them")
+    parser.add_argument("--min-weight", type=int, default=1, help="hide edges shared by fewer files than this")
+    parser.add_argument("--iterations", type=int, default=50, help="number of layout iterations")
+    parser.add_argument("--serve", action="store_true", help="explore the graph through a local server that sends only the part being viewed")
+    parser.add_argument("--port", type=int, default=0, help="port of the --serve server (default: any free port)")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+
+    if args.folder_path:
+        folder_path = args.folder_path
+    else:
+        # Prompt the user to select a folder if no folder path is provided
+        root = Tk()
+        root.withdraw()  # Hide the root window
+        folder_path = filedialog.askdirectory(title="Select Folder Containing Files to Tag")
+        if not folder_path:
+            print("No folder path provided.")
+            return 0
+
+    print(f"Selected folder: {folder_path}")
+
+    files_tags = build_files_tags(folder_path, full_scan=args.full)
+    metrics.print_summary()
+    print(f"Found tags for {len(files_tags)} files")
+
+    if args.serve:
+        from graphserver import serve_graph
+        serve_graph(files_tags, folder_path, port=args.port)
+        return 0
+
+    cluster = args.cluster
+    if cluster == "auto":
+        cluster = "none" if len(files_tags) <= MAX_FILE_NODES else "folder"
+    nodes, edges = build_graph(files_tags, folder_path, cluster)
+    nodes, edges = prune_edges(nodes, edges, args.min_weight)
+    print(f"Laying out {len(nodes)} nodes and {len(edges)} edges")
+    with metrics.stage("layout"):
+        positions = compute_layout(list(nodes), edges, iterations=args.iterations)
+
+    # Generate the network graph HTML
+    write_graph_html(graph_data(nodes, edges, positions))
+    print(f"Generated {OUTPUT_PATH}")
 
     # Open the generated HTML file in the default web browser
     try:
-        # Use os.system to open the file with the default application
-        os.system("open tags_graph.html")
-        print("Opened tags_graph.html in web browser")
-        sys.exit(0) # Exit with status code 0 indicating success
+        if not webbrowser.open(pathlib.Path(OUTPUT_PATH).as_uri()):
+            print(f"No web browser found to open {OUTPUT_PATH}")
+            return 1
+        print(f"Opened {OUTPUT_PATH} in web browser")
+        return 0 # Status code 0 indicating success
     except Exception as e:
-        print(f"Failed to open tags_graph.html in web browser: {e}")
-        sys.exit(1)  # Exit with status code 1 indicating an error
+        print(f"Failed to open {OUTPUT_PATH} in web browser: {e}")
+        return 1  # Status code 1 indicating an error
+
+if __name__ == "__main__":
+    sys.exit(main())
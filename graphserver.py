@@ -0,0 +1,277 @@
+import os
+import json
+import webbrowser
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from graph import SCRIPT_DIR, vis_node
+
+# Vendored vis-network assets served to the browser
+VIS_DIR = os.path.join(SCRIPT_DIR, "lib", "vis-9.1.2")
+
+# Default number of files and co-occurring tags returned by a single query
+DEFAULT_LIMIT = 50
+DEFAULT_TOP_K = 20
+
+CONTENT_TYPES = {".js": "application/javascript", ".css": "text/css", ".html": "text/html; charset=utf-8"}
+
+class GraphIndex:
+    """In-memory index of files_tags answering the subgraph queries of the graph server.
+
+    Files are indexed by tag and by folder (relative to the root folder) so that a query only
+    touches the files it returns.
+    """
+
+    def __init__(self, files_tags, folder_path):
+        self.folder_path = folder_path
+        self.path_tags = {file_path: sorted(set(tags)) for file_path, tags in files_tags.items()}
+        self.tag_paths = {}
+        self.folder_files = {}
+        self.folder_children = {}
+        self.folder_counts = Counter()
+        for file_path in sorted(self.path_tags):
+            for tag in self.path_tags[file_path]:
+                self.tag_paths.setdefault(tag, []).append(file_path)
+            folder = self._folder_key(os.path.dirname(file_path))
+            self.folder_files.setdefault(folder, []).append(file_path)
+            # Count the file in every folder above it and link each folder to its parent
+            while True:
+                self.folder_counts[folder] += 1
+                if folder == ".":
+                    break
+                parent = os.path.dirname(folder) or "."
+                self.folder_children.setdefault(parent, set()).add(folder)
+                folder = parent
+
+    def _folder_key(self, path):
+        return os.path.relpath(path, self.folder_path)
+
+    def _file_node(self, file_path):
+        return vis_node(f"file:{file_path}", {"label": os.path.basename(file_path), "kind": "file", "count": 1})
+
+    def _tag_node(self, tag):
+        return vis_node(f"tag:{tag}", {"label": tag, "kind": "tag", "count": len(self.tag_paths.get(tag, ()))})
+
+    def _folder_node(self, folder):
+        label = os.path.basename(os.path.abspath(os.path.join(self.folder_path, folder)))
+        return vis_node(f"folder:{folder}", {"label": label, "kind": "folder", "count": self.folder_counts[folder]})
+
+    def _files_subgraph(self, file_paths, nodes, edges):
+        for file_path in file_paths:
+            nodes[f"file:{file_path}"] = self._file_node(file_path)
+            for tag in self.path_tags[file_path]:
+                nodes.setdefault(f"tag:{tag}", self._tag_node(tag))
+                edges[(f"file:{file_path}", f"tag:{tag}")] = 1
+
+    def tags(self, prefix="", limit=DEFAULT_LIMIT):
+        """Return the most used tags starting with prefix as [{"tag", "count"}]."""
+        prefix = prefix.lower()
+        matches = [(len(paths), tag) for tag, paths in self.tag_paths.items() if tag.lower().startswith(prefix)]
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return [{"tag": tag, "count": count} for count, tag in matches[:limit]]
+
+    def cooccurring(self, tag, top_k=DEFAULT_TOP_K):
+        """Return the top_k tags that appear most often on the same files as tag, with their counts."""
+        counts = Counter()
+        for file_path in self.tag_paths.get(tag, ()):
+            counts.update(other for other in self.path_tags[file_path] if other != tag)
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+    def tag_subgraph(self, tag, limit=DEFAULT_LIMIT):
+        """Return the neighbourhood of a tag: up to limit of its files and their other tags."""
+        nodes, edges = {}, {}
+        if tag in self.tag_paths:
+            nodes[f"tag:{tag}"] = self._tag_node(tag)
+            self._files_subgraph(self.tag_paths[tag][:limit], nodes, edges)
+        return self._response(nodes, edges, total=len(self.tag_paths.get(tag, ())))
+
+    def cooccurrence_subgraph(self, tag, top_k=DEFAULT_TOP_K):
+        """Return a tag linked to its top_k co-occurring tags, weighted by the files they share."""
+        nodes, edges = {}, {}
+        if tag in self.tag_paths:
+            nodes[f"tag:{tag}"] = self._tag_node(tag)
+            for other, count in self.cooccurring(tag, top_k):
+                nodes[f"tag:{other}"] = self._tag_node(other)
+                edges[(f"tag:{tag}", f"tag:{other}")] = count
+        return self._response(nodes, edges, total=len(nodes))
+
+    def folder_subgraph(self, folder=".", limit=DEFAULT_LIMIT):
+        """Return a folder linked to its sub-folders and to up to limit of the files it directly holds."""
+        folder = os.path.normpath(folder or ".")
+        nodes, edges = {}, {}
+        if folder in self.folder_counts:
+            source = f"folder:{folder}"
+            nodes[source] = self._folder_node(folder)
+            for child in sorted(self.folder_children.get(folder, ())):
+                nodes[f"folder:{child}"] = self._folder_node(child)
+                edges[(source, f"folder:{child}")] = self.folder_counts[child]
+            file_paths = self.folder_files.get(folder, [])[:limit]
+            self._files_subgraph(file_paths, nodes, edges)
+            for file_path in file_paths:
+                edges[(source, f"file:{file_path}")] = 1
+        return self._response(nodes, edges, total=len(self.folder_files.get(folder, ())))
+
+    def _response(self, nodes, edges, total):
+        vis_edges = [{"id": f"{source}->{target}", "from": source, "to": target, "value": weight, "title": str(weight)}
+                     for (source, target), weight in edges.items()]
+        return {"nodes": list(nodes.values()), "edges": vis_edges, "total": total}
+
+EXPLORER_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>Tags graph</title>
+    <link rel="stylesheet" href="lib/vis-9.1.2/vis-network.css">
+    <script src="lib/vis-9.1.2/vis-network.min.js"></script>
+    <style>
+        body { margin: 0; background-color: #222222; color: white; font-family: sans-serif; }
+        #toolbar { position: absolute; top: 10px; left: 10px; z-index: 1; }
+        #info { margin-top: 6px; font-size: 13px; }
+        #mynetwork { width: 100%; height: 100vh; }
+    </style>
+</head>
+<body>
+<div id="toolbar">
+    <input id="search" list="suggestions" placeholder="Tag">
+    <datalist id="suggestions"></datalist>
+    <button id="clear">Clear</button>
+    <div id="info">Click a tag to show its files, double-click it to show the tags it co-occurs with, click a folder to open it.</div>
+</div>
+<div id="mynetwork"></div>
+<script type="text/javascript">
+    var nodes = new vis.DataSet([]);
+    var edges = new vis.DataSet([]);
+    var network = new vis.Network(document.getElementById("mynetwork"), {nodes: nodes, edges: edges}, {
+        nodes: {font: {color: "white"}, scaling: {min: 10, max: 40}},
+        edges: {smooth: false, color: {opacity: 0.4}, scaling: {min: 1, max: 8}},
+        physics: {stabilization: {iterations: 100}}
+    });
+    var info = document.getElementById("info");
+
+    function load(url) {
+        // Merge the returned subgraph into what is already displayed
+        fetch(url).then(function(response) { return response.json(); }).then(function(data) {
+            nodes.update(data.nodes);
+            edges.update(data.edges);
+            info.textContent = "Showing " + nodes.length + " nodes (" + data.total + " matching)";
+        });
+    }
+
+    network.on("click", function(params) {
+        if (params.nodes.length === 0) {
+            return;
+        }
+        var nodeId = params.nodes[0];
+        var node = nodes.get(nodeId);
+        if (node.node_type === "tag") {
+            load("api/tag?name=" + encodeURIComponent(nodeId.slice(4)));
+        } else if (node.node_type === "folder") {
+            load("api/folder?path=" + encodeURIComponent(nodeId.slice(7)));
+        } else {
+            info.textContent = nodeId.slice(5);
+        }
+    });
+
+    network.on("doubleClick", function(params) {
+        if (params.nodes.length > 0 && params.nodes[0].indexOf("tag:") === 0) {
+            load("api/cooccur?tag=" + encodeURIComponent(params.nodes[0].slice(4)));
+        }
+    });
+
+    var search = document.getElementById("search");
+    search.addEventListener("input", function() {
+        fetch("api/tags?q=" + encodeURIComponent(search.value)).then(function(response) { return response.json(); }).then(function(tags) {
+            var suggestions = document.getElementById("suggestions");
+            suggestions.innerHTML = "";
+            tags.forEach(function(tag) {
+                var option = document.createElement("option");
+                option.value = tag.tag;
+                option.label = tag.tag + " (" + tag.count + ")";
+                suggestions.appendChild(option);
+            });
+        });
+    });
+    search.addEventListener("change", function() {
+        load("api/tag?name=" + encodeURIComponent(search.value));
+    });
+
+    document.getElementById("clear").addEventListener("click", function() {
+        nodes.clear();
+        edges.clear();
+        load("api/folder?path=.");
+    });
+
+    load("api/folder?path=.");
+</script>
+</body>
+</html>
+"""
+
+def make_handler(index):
+    """Return the request handler class serving the explorer page, the vis assets and index queries."""
+
+    class GraphRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                limit = int(query.get("limit", DEFAULT_LIMIT))
+                top_k = int(query.get("k", DEFAULT_TOP_K))
+            except ValueError:
+                self.send_error(400, "limit and k must be integers")
+                return
+
+            if url.path == "/":
+                self._send(EXPLORER_PAGE.encode("utf-8"), CONTENT_TYPES[".html"])
+            elif url.path.startswith("/lib/vis-9.1.2/"):
+                self._send_asset(url.path.rsplit("/", 1)[1])
+            elif url.path == "/api/tags":
+                self._send_json(index.tags(query.get("q", ""), limit))
+            elif url.path == "/api/tag":
+                self._send_json(index.tag_subgraph(query.get("name", ""), limit))
+            elif url.path == "/api/cooccur":
+                self._send_json(index.cooccurrence_subgraph(query.get("tag", ""), top_k))
+            elif url.path == "/api/folder":
+                self._send_json(index.folder_subgraph(query.get("path", "."), limit))
+            else:
+                self.send_error(404)
+
+        def _send_asset(self, file_name):
+            # Only the files of the vendored vis-network folder can be served
+            asset_path = os.path.join(VIS_DIR, file_name)
+            if file_name in ("", ".", "..") or not os.path.isfile(asset_path):
+                self.send_error(404)
+                return
+            with open(asset_path, "rb") as file:
+                self._send(file.read(), CONTENT_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream"))
+
+        def _send_json(self, data):
+            self._send(json.dumps(data).encode("utf-8"), "application/json")
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Keep the terminal quiet; every click of the page issues a request
+            pass
+
+    return GraphRequestHandler
+
+def serve_graph(files_tags, folder_path, port=0, open_browser=True):
+    """Serve the tag graph of folder_path on localhost until interrupted."""
+    index = GraphIndex(files_tags, folder_path)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(index))
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    print(f"Serving the tags graph of {len(index.path_tags)} files and {len(index.tag_paths)} tags at {url}")
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped the graph server")
+    finally:
+        server.server_close()
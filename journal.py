@@ -0,0 +1,116 @@
+import os
+import json
+import sqlite3
+from manifest import file_signature
+from metrics import log, error, NORMAL
+
+# Name of the journal kept at the root of a folder while it is being tagged
+JOURNAL_NAME = ".tagify_journal.sqlite3"
+
+# Stages a file goes through, in order: its text was extracted (or its video transcribed), its
+# tags were generated, written to its metadata, and set as its Finder tags
+EXTRACTED = "extracted"
+TAGGED = "tagged"
+WRITTEN = "written"
+FINDER_TAGS_SET = "finder tags set"
+
+class RunJournal:
+    """Record of the last stage each file of a run reached, so that an interrupted run can resume.
+
+    Entries are written in one transaction per batch of files and keep the file's signature
+    after the stage, so a file changed since then starts over. Extracted texts are kept until
+    the file is tagged, so a resumed run does not transcribe a video again. The files that are
+    done are only kept until the folder's manifest, which then records them, is saved.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, JOURNAL_NAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                content_hash TEXT,
+                text TEXT,
+                tags TEXT
+            )
+        """)
+        self.conn.commit()
+        count = self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        if count:
+            log(f"Resuming from {self.path}, which records {count} files of an earlier run", NORMAL)
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self.folder_path)
+
+    def record(self, stage, files_tags, hashes=None, texts=None):
+        """Record that the files of files_tags ({file_path: tags}) reached stage, in one transaction.
+
+        hashes and texts give the content hash and extracted text of some of the files.
+        """
+        rows = []
+        for file_path, tags in files_tags.items():
+            try:
+                signature = json.dumps(file_signature(os.stat(file_path)))
+            except OSError as e:
+                error(f"Failed to record {file_path} in the journal: {e}", file_path, "journal")
+                continue
+            rows.append((
+                self._key(file_path), stage, signature, (hashes or {}).get(file_path),
+                (texts or {}).get(file_path), json.dumps(tags) if tags is not None else None
+            ))
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, stage, signature, content_hash, text, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def entries(self, file_paths, chunk_size=900):
+        """Return {file_path: entry} for the given files that are in the journal.
+
+        Each entry holds the stage, content_hash, text and tags recorded for the file, and
+        whether the file is unchanged since.
+        """
+        keys = {self._key(file_path): file_path for file_path in file_paths}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), chunk_size):
+            chunk = key_list[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            for key, stage, signature, content_hash, text, tags in self.conn.execute(
+                f"SELECT path, stage, signature, content_hash, text, tags FROM files WHERE path IN ({placeholders})", chunk
+            ):
+                file_path = keys[key]
+                try:
+                    unchanged = json.loads(signature) == file_signature(os.stat(file_path))
+                except OSError:
+                    continue
+                found[file_path] = {
+                    "stage": stage,
+                    "unchanged": unchanged,
+                    "content_hash": content_hash,
+                    "text": text,
+                    "tags": json.loads(tags) if tags is not None else None,
+                }
+        return found
+
+    def forget_done(self):
+        """Forget the files that went through every stage, once the manifest recording them is saved.
+
+        The other files keep their entries, so that the next run retries them from their last
+        stage, unless they no longer exist.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE stage = ?", (FINDER_TAGS_SET,))
+            missing = [(key,) for (key,) in self.conn.execute("SELECT path FROM files")
+                       if not os.path.exists(os.path.join(self.folder_path, key))]
+            self.conn.executemany("DELETE FROM files WHERE path = ?", missing)
+
+    def close(self):
+        self.conn.close()
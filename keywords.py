@@ -0,0 +1,166 @@
+import os
+import re
+import math
+import heapq
+import hashlib
+import sqlite3
+from collections import Counter
+
+# Default location of the document frequencies the TF-IDF keyword extractor learns
+DEFAULT_FREQUENCIES_PATH = os.path.join(os.path.expanduser("~"), ".tagify", "frequencies.sqlite3")
+
+# Name of the TF-IDF extractor in the cache, alongside the KeyBERT model name
+TFIDF_NAME = "tfidf"
+
+# Words of at least two letters, in any alphabet
+WORD = re.compile(r"[^\W\d_]{2,}")
+
+# Common English words that never make useful tags (the same kind of list KeyBERT's stop_words="english" uses)
+STOP_WORDS = frozenset("""
+a about above across after afterwards again against all almost alone along already also although always am among
+amongst amount an and another any anyhow anyone anything anyway anywhere are around as at back be became because
+become becomes becoming been before beforehand behind being below beside besides between beyond both bottom but by
+call can cannot could did do does doing done down due during each either else elsewhere enough etc even ever every
+everyone everything everywhere except few first for former formerly from front full further get give go had has
+have having he hence her here hereafter hereby herein hereupon hers herself him himself his how however i ie if in
+indeed into is it its itself just keep last latter latterly least less made many may me meanwhile might mine more
+moreover most mostly move much must my myself namely neither never nevertheless next no nobody none noone nor not
+nothing now nowhere of off often on once one only onto or other others otherwise our ours ourselves out over own
+part per perhaps please put rather re said same see seem seemed seeming seems several she should show side since so
+some somehow someone something sometime sometimes somewhere still such take than that the their theirs them
+themselves then thence there thereafter thereby therefore therein thereupon these they this those though through
+throughout thru thus to together too top toward towards under until up upon us use used using very via was we well
+were what whatever when whence whenever where whereafter whereas whereby wherein whereupon wherever whether which
+while whither who whoever whole whom whose why will with within without would yet you your yours yourself
+yourselves
+""".split())
+
+def words(text):
+    """Return the lowercase words of a text that can become tags."""
+    return [word for word in WORD.findall(text.lower()) if word not in STOP_WORDS]
+
+class DocumentFrequencies:
+    """Number of documents each word appeared in, over every document seen so far, kept in SQLite.
+
+    Counts are read from the database as words are first looked up, and new documents are
+    added in memory until save() adds them to the database, so several processes can share it.
+    Documents are told apart by the hash of their text, so a document tagged again, by this
+    run or a later one, is only ever counted once.
+    """
+
+    # Key of the row holding the number of documents
+    DOCUMENTS = ""
+
+    def __init__(self, path=DEFAULT_FREQUENCIES_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS frequencies (word TEXT PRIMARY KEY, documents INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents (hash TEXT PRIMARY KEY)")
+        self.conn.commit()
+        self.counts = {}
+        # Words of the documents counted since the last save, by document hash
+        self.pending = {}
+
+    def load(self, document_words, chunk_size=900):
+        """Read the counts of the words not looked up yet."""
+        missing = [word for word in set(document_words) if word not in self.counts]
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            for word in chunk:
+                self.counts[word] = 0
+            placeholders = ", ".join("?" * len(chunk))
+            for word, documents in self.conn.execute(f"SELECT word, documents FROM frequencies WHERE word IN ({placeholders})", chunk):
+                self.counts[word] = documents
+
+    def counted(self, document_hash):
+        """Return whether the document with this hash was counted already."""
+        return (document_hash in self.pending or
+                self.conn.execute("SELECT 1 FROM documents WHERE hash = ?", (document_hash,)).fetchone() is not None)
+
+    def add(self, document_words, document_hash):
+        """Count a document in which document_words (a set) appear, unless it was counted already."""
+        if self.counted(document_hash):
+            return
+        document_words = list(document_words) + [self.DOCUMENTS]
+        self.load(document_words)
+        for word in document_words:
+            self.counts[word] += 1
+        self.pending[document_hash] = document_words
+
+    def documents(self, word=DOCUMENTS):
+        """Return the number of documents a word appeared in, or the number of documents."""
+        self.load([word])
+        return self.counts[word]
+
+    def save(self):
+        """Add the documents counted since the last save to the database.
+
+        The counts read so far are then forgotten, so that they are read again, with the
+        documents other processes added, when next looked up.
+        """
+        if self.pending:
+            added = Counter()
+            with self.conn:
+                for document_hash, document_words in self.pending.items():
+                    # Another process may have counted the same document in the meantime
+                    if self.conn.execute("INSERT OR IGNORE INTO documents (hash) VALUES (?)", (document_hash,)).rowcount:
+                        added.update(document_words)
+                self.conn.executemany(
+                    "INSERT INTO frequencies (word, documents) VALUES (?, ?) "
+                    "ON CONFLICT(word) DO UPDATE SET documents = documents + excluded.documents",
+                    added.items()
+                )
+            self.pending.clear()
+        self.counts.clear()
+
+    def close(self):
+        self.save()
+        self.conn.close()
+
+class TfidfKeywords:
+    """Keyword extractor scoring each word of a document by TF-IDF, with KeyBERT's extract_keywords interface.
+
+    The inverse document frequencies come from every document this extractor has seen, in this
+    run and previous ones, so words common to the whole library rank below words particular to
+    a document. No model is involved, so it is orders of magnitude faster than KeyBERT.
+    """
+
+    def __init__(self, frequencies):
+        self.frequencies = frequencies
+
+    def score(self, counts, top_n):
+        """Return the top_n (word, score) of a document from its word counts."""
+        length = sum(counts.values())
+        self.frequencies.load(counts.keys())
+        documents = self.frequencies.documents()
+        # Smoothed inverse document frequency, as in scikit-learn's TfidfTransformer
+        scores = {
+            word: count / length * (math.log((1 + documents) / (1 + self.frequencies.counts[word])) + 1)
+            for word, count in counts.items()
+        }
+        return [(word, round(score, 4)) for word, score in heapq.nlargest(top_n, scores.items(), key=lambda item: item[1])]
+
+    def extract_keywords(self, docs, top_n=5, **kwargs):
+        """Return the top_n (keyword, score) of each document, as a flat list for a single one."""
+        docs = [docs] if isinstance(docs, str) else list(docs)
+        word_counts = [Counter(words(doc)) for doc in docs]
+        # Count the whole batch first, so its first documents are scored against the others too
+        for doc, counts in zip(docs, word_counts):
+            if counts:
+                self.frequencies.add(counts.keys(), hashlib.blake2b(doc.encode("utf-8", "replace"), digest_size=16).hexdigest())
+        self.frequencies.save()
+        results = [self.score(counts, top_n) if counts else [] for counts in word_counts]
+        return results[0] if len(results) == 1 else results
+
+# TF-IDF extractor of this process, created on first use
+_tfidf_model = None
+
+def get_tfidf_model(path=DEFAULT_FREQUENCIES_PATH):
+    """Open the document frequencies on first use and return the TF-IDF extractor."""
+    global _tfidf_model
+    if _tfidf_model is None:
+        _tfidf_model = TfidfKeywords(DocumentFrequencies(path))
+    return _tfidf_model
@@ -1,11 +1,22 @@
+import os
 import tkinter as tk
 from tkinter import messagebox, filedialog
-import subprocess
 from PIL import Image, ImageDraw, ImageTk
+from worker import Worker
 
 # Global variable to store the path to the folder
 folder_path = ""
 
+# Background process running the scripts, started once so that their models stay loaded
+worker = Worker()
+
+# Label showing the progress of the running script, and the last line it printed
+status_label = None
+last_output = None
+
+# Milliseconds between two checks for messages from the worker
+POLL_INTERVAL = 100
+
 def select_folder():
     global folder_path
     folder_path = filedialog.askdirectory(title="Select Folder Containing Files to Tag")
@@ -15,10 +26,41 @@ def on_button_click(label, script, button):
     global folder_path
     if not folder_path:
         folder_path = select_folder()
-    if folder_path:
-        subprocess.run(["python", script, folder_path])
-    else:
+    if not folder_path:
         messagebox.showwarning("No Folder Selected", "Please select a folder first.")
+    elif worker.busy:
+        messagebox.showwarning("Busy", "Please wait for the current task to finish.")
+    else:
+        # The worker runs the script's main() without blocking the window
+        worker.submit(os.path.splitext(script)[0], [folder_path])
+        status_label.config(text=f"Running {script}...")
+        status_label.after(POLL_INTERVAL, poll_worker)
+
+def poll_worker():
+    """Show the progress of the running script until it is done."""
+    global last_output
+    for kind, payload in worker.messages():
+        if kind == "progress":
+            status_label.config(text=payload["line"])
+        elif kind == "output":
+            last_output = payload
+        elif kind == "done":
+            if payload.get("error"):
+                status_label.config(text=payload["error"])
+            elif payload["status"] != 0:
+                status_label.config(text=f"Failed: {last_output}" if last_output else "Failed")
+            else:
+                summary = payload["summary"]
+                status_label.config(text=f"Done: {summary['files']} files in {summary['wall_time']:.1f}s, {summary['errors']} errors")
+            last_output = None
+            return
+    status_label.after(POLL_INTERVAL, poll_worker)
+
+def quit_app(root):
+    if worker.busy and not messagebox.askyesno("Busy", "A task is still running. Stop it and quit?"):
+        return
+    worker.close()
+    root.quit()
 
 def on_enter(event):
     event.widget.config(image=event.widget.hover_image, fg="lightgrey")
@@ -104,18 +146,25 @@ def create_rounded_button(canvas, text, script, y_position, command=None):
     return button
 
 def main():
+    global status_label
     root = tk.Tk()
     root.title("Tag Manager")
-    root.geometry("600x450")  # Adjusted height to fit the new button
+    root.geometry("600x490")  # Adjusted height to fit the status line
 
-    canvas = tk.Canvas(root, width=600, height=450, bg="white", highlightthickness=0)
+    canvas = tk.Canvas(root, width=600, height=490, bg="white", highlightthickness=0)
     canvas.pack()
 
+    # Start the worker now, so that it has loaded by the first click
+    worker.start()
+
     # Create buttons
     button1 = create_rounded_button(canvas, "Select a folder to autotag", "tag.py", 10)
     button2 = create_rounded_button(canvas, "Sync Finder tags to Metadata", "sync.py", 120)
     button3 = create_rounded_button(canvas, "Open tags in a graph view", "graph.py", 230)
-    button4 = create_rounded_button(canvas, "Close and Quit", None, 340, command=root.quit)
+    button4 = create_rounded_button(canvas, "Close and Quit", None, 340, command=lambda: quit_app(root))
+    status_label = tk.Label(canvas, text="", font=("Helvetica", 14), fg="darkgrey", bg="white", anchor="w")
+    status_label.place(x=10, y=450, width=580, height=30)
+    root.protocol("WM_DELETE_WINDOW", lambda: quit_app(root))
 
     root.mainloop()
 
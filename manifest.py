@@ -0,0 +1,115 @@
+import os
+import json
+from metrics import log, error, NORMAL
+
+# Name of the manifest file written at the root of every scanned folder
+MANIFEST_NAME = ".tagify_manifest.json"
+
+# File extensions handled by tag.py, sync.py and graph.py
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".mp4", ".mkv", ".webm")
+
+# Number of updates after which the manifest is written to disk during a run
+SAVE_EVERY = 500
+
+# Marker in the names of the temporary files PDFs and videos are rewritten to before replacing them
+TEMP_MARKER = ".tagify-tmp"
+
+def is_supported(file_name):
+    """Return True for the non-hidden files whose extension is supported, other than half-written temporary files."""
+    return not file_name.startswith("._") and TEMP_MARKER not in file_name and file_name.endswith(SUPPORTED_EXTENSIONS)
+
+def scan_folder(folder_path):
+    """Yield (file_path, stat) for every supported file in a folder and its sub-folders."""
+    stack = [folder_path]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError as e:
+            error(f"Failed to list {current}: {e}", current, "scan")
+            continue
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and is_supported(entry.name):
+                    yield entry.path, entry.stat()
+            except OSError as e:
+                error(f"Failed to stat {entry.path}: {e}", entry.path, "scan")
+
+def file_signature(stat):
+    """Return the stat fields that change whenever a file's content or tags change."""
+    # Finder tags are stored in an extended attribute, which updates ctime but not mtime
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino]
+
+class Manifest:
+    """Record of the size, mtime, ctime, inode and last-known tags of every file under a folder.
+
+    The manifest is stored as MANIFEST_NAME at the root of the folder, with one section per
+    script (tag, sync, graph) so that a file handled by one of them still counts as changed for
+    the others. Paths are stored relative to the root so a moved library keeps its manifest.
+    """
+
+    def __init__(self, folder_path, section, force=False):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, MANIFEST_NAME)
+        self.section = section
+        self.force = force
+        self.data = {"version": 1, "sections": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == 1:
+                    self.data = data
+            except (OSError, ValueError) as e:
+                log(f"Ignoring unreadable manifest {self.path}: {e}", NORMAL)
+        self.entries = self.data["sections"].setdefault(section, {})
+        self.seen = set()
+        self.pending_updates = 0
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self.folder_path)
+
+    def changed(self, file_path, stat):
+        """Return True if a file was added or modified since it was last recorded."""
+        if self.force:
+            return True
+        entry = self.entries.get(self._key(file_path))
+        return entry is None or entry["signature"] != file_signature(stat)
+
+    def tags(self, file_path):
+        """Return the last-known tags of a file, or None if it was never recorded."""
+        entry = self.entries.get(self._key(file_path))
+        return entry["tags"] if entry is not None else None
+
+    def scan(self):
+        """Yield (file_path, stat, changed) for every supported file under the folder."""
+        for file_path, stat in scan_folder(self.folder_path):
+            self.seen.add(self._key(file_path))
+            yield file_path, stat, self.changed(file_path, stat)
+
+    def update(self, file_path, tags, stat=None):
+        """Record the current state and tags of a file once it has been handled."""
+        if stat is None:
+            stat = os.stat(file_path)
+        self.entries[self._key(file_path)] = {"signature": file_signature(stat), "tags": list(tags)}
+        self.pending_updates += 1
+        if self.pending_updates >= SAVE_EVERY:
+            self.save()
+
+    def prune(self):
+        """Forget the files that were not seen during the last scan."""
+        for key in [key for key in self.entries if key not in self.seen]:
+            del self.entries[key]
+
+    def save(self):
+        """Write the manifest atomically to the root of the folder."""
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self.data, f)
+            os.replace(temp_path, self.path)
+            self.pending_updates = 0
+        except OSError as e:
+            error(f"Failed to save manifest {self.path}: {e}")
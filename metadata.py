@@ -0,0 +1,49 @@
+import json
+from asyncrun import run_blocking, run_serially, map_concurrently, DEFAULT_CONCURRENCY
+from probe import probe_video, probe_video_async
+
+def parse_video_tags(record):
+    """Return the tags held in the comment of a video's probe record."""
+    comment = (record["comment"] or "").strip()
+    return comment.split(", ") if comment else []
+
+def read_metadata_tags(file_path):
+    """Read the tags previously written to a file's own metadata."""
+    tags = []
+    if file_path.endswith(".pdf"):
+        # Read tags from the PDF metadata
+        import pymupdf
+        doc = pymupdf.open(file_path)
+        metadata = doc.metadata
+        tags_str = metadata.get("keywords", "")
+        tags = tags_str.split(", ") if tags_str else []
+        doc.close()
+    elif file_path.endswith(".txt"):
+        # Read tags from the metadata file
+        metadata_path = file_path.replace(".txt", "_metadata.json")
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+            tags = metadata.get("tags", [])
+    elif file_path.endswith((".mp4", ".mkv", ".webm")):
+        # Read tags from the comment in the video metadata
+        tags = parse_video_tags(probe_video(file_path))
+    return tags
+
+async def read_metadata_tags_async(file_path, limiter=None):
+    """Read the tags of a file's own metadata without blocking the event loop.
+
+    Only the ffprobe calls of videos run concurrently: pymupdf is not thread-safe, so PDFs are
+    read one at a time on a single thread.
+    """
+    if file_path.endswith((".mp4", ".mkv", ".webm")):
+        return parse_video_tags(await probe_video_async(file_path, limiter))
+    if file_path.endswith(".pdf"):
+        return await run_serially(read_metadata_tags, file_path)
+    return await run_blocking(read_metadata_tags, file_path, limiter=limiter)
+
+def read_metadata_tags_many(paths, concurrency=DEFAULT_CONCURRENCY):
+    """Read the metadata tags of many files, at most concurrency at once.
+
+    Returns {file_path: tags}, where tags is the exception raised for the files that could not be read.
+    """
+    return map_concurrently(read_metadata_tags_async, paths, concurrency)
@@ -0,0 +1,238 @@
+import sys
+import math
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Verbosity levels: errors and the final summary, plus the progress line, plus a message per file
+QUIET = 0
+NORMAL = 1
+VERBOSE = 2
+
+# Minimum number of seconds between two progress line updates (on a terminal, and otherwise)
+PROGRESS_INTERVAL = 0.5
+PROGRESS_INTERVAL_NO_TTY = 30.0
+
+# Number of files listed as the slowest ones in the summary
+SLOWEST_FILES = 10
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the sorted values fall (nearest rank)."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+class Metrics:
+    """Per-stage durations, counters and errors of a run, with a progress line and a final summary.
+
+    Every stage duration and error can also be written as one JSON object per line to a trace
+    file. A Metrics created with keep_events=True (as in worker processes) keeps its events so
+    that the parent process can replay them into its own Metrics. When progress_callback is
+    set, it receives the progress as a dictionary instead of the progress line being printed.
+    """
+
+    def __init__(self, verbosity=NORMAL, trace_path=None, keep_events=False):
+        self.lock = threading.Lock()
+        self.keep_events = keep_events
+        self.progress_callback = None
+        self.trace = None
+        self.configure(verbosity, trace_path)
+        self.reset()
+
+    def configure(self, verbosity=NORMAL, trace_path=None):
+        self.verbosity = verbosity
+        if self.trace is not None:
+            self.trace.close()
+        self.trace = open(trace_path, "a") if trace_path else None
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.durations = {}
+        self.file_times = Counter()
+        self.file_stages = {}
+        self.counters = Counter()
+        self.errors = []
+        self.events = []
+        self.total = None
+        self.done = 0
+        self.last_progress = 0.0
+        self.progress_shown = False
+
+    def _emit(self, event):
+        if self.keep_events:
+            self.events.append(event)
+        if self.trace is not None:
+            self.trace.write(json.dumps({"time": time.time(), **event}) + "\n")
+
+    def record(self, stage, seconds, file_path=None, files=1):
+        """Record that a stage took seconds for a file, or for a batch of files when file_path is None."""
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            if file_path is not None:
+                self.file_times[file_path] += seconds
+                self.file_stages.setdefault(file_path, Counter())[stage] += seconds
+            self._emit({"event": "stage", "stage": stage, "seconds": round(seconds, 6), "file": file_path, "files": files})
+
+    @contextmanager
+    def stage(self, stage, file_path=None, files=1):
+        """Time the body of a with statement as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, file_path, files)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+            if self.keep_events:
+                self.events.append({"event": "count", "name": name, "n": n})
+
+    def error(self, message, file_path=None, stage=None, show=True):
+        """Record an error and show it."""
+        with self.lock:
+            self.errors.append({"message": message, "file": file_path, "stage": stage})
+            self._emit({"event": "error", "message": message, "file": file_path, "stage": stage})
+        if show:
+            self._print(message, sys.stderr)
+
+    def log(self, message, level=VERBOSE):
+        """Print a message if the verbosity is at least level."""
+        if self.verbosity >= level:
+            self._print(message, sys.stdout)
+
+    def _print(self, message, stream):
+        # Clear the progress line so that the message does not get mixed into it
+        if self.progress_shown and sys.stderr.isatty():
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            self.progress_shown = False
+        print(message, file=stream)
+
+    def replay(self, events):
+        """Add the events kept by another Metrics, whose errors were already shown."""
+        for event in events:
+            if event["event"] == "stage":
+                self.record(event["stage"], event["seconds"], event["file"], event["files"])
+            elif event["event"] == "error":
+                self.error(event["message"], event["file"], event["stage"], show=False)
+            elif event["event"] == "count":
+                self.count(event["name"], event["n"])
+
+    def set_total(self, total):
+        self.total = total
+
+    def file_done(self, n=1):
+        """Count files as handled and refresh the progress line."""
+        with self.lock:
+            self.done += n
+        self.progress()
+
+    def progress(self, force=False):
+        if self.verbosity < NORMAL:
+            return
+        now = time.perf_counter()
+        tty = sys.stderr.isatty()
+        interactive = tty or self.progress_callback is not None
+        if not force and now - self.last_progress < (PROGRESS_INTERVAL if interactive else PROGRESS_INTERVAL_NO_TTY):
+            return
+        self.last_progress = now
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = None
+        line = f"{self.done}" + (f"/{self.total}" if self.total else "") + f" files, {rate:.1f} files/s"
+        if self.total and rate > 0:
+            remaining = max(0, self.total - self.done) / rate
+            line += f", ETA {int(remaining // 3600):d}:{int(remaining % 3600 // 60):02d}:{int(remaining % 60):02d}"
+        if self.errors:
+            line += f", {len(self.errors)} errors"
+        if self.progress_callback is not None:
+            self.progress_callback({"done": self.done, "total": self.total, "files_per_sec": rate,
+                                    "eta": remaining, "errors": len(self.errors), "line": line})
+            return
+        if tty:
+            sys.stderr.write("\r\033[K" + line)
+            self.progress_shown = True
+        else:
+            sys.stderr.write(line + "\n")
+        sys.stderr.flush()
+
+    def summary(self, slowest=SLOWEST_FILES):
+        """Return the run's totals, per-stage statistics, slowest files, counters and errors."""
+        with self.lock:
+            wall_time = time.perf_counter() - self.start_time
+            stages = {}
+            for stage, durations in self.durations.items():
+                durations = sorted(durations)
+                stages[stage] = {
+                    "count": len(durations),
+                    "total": sum(durations),
+                    "p50": percentile(durations, 0.5),
+                    "p95": percentile(durations, 0.95),
+                    "max": durations[-1],
+                }
+            slowest_files = [
+                {"file": file_path, "seconds": seconds, "stages": dict(self.file_stages[file_path])}
+                for file_path, seconds in self.file_times.most_common(slowest)
+            ]
+            return {
+                "files": self.done,
+                "wall_time": wall_time,
+                "files_per_sec": self.done / wall_time if wall_time > 0 else 0.0,
+                "stages": stages,
+                "slowest_files": slowest_files,
+                "counters": dict(self.counters),
+                "errors": len(self.errors),
+            }
+
+    def print_summary(self, note=None):
+        """Print the summary, and write it to the trace as the last line."""
+        summary = self.summary()
+        if self.trace is not None:
+            self.trace.write(json.dumps({"time": time.time(), "event": "summary", **summary}) + "\n")
+            self.trace.flush()
+        if self.verbosity >= NORMAL:
+            self.progress(force=True)
+            if self.progress_shown:
+                sys.stderr.write("\n")
+                self.progress_shown = False
+        print(f"{summary['files']} files in {summary['wall_time']:.1f}s ({summary['files_per_sec']:.1f} files/s), {summary['errors']} errors")
+        if summary["stages"]:
+            print(f"  {'stage':<16}{'count':>8}{'total':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+            for stage, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+                print(f"  {stage:<16}{stats['count']:>8}{stats['total']:>9.2f}s{stats['p50']:>9.3f}s{stats['p95']:>9.3f}s{stats['max']:>9.3f}s")
+        if note:
+            print(f"  ({note})")
+        if summary["slowest_files"]:
+            print("Slowest files:")
+            for slow in summary["slowest_files"]:
+                stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in sorted(slow["stages"].items(), key=lambda item: -item[1]))
+                print(f"  {slow['seconds']:8.2f}s  {slow['file']} ({stages})")
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+# Metrics of the current process, shared by every module
+metrics = Metrics()
+
+def log(message, level=VERBOSE):
+    metrics.log(message, level)
+
+def error(message, file_path=None, stage=None):
+    metrics.error(message, file_path, stage)
+
+def add_arguments(parser):
+    """Add the verbosity and trace options to a command line parser."""
+    parser.add_argument("-v", "--verbose", action="store_true", help="print a message for every file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="print only errors and the final summary")
+    parser.add_argument("--trace", help="append per-file stage timings and errors to this JSON-lines file")
+
+def configure_from_args(args):
+    """Configure the shared metrics from the options added by add_arguments."""
+    verbosity = VERBOSE if args.verbose else QUIET if args.quiet else NORMAL
+    metrics.configure(verbosity, args.trace)
+    metrics.reset()
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import onnxruntime
+from tokenizers import Tokenizer
+from keybert.backend import BaseEmbedder
+
+# Model files looked for in the folder, the quantized one first
+ONNX_MODEL_FILES = ("model_quantized.onnx", "model_int8.onnx", "model.onnx")
+
+# Maximum number of tokens read from each text when the export does not say (as for all-MiniLM-L6-v2)
+DEFAULT_MAX_TOKENS = 256
+
+# Number of texts run through the model at once
+DEFAULT_ONNX_BATCH_SIZE = 32
+
+# Cosine similarity to the PyTorch embeddings below which the parity check fails
+DEFAULT_MIN_SIMILARITY = 0.98
+
+# Texts the parity check embeds when no files are given
+SAMPLE_TEXTS = [
+    "Quarterly financial report with revenue, operating costs and forecasts for the next fiscal year.",
+    "Lecture on the thermodynamics of black holes and Hawking radiation.",
+    "Recipe for sourdough bread: flour, water, salt and a mature starter, baked in a Dutch oven.",
+    "The committee approved the new zoning regulations for the harbor district after a public hearing.",
+    "Tutorial on training convolutional neural networks for image classification with data augmentation.",
+    "Travel diary of a cycling trip along the Danube from Passau to Vienna.",
+    "Maintenance manual for the hydraulic landing gear of a regional turboprop aircraft.",
+    "Interview with a jazz pianist about improvisation, harmony and early recordings.",
+    "machine learning",
+    "invoice",
+]
+
+def find_model_file(path):
+    """Return the ONNX file of a model folder, or path itself if it is an ONNX file."""
+    if os.path.isfile(path):
+        return path
+    for name in ONNX_MODEL_FILES:
+        if os.path.isfile(os.path.join(path, name)):
+            return os.path.join(path, name)
+    candidates = sorted(name for name in os.listdir(path) if name.endswith(".onnx"))
+    if len(candidates) != 1:
+        raise FileNotFoundError(f"Expected one of {', '.join(ONNX_MODEL_FILES)} in {path}")
+    return os.path.join(path, candidates[0])
+
+def max_tokens(folder):
+    """Return the maximum sequence length of an exported sentence-transformer."""
+    for name, key in (("sentence_bert_config.json", "max_seq_length"), ("tokenizer_config.json", "model_max_length")):
+        try:
+            with open(os.path.join(folder, name)) as f:
+                value = json.load(f).get(key)
+        except (OSError, ValueError):
+            continue
+        # tokenizer_config.json uses a huge number for "no limit"
+        if isinstance(value, int) and 0 < value <= 8192:
+            return value
+    return DEFAULT_MAX_TOKENS
+
+class OnnxEmbedder(BaseEmbedder):
+    """Sentence-transformer exported to ONNX (typically int8-quantized), run with ONNX Runtime on the CPU.
+
+    It implements KeyBERT's embedder interface, so KeyBERT(model=OnnxEmbedder(path)) uses it in
+    place of the PyTorch model. The folder holds the .onnx file and the tokenizer.json of the
+    export; the token embeddings are mean pooled and normalized as all-MiniLM-L6-v2 does.
+    """
+
+    def __init__(self, path, threads=0, batch_size=DEFAULT_ONNX_BATCH_SIZE):
+        super().__init__()
+        self.path = path
+        self.model_file = find_model_file(path)
+        folder = os.path.dirname(self.model_file)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(self.model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.tokenizer = Tokenizer.from_file(os.path.join(folder, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_tokens(folder))
+        self.tokenizer.no_padding()
+        self.batch_size = batch_size
+
+    def _embed_batch(self, encodings):
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        for i, encoding in enumerate(encodings):
+            input_ids[i, :len(encoding.ids)] = encoding.ids
+            attention_mask[i, :len(encoding.ids)] = 1
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        if "sentence_embedding" in self.output_names:
+            # Exported with the sentence-transformers library, pooling included
+            embeddings = self.session.run(["sentence_embedding"], inputs)[0]
+        else:
+            token_embeddings = self.session.run([self.output_names[0]], inputs)[0]
+            mask = attention_mask[:, :, None].astype(np.float32)
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (embeddings / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def embed(self, documents, verbose=False):
+        """Return the embeddings of documents, one row per document."""
+        documents = list(documents)
+        if not documents:
+            return np.empty((0, 0), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(documents)
+        # Batch texts of similar lengths together, so that little of each batch is padding
+        order = sorted(range(len(documents)), key=lambda i: len(encodings[i].ids))
+        embeddings = [None] * len(documents)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            for i, embedding in zip(indices, self._embed_batch([encodings[i] for i in indices])):
+                embeddings[i] = embedding
+        return np.vstack(embeddings)
+
+def embedding_similarities(embeddings, reference):
+    """Return the cosine similarity of each embedding to the matching reference embedding."""
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    return (embeddings * reference).sum(axis=1)
+
+def check_parity(path, texts, top_n=5):
+    """Compare the ONNX model with the PyTorch one on texts and return the results.
+
+    Returns the cosine similarity of each text's two embeddings, and the fraction of the top_n
+    tags KeyBERT generates from the PyTorch embeddings that it also generates from the ONNX ones.
+    """
+    import tag
+    from keybert import KeyBERT
+
+    reference_model = KeyBERT(model=tag.KEYBERT_MODEL)
+    onnx_model = KeyBERT(model=OnnxEmbedder(path))
+    reference = reference_model.model.embed(texts)
+    embeddings = onnx_model.model.embed(texts)
+    reference_tags = tag.generate_tags_batch(texts, reference_model, top_n, doc_embeddings=reference)
+    onnx_tags = tag.generate_tags_batch(texts, onnx_model, top_n, doc_embeddings=embeddings)
+    overlaps = [len(set(a) & set(b)) / len(a) for a, b in zip(reference_tags, onnx_tags) if a]
+    return {
+        "similarities": embedding_similarities(embeddings, reference),
+        "tag_overlap": float(np.mean(overlaps)) if overlaps else 1.0,
+    }
+
+def main(argv=None):
+    """Check that an exported ONNX model embeds like the PyTorch one and return the exit status."""
+    import tag
+
+    parser = argparse.ArgumentParser(description="Compare the embeddings and tags of an ONNX export with the PyTorch model.")
+    parser.add_argument("model_path", nargs="?", default=tag.DEFAULT_ONNX_MODEL_DIR,
+                        help=f"folder of the ONNX model and its tokenizer.json (default: {tag.DEFAULT_ONNX_MODEL_DIR})")
+    parser.add_argument("files", nargs="*", help="files whose texts are compared (default: a few built-in sentences)")
+    parser.add_argument("--min-similarity", type=float, default=DEFAULT_MIN_SIMILARITY,
+                        help="lowest acceptable cosine similarity between the two embeddings of a text (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    texts = SAMPLE_TEXTS
+    if args.files:
+        texts = [text for text in (tag.extract_text(file_path) for file_path in args.files) if text]
+    results = check_parity(args.model_path, texts)
+    similarities = results["similarities"]
+    print(f"{len(texts)} texts: cosine similarity min {similarities.min():.4f}, mean {similarities.mean():.4f}; "
+          f"{results['tag_overlap']:.0%} of the tags are the same")
+    if similarities.min() < args.min_similarity:
+        print(f"The embeddings of {args.model_path} differ from the PyTorch model's beyond --min-similarity {args.min_similarity}.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
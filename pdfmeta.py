@@ -0,0 +1,62 @@
+import os
+import re
+import sys
+from xml.sax.saxutils import escape
+from metrics import log
+from manifest import TEMP_MARKER
+
+# Keywords element of the XMP packet, which some viewers read instead of the Info dictionary
+XMP_KEYWORDS = re.compile(r"(<pdf:Keywords>)(.*?)(</pdf:Keywords>)", re.DOTALL)
+
+def pdf_errors():
+    """Return the exception types pymupdf raises for damaged PDFs, for use in an except clause.
+
+    pymupdf is only imported once a PDF is opened, so until then no such error can be raised.
+    """
+    pymupdf = sys.modules.get("pymupdf")
+    return (pymupdf.FileDataError,) if pymupdf is not None else ()
+
+def add_tags_to_pdf_metadata(pdf_path, tags):
+    """Add generated tags to the metadata of the PDF.
+
+    The updated Info dictionary (and XMP keywords, if any) is appended to the file with an
+    incremental save, so the rest of the document is not rewritten. PDFs that cannot be saved
+    incrementally are saved in full to a temporary file which then replaces the original.
+    Returns False when the keywords were already up to date and nothing was written.
+    """
+    import pymupdf
+
+    keywords = ", ".join(tags)
+    doc = pymupdf.open(pdf_path)
+    try:
+        metadata = doc.metadata
+        xml_metadata = doc.get_xml_metadata()
+        xml_keywords = XMP_KEYWORDS.search(xml_metadata)
+        if metadata.get("keywords", "") == keywords and (xml_keywords is None or xml_keywords.group(2) == escape(keywords)):
+            log(f"PDF metadata already up to date: {pdf_path}")
+            return False
+
+        # Add or update the Keywords field with the generated tags
+        metadata["keywords"] = keywords
+        doc.set_metadata(metadata)
+        if xml_keywords is not None:
+            doc.set_xml_metadata(XMP_KEYWORDS.sub(lambda match: match.group(1) + escape(keywords) + match.group(3), xml_metadata, count=1))
+
+        if doc.can_save_incrementally():
+            doc.save(pdf_path, incremental=True, encryption=pymupdf.PDF_ENCRYPT_KEEP)
+            return True
+
+        # Save the updated PDF next to the original and swap it in atomically
+        root, file_name = os.path.split(pdf_path)
+        temp_path = os.path.join(root, f".{file_name}{TEMP_MARKER}")
+        try:
+            doc.save(temp_path, garbage=1)
+            doc.close()
+            os.replace(temp_path, pdf_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+    finally:
+        if not doc.is_closed:
+            doc.close()
@@ -0,0 +1,135 @@
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+
+# Default folder of the phrase embedding stores, one per sentence-transformer
+DEFAULT_PHRASE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".tagify", "phrases")
+
+# Number of phrase embeddings kept in memory
+DEFAULT_MEMORY_ENTRIES = 20000
+
+class PhraseEmbeddingCache:
+    """Embeddings of candidate keyphrases, shared across documents, runs and processes.
+
+    The embeddings are rows of a float32 file read through a memory map, a SQLite index gives
+    the row of each phrase, and the most recently used embeddings are also kept in memory.
+    Rows are only ever appended, under the index's write lock, so several processes can add
+    phrases at once. There is one store per model, as their embeddings are not comparable.
+    """
+
+    def __init__(self, model_name, folder=DEFAULT_PHRASE_CACHE_DIR, memory_entries=DEFAULT_MEMORY_ENTRIES):
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, re.sub(r"[^\w.-]", "_", model_name))
+        self.data_path = base + ".f32"
+        self.conn = sqlite3.connect(base + ".sqlite3", timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS phrases (phrase TEXT PRIMARY KEY, row INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.mapped = None
+        self.dimension = self._meta("dimension")
+        open(self.data_path, "ab").close()
+        # Number of phrases found in the store, and embedded, by this process
+        self.hits = 0
+        self.misses = 0
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _remember(self, phrase, embedding):
+        self.memory[phrase] = embedding
+        self.memory.move_to_end(phrase)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _read_rows(self, rows):
+        """Read rows of the data file, mapping it again if it grew since it was mapped."""
+        needed = max(rows) + 1
+        if self.mapped is None or self.mapped.shape[0] < needed:
+            count = os.path.getsize(self.data_path) // (4 * self.dimension)
+            self.mapped = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(count, self.dimension))
+        return np.array(self.mapped[rows])
+
+    def lookup(self, phrases, chunk_size=900):
+        """Return {phrase: embedding} for the phrases already stored."""
+        found = {}
+        missing = []
+        for phrase in phrases:
+            embedding = self.memory.get(phrase)
+            if embedding is not None:
+                self.memory.move_to_end(phrase)
+                found[phrase] = embedding
+            else:
+                missing.append(phrase)
+        if missing and self.dimension is None:
+            # Another process may have stored the first embeddings since this store was opened
+            self.dimension = self._meta("dimension")
+        if not missing or self.dimension is None:
+            return found
+        rows = {}
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            rows.update(self.conn.execute(f"SELECT phrase, row FROM phrases WHERE phrase IN ({placeholders})", chunk))
+        if rows:
+            phrases_read = list(rows)
+            for phrase, embedding in zip(phrases_read, self._read_rows([rows[phrase] for phrase in phrases_read])):
+                self._remember(phrase, embedding)
+                found[phrase] = embedding
+        return found
+
+    def add(self, embeddings):
+        """Store {phrase: embedding} for phrases that are not stored yet."""
+        if not embeddings:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            dimension = self._meta("dimension")
+            if dimension is None:
+                dimension = len(next(iter(embeddings.values())))
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('dimension', ?)", (dimension,))
+            self.dimension = dimension
+            # Another process may have stored some of them in the meantime
+            stored = set()
+            phrases = list(embeddings)
+            for start in range(0, len(phrases), 900):
+                chunk = phrases[start:start + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                stored.update(phrase for (phrase,) in self.conn.execute(f"SELECT phrase FROM phrases WHERE phrase IN ({placeholders})", chunk))
+            new_phrases = [phrase for phrase in phrases if phrase not in stored]
+            if new_phrases:
+                first_row = os.path.getsize(self.data_path) // (4 * dimension)
+                data = np.vstack([np.asarray(embeddings[phrase], dtype=np.float32) for phrase in new_phrases])
+                # Write the rows before committing the index, so a phrase is never indexed without its embedding
+                with open(self.data_path, "r+b") as f:
+                    f.seek(first_row * 4 * dimension)
+                    f.write(data.tobytes())
+                self.conn.executemany("INSERT INTO phrases (phrase, row) VALUES (?, ?)",
+                                      [(phrase, first_row + i) for i, phrase in enumerate(new_phrases)])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        for phrase, embedding in embeddings.items():
+            self._remember(phrase, np.asarray(embedding, dtype=np.float32))
+
+    def embed(self, phrases, embedder):
+        """Return the embeddings of phrases, in order, only asking embedder.embed for the unseen ones."""
+        found = self.lookup(phrases)
+        missing = [phrase for phrase in phrases if phrase not in found]
+        if missing:
+            computed = {phrase: embedding for phrase, embedding in zip(missing, embedder.embed(missing))}
+            self.add(computed)
+            found.update(computed)
+        self.hits += len(phrases) - len(missing)
+        self.misses += len(missing)
+        return np.vstack([found[phrase] for phrase in phrases]) if phrases else np.empty((0, self.dimension or 0), dtype=np.float32)
+
+    def close(self):
+        self.conn.close()
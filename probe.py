@@ -0,0 +1,94 @@
+import os
+import json
+import threading
+import subprocess
+from collections import OrderedDict
+from asyncrun import run_command
+
+# Number of probe records kept in memory
+PROBE_CACHE_SIZE = 4096
+
+class ProbeError(Exception):
+    """Raised when ffprobe cannot read a video."""
+
+def probe_command(video_path):
+    """Return the ffprobe command printing a video's format, streams and chapters as JSON."""
+    return ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", "-show_chapters", video_path]
+
+def parse_probe(output):
+    """Turn ffprobe's JSON output into a probe record.
+
+    The record holds the codec of the first audio stream, the duration in seconds, the chapter
+    titles, the format-level tags (with lowercase keys) and the comment tag tagify writes.
+    """
+    data = json.loads(output or "{}")
+    audio_streams = [stream for stream in data.get("streams", []) if stream.get("codec_type") == "audio"]
+    format_tags = {key.lower(): value for key, value in data.get("format", {}).get("tags", {}).items()}
+    try:
+        duration = float(data.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    chapters = []
+    for chapter in data.get("chapters", []):
+        title = {key.lower(): value for key, value in chapter.get("tags", {}).items()}.get("title")
+        if title:
+            chapters.append(title)
+    return {
+        "audio_codec": audio_streams[0].get("codec_name") if audio_streams else None,
+        "duration": duration,
+        "chapters": chapters,
+        "tags": format_tags,
+        "comment": format_tags.get("comment"),
+    }
+
+class ProbeCache:
+    """Thread-safe in-memory LRU of probe records keyed by path and checked against size and mtime."""
+
+    def __init__(self, max_entries=PROBE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, video_path, stat):
+        with self.lock:
+            entry = self.entries.get(video_path)
+            if entry is None or entry[0] != (stat.st_size, stat.st_mtime_ns):
+                return None
+            self.entries.move_to_end(video_path)
+            return entry[1]
+
+    def put(self, video_path, stat, record):
+        with self.lock:
+            self.entries[video_path] = ((stat.st_size, stat.st_mtime_ns), record)
+            self.entries.move_to_end(video_path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# Probe records shared by every stage of this process
+probe_cache = ProbeCache()
+
+def probe_video(video_path, cache=probe_cache):
+    """Return the probe record of a video, running ffprobe only if the file changed since it was last probed."""
+    stat = os.stat(video_path)
+    record = cache.get(video_path, stat) if cache is not None else None
+    if record is None:
+        result = subprocess.run(probe_command(video_path), stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise ProbeError(f"ffprobe failed on {video_path}: {result.stderr.strip()}")
+        record = parse_probe(result.stdout)
+        if cache is not None:
+            cache.put(video_path, stat, record)
+    return record
+
+async def probe_video_async(video_path, limiter=None, cache=probe_cache):
+    """Return the probe record of a video without blocking the event loop."""
+    stat = os.stat(video_path)
+    record = cache.get(video_path, stat) if cache is not None else None
+    if record is None:
+        result = await run_command(probe_command(video_path), limiter)
+        if result.returncode != 0:
+            raise ProbeError(f"ffprobe failed on {video_path}: {result.stderr.strip()}")
+        record = parse_probe(result.stdout)
+        if cache is not None:
+            cache.put(video_path, stat, record)
+    return record
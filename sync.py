@@ -1,9 +1,14 @@
 import os
 import sys
-import subprocess
+import argparse
 from tkinter import Tk, filedialog, messagebox
-import pymupdf
 import json
+from manifest import Manifest
+from videometa import add_tags_to_video_metadata
+from pdfmeta import add_tags_to_pdf_metadata
+from tagstore import get_finder_tags_bulk, chunked, BULK_SIZE
+from asyncrun import run_blocking, run_serially, map_concurrently, DEFAULT_CONCURRENCY
+from metrics import metrics, log, error, add_arguments, configure_from_args
 
 def select_folder():
     """Prompt the user to select a folder if no folder path is provided."""
@@ -15,43 +20,6 @@ def select_folder():
         return None
     return folder_path
 
-def get_finder_tags(file_path):
-    """Get Finder tags for a file using the tag command line tool."""
-    tag_cmd = ["tag", "--list", file_path]
-    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Failed to get tags for {file_path}: {result.stderr}")
-        return []
-    tags_str = result.stdout.replace(file_path,"").strip()
-    # Split the tags_str based on the first occurrence of multiple spaces
-    tags = [tag.strip() for tag in tags_str.split(",")] if tags_str else []
-    if len(tags) > 0:
-        print(f"Retrieved Finder tags for {file_path}: {', '.join(tags)}")
-    else:
-        print(f"No Finder tags found for {file_path}")
-    return tags
-
-def add_tags_to_pdf_metadata(pdf_path, tags):
-    """Add generated tags to the metadata of the PDF."""
-    doc = pymupdf.open(pdf_path)
-    metadata = doc.metadata
-
-    # Add or update the Keywords field with the generated tags
-    metadata["keywords"] = ", ".join(tags)
-    doc.set_metadata(metadata)
-
-    # Save the updated PDF
-    doc.save(pdf_path)
-    doc.close()
-
-def add_tags_to_video_metadata(video_path, tags):
-    """Add generated tags to the metadata of the video."""
-    tags_str = ", ".join(tags)
-    ffmpeg_cmd = [
-        "ffmpeg", "-loglevel", "quiet", "-y", "-i", video_path, "-metadata", f"comment={tags_str}", "-c", "copy", video_path
-    ]
-    subprocess.run(ffmpeg_cmd)
-
 def add_tags_to_text_file(text_path, tags):
     """Add generated tags to the metadata of the text file."""
     metadata_path = text_path.replace(".txt", "_metadata.json")
@@ -62,34 +30,70 @@ def add_tags_to_text_file(text_path, tags):
     metadata["tags"] = tags
     with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=4)
-    print(f"Updated metadata saved at: {metadata_path}")
+    log(f"Updated metadata saved at: {metadata_path}")
 
-def sync_tags(folder_path):
-    """Recursively visit every file and sub-folder in the folder_path and sync Finder tags to metadata."""
-    for root, dirs, files in os.walk(folder_path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            
-            # Check if it's actually a file
-            if not os.path.isfile(file_path):
-                continue
-            
-            # Skip hidden files and non-supported files
-            if file_name.startswith("._") or not file_name.endswith((".pdf", ".txt", ".mp4", ".mkv", ".webm")):
+def write_metadata_tags(file_path, tags):
+    """Write Finder tags to the metadata of a PDF, a video or a text file that has a metadata file."""
+    with metrics.stage("write", file_path):
+        if file_path.endswith(".pdf"):
+            add_tags_to_pdf_metadata(file_path, tags)
+        elif file_path.endswith((".mp4", ".mkv", ".webm")):
+            add_tags_to_video_metadata(file_path, tags)
+        elif file_path.endswith(".txt") and os.path.exists(file_path.replace(".txt", "_metadata.json")):
+            add_tags_to_text_file(file_path, tags)
+
+def write_metadata_tags_async(files_tags):
+    """Return a coroutine function writing the tags of files_tags ({file_path: tags}) to a file's metadata.
+
+    pymupdf is not thread-safe, so PDFs are written one at a time on a single thread, while
+    videos and text files are written concurrently.
+    """
+    async def write(file_path, limiter):
+        if file_path.endswith(".pdf"):
+            return await run_serially(write_metadata_tags, file_path, files_tags[file_path])
+        return await run_blocking(write_metadata_tags, file_path, files_tags[file_path], limiter=limiter)
+    return write
+
+def sync_tags(folder_path, full_scan=False, concurrency=DEFAULT_CONCURRENCY):
+    """Recursively visit every file and sub-folder in the folder_path and sync Finder tags to metadata.
+
+    Files that have not changed since the previous sync, according to the folder's manifest,
+    are skipped unless full_scan is set. The metadata of up to concurrency files is written at once.
+    """
+    manifest = Manifest(folder_path, "sync", force=full_scan)
+    with metrics.stage("scan"):
+        changed_paths = [file_path for file_path, stat, changed in manifest.scan() if changed]
+    metrics.set_total(len(changed_paths))
+    for chunk in chunked(changed_paths, BULK_SIZE):
+        with metrics.stage("finder tags", files=len(chunk)):
+            finder_tags = get_finder_tags_bulk(chunk, concurrency)
+        tagged_paths = [file_path for file_path in chunk if len(finder_tags[file_path]) > 0]
+        results = map_concurrently(write_metadata_tags_async(finder_tags), tagged_paths, concurrency)
+        for file_path in chunk:
+            result = results.get(file_path)
+            metrics.file_done()
+            if isinstance(result, Exception):
+                # Leave the file out of the manifest so that the next sync retries it
+                error(f"Failed to sync the tags of {os.path.basename(file_path)}: {result}", file_path, "write")
                 continue
-            
-            tags = get_finder_tags(file_path)
-            if len(tags) > 0:
-                if file_name.endswith(".pdf"):
-                    add_tags_to_pdf_metadata(file_path, tags)
-                elif file_name.endswith((".mp4", ".mkv", ".webm")):
-                    add_tags_to_video_metadata(file_path, tags)
-                elif file_name.endswith(".txt") and file_name.replace(".txt", "_metadata.json") in files:
-                    add_tags_to_text_file(file_path, tags)
+            manifest.update(file_path, finder_tags[file_path])
+    manifest.prune()
+    manifest.save()
+    metrics.print_summary()
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        folder_path = sys.argv[1]
+def main(argv=None):
+    """Sync the Finder tags of the folder given on the command line (or in argv) and return the exit status."""
+    parser = argparse.ArgumentParser(description="Sync Finder tags to the metadata of the files in a folder.")
+    parser.add_argument("folder_path", nargs="?", help="folder containing the files to sync")
+    parser.add_argument("--full", action="store_true", help="sync every file, even those unchanged since the last run")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"number of files whose metadata is written at once (default: {DEFAULT_CONCURRENCY})")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+
+    if args.folder_path:
+        folder_path = args.folder_path
     else:
         # Prompt the user to select a folder if no folder path is provided
         root = Tk()
@@ -97,12 +101,15 @@ if __name__ == "__main__":
         folder_path = filedialog.askdirectory(title="Select Folder Containing Files to Tag")
         if not folder_path:
             print("No folder path provided.")
-            sys.exit()
+            return 0
 
     if folder_path:
         print(f"Selected folder: {folder_path}")
-        sync_tags(folder_path)
-        sys.exit(0) # Exit with status code 0 indicating success
+        sync_tags(folder_path, full_scan=args.full, concurrency=max(1, args.concurrency))
+        return 0 # Status code 0 indicating success
     else:
         print("No folder path provided.")
-        sys.exit(1)  # Exit with status code 1 indicating an error
\ No newline at end of file
+        return 1  # Status code 1 indicating an error
+
+if __name__ == "__main__":
+    sys.exit(main())
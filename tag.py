@@ -1,308 +1,818 @@
 import os
 import sys
-import pymupdf
-from keybert import KeyBERT
-import re
-import subprocess
-import whisper
+import argparse
 import json
-import inflect
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+import numpy as np
+from cache import TagCache, hash_file, DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES
+from manifest import Manifest
+from journal import RunJournal, EXTRACTED, TAGGED, WRITTEN, FINDER_TAGS_SET
+from videometa import add_tags_to_video_metadata
+from pdfmeta import add_tags_to_pdf_metadata, pdf_errors
+from metadata import read_metadata_tags_many
+from tagstore import get_finder_tags_bulk, set_finder_tags_bulk, chunked, BULK_SIZE
+from asyncrun import DEFAULT_CONCURRENCY
+from keywords import get_tfidf_model, TFIDF_NAME
+from phrasecache import PhraseEmbeddingCache, DEFAULT_PHRASE_CACHE_DIR
+from metrics import Metrics, metrics, log, error, add_arguments, configure_from_args, NORMAL
+from transcribe import transcribe_video, transcribe_videos, DEFAULT_SEGMENT_SECONDS
 
 # Set the environment variable to disable parallelism for tokenizers
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-# Initialize KeyBERT
-kw_model = KeyBERT()
-
-# Initialize the inflect engine
-p = inflect.engine()
-
-def extract_chapter_titles(video_file):
-    cmd = ["ffprobe", "-i", video_file, "-show_chapters", "-loglevel", "error"]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    if result.returncode != 0:
-        print(f"Failed to extract chapter titles from {video_file}")
-        print(result.stderr)
-        return []
-
-    # print(result.stdout)
-
-    # Regular expression to match chapter titles
-    titles = re.findall(r'TAG:title=(.+)', result.stdout)
-
-    return titles
-
-def get_filename_without_extension(video_path):
-    """Extract the filename without extension from a video path."""
-    filename_with_extension = os.path.basename(video_path)  # Get the filename with extension
-    filename_without_extension = os.path.splitext(filename_with_extension)[0]  # Remove the extension
-    return filename_without_extension
-
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF file."""
-    doc = pymupdf.open(pdf_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
-
-def extract_audio_with_original_format(video_path, output_dir):
-    """Extract audio from a video file, preserving the original format."""
-    # Get the audio codec using ffprobe
-    ffprobe_cmd = [
-        "ffprobe", "-v", "error", "-select_streams", "a:0",
-        "-show_entries", "stream=codec_name", "-of",
-        "default=noprint_wrappers=1:nokey=1", video_path
-    ]
-    result = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    audio_codec = result.stdout.strip()
-    
-    # Map codec to file extension
-    codec_to_extension = {
-        "aac": "m4a",  # Use m4a for AAC audio
-        "mp3": "mp3",
-        "vorbis": "ogg",
-        "opus": "opus",
-        "flac": "flac",
-        "pcm_s16le": "wav",
-    }
-    file_extension = codec_to_extension.get(audio_codec, "m4a")  # Default to m4a if unknown
-    
-    # Create the output directory if it doesn't exist
-    video_name_without_extension = get_filename_without_extension(video_path)
-    output_dir = os.path.join(output_dir, video_name_without_extension)
-    os.makedirs(output_dir, exist_ok=True)
-    
-    audio_output_path = os.path.join(output_dir, f"{video_name_without_extension}.{file_extension}")
-
-    # Check if the audio file already exists
-    if os.path.exists(audio_output_path):
-        print(f"Audio already extracted: {audio_output_path}")
-        return audio_output_path
-
-    # Extract audio if it doesn't already exist
-    ffmpeg_cmd = [
-        "ffmpeg", "-i", video_path, "-vn", "-acodec", "copy", audio_output_path
-    ]
-    subprocess.run(ffmpeg_cmd)
-    return audio_output_path
-    
-def transcribe_audio_with_language_detection(audio_path):
-    """Transcribe audio with language detection and save as JSON."""
-    # Extract the file extension from audio_path
-    output_dir = os.path.dirname(audio_path)
-    output_json_path = os.path.join(output_dir, f"{get_filename_without_extension(audio_path)}_transcription.json")
-
-    
-    # Check if the transcription file already exists
-    if os.path.exists(output_json_path):
-        print(f"Transcription already exists: {output_json_path}")
-        return output_json_path
-    
-    model = whisper.load_model("base")
-    result = model.transcribe(audio_path)
-    detected_language = result.get("language", "unknown")
-    transcript = result["text"]
-    
-    # Create the JSON structure
-    transcription_data = {
-        "language": detected_language,
-        "transcript": transcript
-    }
-
-    # Save the transcription data to a JSON file
-    with open(output_json_path, 'w') as json_file:
-        json.dump(transcription_data, json_file, ensure_ascii=False, indent=4)
-
-    print(f"Transcription saved to {output_json_path}")
-    return output_json_path
-
-def generate_tags(text, model, top_n=5):
-    """Generate tags using KeyBERT and convert them to singular form."""
-    keywords = model.extract_keywords(text, top_n=top_n * 2)  # Extract more keywords to ensure we get enough unique singular keywords
+# Sentence-transformer used by KeyBERT (also part of the cache key)
+KEYBERT_MODEL = "all-MiniLM-L6-v2"
+
+# Number of tags generated for each file
+DEFAULT_TOP_N = 5
+
+# Keyword extractors: KeyBERT, or TF-IDF against the document frequencies of the whole library
+KEYWORD_BACKENDS = ("keybert", "tfidf")
+DEFAULT_KEYWORD_BACKEND = "keybert"
+
+# Models computing KeyBERT's embeddings: the PyTorch sentence-transformer, or an int8 ONNX export of it
+EMBEDDING_BACKENDS = ("torch", "onnx")
+DEFAULT_EMBEDDING_BACKEND = "torch"
+
+# Default folder of the ONNX export, with its tokenizer.json
+DEFAULT_ONNX_MODEL_DIR = os.path.join(os.path.expanduser("~"), ".tagify", "onnx", "all-MiniLM-L6-v2-int8")
+
+# KeyBERT (and torch) are imported and initialized on first use, so that runs without
+# anything to tag and the transcription worker processes, which re-import this module,
+# do not load them
+kw_model = None
+
+# ONNX export KeyBERT embeds with instead of the PyTorch model, if any (see use_onnx_model),
+# and the one kw_model was created with
+onnx_model_path = None
+_kw_model_onnx_path = None
+
+# Number of threads ONNX Runtime uses, 0 for all the cores
+_onnx_threads = 0
+
+# The inflect engine takes seconds to import, so it is also initialized on first use
+p = None
+
+# Store of KeyBERT's candidate keyphrase embeddings opened by this process, and its (model, folder)
+_phrase_cache = None
+_phrase_cache_key = None
+
+# Number of documents whose texts are sent to KeyBERT in a single call
+DEFAULT_BATCH_SIZE = 32
+
+# How pages are picked from PDFs longer than --pdf-max-pages: the first pages or evenly spaced ones
+PDF_SAMPLING_STRATEGIES = ("first", "even")
+DEFAULT_PDF_SAMPLING = "first"
+
+# Number of characters of a PDF's text KeyBERT generates tags from
+DEFAULT_PDF_MAX_CHARS = 200000
+
+# Number of threads extracting audio and chapter titles from videos
+DEFAULT_EXTRACT_WORKERS = 2
+
+# Number of processes transcribing videos, each with its own Whisper model
+DEFAULT_WHISPER_WORKERS = 1
+
+def use_onnx_model(path, threads=0):
+    """Make KeyBERT embed with the ONNX export in path, or with the PyTorch model if path is None."""
+    global onnx_model_path, _onnx_threads
+    onnx_model_path = path
+    _onnx_threads = threads
+
+def get_kw_model():
+    """Initialize KeyBERT on first use, or when the embedding model changed, and return it."""
+    global kw_model, _kw_model_onnx_path
+    if kw_model is None or _kw_model_onnx_path != onnx_model_path:
+        from keybert import KeyBERT
+        if onnx_model_path is not None:
+            from onnxembed import OnnxEmbedder
+            kw_model = KeyBERT(model=OnnxEmbedder(onnx_model_path, threads=_onnx_threads))
+        else:
+            kw_model = KeyBERT(model=KEYBERT_MODEL)
+        _kw_model_onnx_path = onnx_model_path
+    return kw_model
+
+def embedding_model_name():
+    """Return the name of the model KeyBERT embeds with, which its cached embeddings are stored under."""
+    if onnx_model_path is None:
+        return KEYBERT_MODEL
+    # The embeddings of a quantized model are close to, but not the same as, the PyTorch ones
+    return f"{KEYBERT_MODEL}-onnx-{os.path.basename(os.path.normpath(onnx_model_path))}"
+
+def keyword_backend(file_path, keyword_backends=None):
+    """Return the keyword extractor for a file.
+
+    keyword_backends maps file extensions to extractor names, with "" for the other files.
+    """
+    keyword_backends = keyword_backends or {}
+    extension = os.path.splitext(file_path)[1].lower()
+    return keyword_backends.get(extension, keyword_backends.get("", DEFAULT_KEYWORD_BACKEND))
+
+def get_keyword_model(backend):
+    """Return the model of a keyword extractor, loading it on first use."""
+    return get_tfidf_model() if backend == "tfidf" else get_kw_model()
+
+def cache_model_name(backend):
+    """Return the name the tags generated by a keyword extractor are cached under."""
+    return TFIDF_NAME if backend == "tfidf" else embedding_model_name()
+
+def get_phrase_cache(folder=DEFAULT_PHRASE_CACHE_DIR):
+    """Open the store of candidate keyphrase embeddings of the current embedding model on first use and return it."""
+    global _phrase_cache, _phrase_cache_key
+    key = (embedding_model_name(), folder)
+    if _phrase_cache is None or _phrase_cache_key != key:
+        if _phrase_cache is not None:
+            _phrase_cache.close()
+        _phrase_cache = PhraseEmbeddingCache(*key)
+        _phrase_cache_key = key
+    return _phrase_cache
+
+def get_inflect_engine():
+    """Initialize the inflect engine on first use and return it."""
+    global p
+    if p is None:
+        import inflect
+        p = inflect.engine()
+    return p
+
+@lru_cache(maxsize=100000)
+def singular_form(keyword):
+    """Return the singular form of a keyword, remembering it as the same keywords recur across files."""
+    return get_inflect_engine().singular_noun(keyword) or keyword
+
+def sample_page_numbers(page_count, sampling=DEFAULT_PDF_SAMPLING, max_pages=None):
+    """Return the numbers of the pages to read from a PDF with page_count pages."""
+    if max_pages is None or max_pages >= page_count:
+        return range(page_count)
+    if sampling == "even":
+        # Evenly spaced pages, always including the first and the last one
+        if max_pages <= 1:
+            return [0]
+        return sorted({round(i * (page_count - 1) / (max_pages - 1)) for i in range(max_pages)})
+    return range(max_pages)
+
+def iter_pdf_pages(pdf_path, sampling=DEFAULT_PDF_SAMPLING, max_pages=None):
+    """Yield the text of the sampled pages of a PDF one page at a time."""
+    import pymupdf
+
+    with pymupdf.open(pdf_path) as doc:
+        for page_number in sample_page_numbers(doc.page_count, sampling, max_pages):
+            yield doc.load_page(page_number).get_text()
+
+def extract_text_from_pdf(pdf_path, sampling=DEFAULT_PDF_SAMPLING, max_pages=None, max_chars=DEFAULT_PDF_MAX_CHARS):
+    """Extract text from a PDF file, reading at most max_pages pages and max_chars characters."""
+    pages = []
+    length = 0
+    for page_text in iter_pdf_pages(pdf_path, sampling, max_pages):
+        if max_chars is not None and length + len(page_text) >= max_chars:
+            # Stop reading (and parsing) pages once the character budget is spent
+            pages.append(page_text[:max_chars - length])
+            break
+        pages.append(page_text)
+        length += len(page_text)
+    return "".join(pages)
+
+def singularize_keywords(keywords, top_n=DEFAULT_TOP_N):
+    """Convert KeyBERT keywords to singular form, keeping the first top_n unique ones."""
     singular_keywords = []
     index = 0
 
     while len(singular_keywords) < top_n and index < len(keywords):
         kw = keywords[index][0]
-        singular_kw = p.singular_noun(kw) or kw
+        singular_kw = singular_form(kw)
         if singular_kw not in singular_keywords:
             singular_keywords.append(singular_kw)
         index += 1
 
     return singular_keywords
 
-def add_tags_to_pdf_metadata(pdf_path, tags):
-    """Add generated tags to the metadata of the PDF."""
-    doc = pymupdf.open(pdf_path)
-    metadata = doc.metadata
-
-    # Add or update the Keywords field with the generated tags
-    metadata["keywords"] = ", ".join(tags)
-    doc.set_metadata(metadata)
-
-    # Save the updated PDF
-    doc.save(pdf_path)
-    doc.close()
-
-def add_tags_to_video_metadata(video_path, tags):
-    """Add generated tags to the metadata of the video."""    
-    tags_str = ", ".join(tags)
-    ffmpeg_cmd = [
-        "ffmpeg", "-loglevel", "quiet", "-y", "-i", video_path, "-metadata", f"comment={tags_str}", "-c", "copy", video_path
-    ]
-    subprocess.run(ffmpeg_cmd)
-
-def get_finder_tags(file_path):
-    """Get Finder tags using the tag command line tool."""
-    tag_cmd = ["tag", "--list", file_path]
-    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Failed to get Finder tags for {file_path}: {result.stderr}")
+def generate_tags(text, model, top_n=DEFAULT_TOP_N):
+    """Generate tags using KeyBERT and convert them to singular form."""
+    keywords = model.extract_keywords(text, top_n=top_n * 2)  # Extract more keywords to ensure we get enough unique singular keywords
+    return singularize_keywords(keywords, top_n)
+
+def embed_documents(texts, model, embeddings=None):
+    """Return the KeyBERT document embeddings of texts, only computing the missing ones."""
+    embeddings = list(embeddings) if embeddings is not None else [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        computed = model.model.embed([texts[i] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+    return np.vstack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+def embed_candidates(texts, model, phrase_cache):
+    """Return KeyBERT's candidate keyphrase vectorizer for texts and the embeddings of its candidates.
+
+    Only the candidates that phrase_cache does not hold yet are embedded. Returns (None, None)
+    when none of the texts has any candidate.
+    """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    # The candidates KeyBERT extracts by default: single words that are not English stop words
+    try:
+        vectorizer = CountVectorizer(ngram_range=(1, 1), stop_words="english").fit(texts)
+    except ValueError:
+        return None, None
+    return vectorizer, phrase_cache.embed(list(vectorizer.get_feature_names_out()), model.model)
+
+def generate_tags_batch(texts, model, top_n=DEFAULT_TOP_N, doc_embeddings=None, phrase_cache=None):
+    """Generate tags for several documents with a single KeyBERT call.
+
+    With a phrase_cache (and doc_embeddings), the embeddings of the candidate keyphrases come
+    from the cache instead of being computed again for every document.
+    """
+    if not texts:
         return []
-    tags_str = result.stdout.replace(file_path,"").strip()
-    # Split the tags_str based on the first occurrence of multiple spaces
-    tags = [tag.strip() for tag in tags_str.split(",")] if tags_str else []
-    if len(tags) > 0:
-        print(f"Retrieved Finder tags for {file_path}: {', '.join(tags)}")
+    if phrase_cache is not None and doc_embeddings is not None:
+        vectorizer, word_embeddings = embed_candidates(texts, model, phrase_cache)
+        if vectorizer is None:
+            return [[] for _ in texts]
+        keywords = model.extract_keywords(texts, top_n=top_n * 2, vectorizer=vectorizer,
+                                          doc_embeddings=doc_embeddings, word_embeddings=word_embeddings)
+    elif doc_embeddings is not None:
+        keywords = model.extract_keywords(texts, top_n=top_n * 2, doc_embeddings=doc_embeddings)
     else:
-        print(f"No Finder tags found for {file_path}")
-    return tags
-
-def set_finder_tags(file_path, tags):
-    """Set Finder tags using the tag command line tool."""
-    tags_str = ",".join(tags)
-    tag_cmd = ["tag", "--set", tags_str, file_path]
-    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Failed to set Finder tags for {file_path}: {result.stderr}")
-    else:
-        print(f"Set Finder tags for {file_path}: {tags_str}")
-
-def process_folder(folder_path):
-    """Process all PDFs and videos in a folder and its sub-folders to generate tags and update metadata."""
-    for root, dirs, files in os.walk(folder_path):
-        for file_name in files:
-            # Initialize the tagged flag
-            tagged = False
-            
-            file_path = os.path.join(root, file_name)
-            
-            # Check if it's actually a file
-            if not os.path.isfile(file_path):
-                continue
-            
-            # Skip hidden files and non-supported files
-            if file_name.startswith("._") or not file_name.endswith((".pdf", ".txt", ".mp4", ".mkv", ".webm")):
-                continue
-            
-            # If the file is already tagged, then set the flag tagged to True
-            finder_tags = get_finder_tags(file_path)
-            if len(finder_tags) > 0:
-                tagged = True
-            
+        keywords = model.extract_keywords(texts, top_n=top_n * 2)
+    # KeyBERT returns a flat list of keywords (rather than one list per document) when given
+    # a single document, and an empty list when none of the documents has any candidate
+    if len(texts) == 1 or not keywords:
+        keywords = [keywords] if len(texts) == 1 else [[] for _ in texts]
+    return [singularize_keywords(doc_keywords, top_n) for doc_keywords in keywords]
+
+def extract_text(file_path, pdf_options=None, keep_audio=False, transcription_options=None):
+    """Extract the text KeyBERT should generate tags from for a supported file.
+
+    pdf_options holds the sampling, max_pages and max_chars arguments of extract_text_from_pdf.
+    The audio of videos is streamed to Whisper, unless keep_audio is set to extract it next to them,
+    and transcription_options bounds how much of it is transcribed (see transcribe_audio_stream).
+    """
+    file_name = os.path.basename(file_path)
+    text = ""
+    if file_name.endswith(".pdf"):
+        # Extract text from the PDF
+        text = extract_text_from_pdf(file_path, **(pdf_options or {}))
+    elif file_name.endswith(".txt"):
+        # Extract text from the text file
+        with open(file_path, 'r') as file:
+            text = file.read()
+    elif file_name.endswith((".mp4", ".mkv", ".webm")):
+        # Extract chapter titles and transcribe audio
+        chapter_titles, transcription = transcribe_video(file_path, keep_audio=keep_audio, transcription_options=transcription_options)
+        text = video_text(file_path, chapter_titles, transcription)
+    return text
+
+def video_text(video_path, chapter_titles, transcription):
+    """Combine a video's name, chapter titles and transcript into the text to generate tags from.
+
+    transcription is a {"language", "transcript"} dict, or the path of the JSON file holding it.
+    """
+    #Strip the file extension
+    file_name = os.path.splitext(os.path.basename(video_path))[0]
+    text = f"{file_name}\n\n"
+
+    log(f"Chapter titles for {file_name}:\n\n")
+    for i, title in enumerate(chapter_titles, start=1):
+        text += f"{i}. {title}\n"
+        log(f"{i}. {title}\n")
+
+    # Load the JSON file to get the language and transcript
+    if isinstance(transcription, str):
+        with open(transcription, 'r') as json_file:
+            transcription = json.load(json_file)
+    language = transcription["language"]
+    transcript = transcription["transcript"]
+    sentences = transcript.split(".")
+    first_sentence = sentences[0]
+    if "transcribed_seconds" in transcription:
+        log(f"Transcribed {transcription['transcribed_seconds']:.0f}s out of {transcription['audio_seconds']:.0f}s of audio decoded")
+    log(f"Transcription ({language}): {first_sentence}...")
+    text += transcript
+    return text
+
+def write_metadata_tags(file_path, tags):
+    """Write generated tags to a file's own metadata."""
+    if file_path.endswith(".pdf"):
+        # Add tags to the PDF metadata
+        add_tags_to_pdf_metadata(file_path, tags)
+        log(f"Tagged PDF saved at: {file_path}")
+    elif file_path.endswith(".txt"):
+        # Save tags in a separate metadata file
+        metadata_path = file_path.replace(".txt", "_metadata.json")
+        with open(metadata_path, 'w') as metadata_file:
+            json.dump({"tags": tags}, metadata_file)
+        log(f"Metadata saved at: {metadata_path}")
+    elif file_path.endswith((".mp4", ".mkv", ".webm")):
+        # Add tags to the video metadata
+        add_tags_to_video_metadata(file_path, tags)
+
+def write_back(file_path, tags, cache=None, content_hash=None):
+    """Write tags to a file's metadata, keeping the cache in step with the new content."""
+    write_metadata_tags(file_path, tags)
+
+    # PDF and video metadata live inside the file, so the written file has a new content hash
+    if cache is not None and content_hash is not None and not file_path.endswith(".txt"):
+        cache.add_alias(hash_file(file_path), content_hash)
+
+def set_tags_and_record(files_tags, manifest=None, concurrency=DEFAULT_CONCURRENCY, journal=None):
+    """Set the Finder tags of handled files in bulk and record them in the journal and the manifest."""
+    # Set Finder tags (Finder tags will be overwritten with metadata tags)
+    with metrics.stage("finder tags", files=len(files_tags)):
+        results = set_finder_tags_bulk({file_path: tags for file_path, tags in files_tags.items() if len(tags) > 0}, concurrency)
+    done = {file_path: tags for file_path, tags in files_tags.items() if results.get(file_path, True)}
+    if journal is not None:
+        journal.record(FINDER_TAGS_SET, done)
+    if manifest is not None:
+        for file_path, tags in done.items():
+            manifest.update(file_path, tags)
+
+def write_back_batch(files_tags, hashes=None, cache=None, manifest=None, journal=None, concurrency=DEFAULT_CONCURRENCY):
+    """Write the tags of a batch of files to their metadata, then set them as their Finder tags.
+
+    hashes gives the content hash each file was tagged from, for the cache. With a journal, the
+    files whose metadata was written, and then those whose Finder tags were set, are recorded in
+    one transaction each. Returns the files whose metadata was written.
+    """
+    written = {}
+    for file_path, tags in files_tags.items():
+        file_name = os.path.basename(file_path)
+        try:
+            with metrics.stage("write", file_path):
+                write_back(file_path, tags, cache, (hashes or {}).get(file_path))
+            written[file_path] = tags
+        except pdf_errors() as e:
+            error(f"Error processing PDF {file_name}: {str(e)}", file_path, "write")
+        except Exception as e:
+            error(f"Unexpected error processing {file_name}: {str(e)}", file_path, "write")
+    if journal is not None:
+        journal.record(WRITTEN, written)
+    set_tags_and_record(written, manifest, concurrency, journal)
+    return written
+
+def tag_batch(batch, top_n=DEFAULT_TOP_N, pdf_options=None, model=None, keyword_backends=None, phrase_cache_dir=None):
+    """Extract the missing texts of a batch of files and generate their tags with a single call per keyword extractor.
+
+    batch holds (file_path, content_hash, text, embedding) tuples, where text is None for files
+    still to be extracted. Each file goes to the extractor keyword_backends picks for it, unless
+    a model is given. KeyBERT takes its candidate keyphrase embeddings from the phrase store in
+    phrase_cache_dir, if any. Returns the (file_path, content_hash, text, embedding, tags) of
+    every file that could be tagged, and the metrics events of the batch for the parent to replay.
+    """
+    batch_metrics = Metrics(verbosity=metrics.verbosity, keep_events=True)
+    extracted = []
+    for file_path, content_hash, text, embedding in batch:
+        file_name = os.path.basename(file_path)
+        try:
+            if text is None:
+                with batch_metrics.stage("extract", file_path):
+                    text = extract_text(file_path, pdf_options)
+            extracted.append((file_path, content_hash, text, embedding))
+        except pdf_errors() as e:
+            batch_metrics.error(f"Error processing PDF {file_name}: {str(e)}", file_path, "extract")
+        except Exception as e:
+            batch_metrics.error(f"Unexpected error processing {file_name}: {str(e)}", file_path, "extract")
+    if not extracted:
+        return [], batch_metrics.events
+
+    groups = {}
+    for item in extracted:
+        groups.setdefault(keyword_backend(item[0], keyword_backends), []).append(item)
+    results = []
+    for backend, items in groups.items():
+        backend_model = model if model is not None else get_keyword_model(backend)
+        texts = [text for _, _, text, _ in items]
+        try:
+            doc_embeddings = None
+            phrase_cache = None
+            if backend == "keybert":
+                with batch_metrics.stage("embed", files=len(texts)):
+                    doc_embeddings = embed_documents(texts, backend_model, [embedding for _, _, _, embedding in items])
+                if phrase_cache_dir is not None:
+                    phrase_cache = get_phrase_cache(phrase_cache_dir)
+                    hits, misses = phrase_cache.hits, phrase_cache.misses
+            with batch_metrics.stage("keywords", files=len(texts)):
+                tags_per_file = generate_tags_batch(texts, backend_model, top_n, doc_embeddings, phrase_cache)
+            if phrase_cache is not None:
+                batch_metrics.count("cached phrases", phrase_cache.hits - hits)
+                batch_metrics.count("embedded phrases", phrase_cache.misses - misses)
+        except Exception as e:
+            batch_metrics.error(f"Unexpected error generating tags for a batch of {len(items)} files: {str(e)}", stage="keywords")
+            continue
+        # The TF-IDF extractor has no embeddings to cache
+        embeddings = doc_embeddings if doc_embeddings is not None else [None] * len(items)
+        results.extend(
+            (file_path, content_hash, text, embedding, tags)
+            for (file_path, content_hash, text, _), embedding, tags in zip(items, embeddings, tags_per_file)
+        )
+    return results, batch_metrics.events
+
+def write_results(results, cache=None, top_n=DEFAULT_TOP_N, manifest=None, keyword_backends=None, journal=None,
+                  concurrency=DEFAULT_CONCURRENCY):
+    """Cache the generated tags of a batch, record them in the journal and write them back to the files.
+
+    At most concurrency Finder tag writes run at once.
+    """
+    files_tags = {}
+    hashes = {}
+    for file_path, content_hash, text, embedding, tags in results:
+        file_name = os.path.basename(file_path)
+        log(f"Tags for {file_name}: {tags}")
+        if cache is not None:
             try:
-                tags = []
-                if file_name.endswith(".pdf"):
-                    if not tagged:
-                        # Extract text from the PDF
-                        text = extract_text_from_pdf(file_path)
-
-                        # Generate tags
-                        tags = generate_tags(text, kw_model)
-                        print(f"Tags for {file_name}: {tags}")
-
-                        # Add tags to the PDF metadata
-                        add_tags_to_pdf_metadata(file_path, tags)
-                        print(f"Tagged PDF saved at: {file_path}")
-                    else:
-                        # Read tags from the PDF metadata
-                        doc = pymupdf.open(file_path)
-                        metadata = doc.metadata
-                        tags_str = metadata.get("keywords", "")
-                        tags = tags_str.split(", ") if tags_str else []
-                        doc.close()
-                elif file_name.endswith(".txt"):
-                    if not tagged:
-                        # Extract text from the text file
-                        with open(file_path, 'r') as file:
-                            text = file.read()
-
-                        # Generate tags
-                        tags = generate_tags(text, kw_model)
-                        print(f"Tags for {file_name}: {tags}")
-
-                        # Save tags in a separate metadata file
-                        metadata_path = file_path.replace(".txt", "_metadata.json")
-                        with open(metadata_path, 'w') as metadata_file:
-                            json.dump({"tags": tags}, metadata_file)
-                        print(f"Metadata saved at: {metadata_path}")
-                    else:
-                        # Read tags from the metadata file
-                        metadata_path = file_path.replace(".txt", "_metadata.json")
-                        with open(metadata_path, 'r') as metadata_file:
-                            metadata = json.load(metadata_file)
-                            tags = metadata.get("tags", [])
-                elif file_name.endswith((".mp4", ".mkv", ".webm")):
-                    if not tagged:
-                        #Strip the file extension
-                        file_name = os.path.splitext(file_name)[0]
-                        text = f"{file_name}\n\n"
-                        
-                        # Extract chapter titles
-                        print(f"Chapter titles for {file_name}:\n\n")
-                        chapter_titles = extract_chapter_titles(file_path)
-                        for i, title in enumerate(chapter_titles, start=1):
-                            text += f"{i}. {title}\n"
-                            print(f"{i}. {title}\n")
-                        
-                        # Extract audio
-                        audio_path = extract_audio_with_original_format(file_path, root)
-                        print(f"Audio extracted from {file_name} to {audio_path}")
-
-                        # Transcribe audio
-                        output_json_path = transcribe_audio_with_language_detection(audio_path)
-                        # Load the JSON file to get the language and transcript
-                        with open(output_json_path, 'r') as json_file:
-                            transcription_data = json.load(json_file)
-                            language = transcription_data["language"]
-                            transcript = transcription_data["transcript"]
-                            sentences = transcript.split(".")
-                            first_sentence = sentences[0]
-                        print(f"Transcription ({language}): {first_sentence}...")
-                        text += transcript
-                        
-                        # Generate tags
-                        tags = generate_tags(text, kw_model)
-                        print(f"Tags for {file_name}: {tags}")
-
-                        # Add tags to the video metadata
-                        add_tags_to_video_metadata(file_path, tags)
-                    else:
-                        # Read tags from the video metadata
-                        tags_str = subprocess.run(
-                            ["ffprobe", "-v", "error", "-show_entries", "format=tags:stream=tags", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
-                            stdout=subprocess.PIPE, text=True
-                        ).stdout.strip()
-                        tags = tags_str.split(", ") if tags_str else []
-                    
-                # Set Finder tags (Finder tags will be overwritten with metadata tags)
-                if len(tags) > 0:
-                    set_finder_tags(file_path, tags)
-                
-                print("----------------")
-            except pymupdf.FileDataError as e:
-                print(f"Error processing PDF {file_name}: {str(e)}")
+                with metrics.stage("cache", file_path):
+                    cache.put(content_hash, cache_model_name(keyword_backend(file_path, keyword_backends)), top_n, text, embedding, tags)
+            except Exception as e:
+                error(f"Failed to cache the tags of {file_name}: {str(e)}", file_path, "cache")
+        files_tags[file_path] = tags
+        hashes[file_path] = content_hash
+    if journal is not None:
+        journal.record(TAGGED, files_tags, hashes)
+    written = write_back_batch(files_tags, hashes, cache, manifest, journal, concurrency)
+    metrics.count("tagged", len(written))
+    log("----------------")
+
+def _init_tag_worker(workers, verbosity, keyword_backends, onnx_model=None):
+    metrics.verbosity = verbosity
+    # Share the cores between the workers instead of letting each torch (or ONNX Runtime) use all of them
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    use_onnx_model(onnx_model, threads)
+    if keyword_backend("", keyword_backends) != "keybert" and "keybert" not in (keyword_backends or {}).values():
+        return
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    get_kw_model()
+
+class BatchRunner:
+    """Generate tags for batches of files in this process or in a pool of worker processes.
+
+    With more than one worker, batches are sent to a pool of processes that each initialize
+    their keyword extractors and the inflect engine once; the parent collects the generated tags and writes
+    them back, so the cache, the journal, the manifest and the Finder tags are only touched by one process.
+    """
+
+    def __init__(self, *, workers=1, cache=None, top_n=DEFAULT_TOP_N, manifest=None, pdf_options=None, keyword_backends=None,
+                 phrase_cache_dir=None, journal=None, concurrency=DEFAULT_CONCURRENCY):
+        self.workers = workers
+        self.cache = cache
+        self.top_n = top_n
+        self.manifest = manifest
+        self.pdf_options = pdf_options
+        self.keyword_backends = keyword_backends
+        self.phrase_cache_dir = phrase_cache_dir
+        self.journal = journal
+        self.concurrency = concurrency
+        self.pending = {}
+        self.executor = None
+        if workers > 1:
+            # Spawn the workers so they do not inherit the parent's model or tokenizer state
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_tag_worker,
+                                                initargs=(workers, metrics.verbosity, keyword_backends, onnx_model_path))
+
+    def submit(self, batch):
+        """Tag a batch of files, or queue it for the worker processes."""
+        if not batch:
+            return
+        if self.executor is None:
+            self._write(*tag_batch(batch, self.top_n, self.pdf_options, None, self.keyword_backends, self.phrase_cache_dir), len(batch))
+            return
+        # Keep at most two batches per worker in flight to bound memory use
+        while len(self.pending) >= 2 * self.workers:
+            self._collect(FIRST_COMPLETED)
+        self.pending[self.executor.submit(tag_batch, batch, self.top_n, self.pdf_options, None, self.keyword_backends,
+                                          self.phrase_cache_dir)] = len(batch)
+
+    def _collect(self, return_when):
+        done, _ = wait(self.pending, return_when=return_when)
+        for future in done:
+            batch_size = self.pending.pop(future)
+            try:
+                self._write(*future.result(), batch_size)
             except Exception as e:
-                print(f"Unexpected error processing {file_name}: {str(e)}")
-    print("Tagging completed.")
+                error(f"Unexpected error in a tagging worker: {str(e)}", stage="keywords")
+                metrics.file_done(batch_size)
+
+    def _write(self, results, events, batch_size):
+        metrics.replay(events)
+        write_results(results, self.cache, self.top_n, self.manifest, self.keyword_backends, self.journal, self.concurrency)
+        metrics.file_done(batch_size)
+
+    def close(self):
+        """Wait for the queued batches and shut the worker processes down."""
+        if self.executor is not None:
+            self._collect(ALL_COMPLETED)
+            self.executor.shutdown()
+
+def resume_files(file_paths, journal, manifest, batch, handled, to_write, hashes, concurrency=DEFAULT_CONCURRENCY):
+    """Pick up the files an interrupted run recorded in the journal, and return the other files.
+
+    Files with a transcript are added to batch, files with generated tags to to_write (and their
+    content hash to hashes), and files whose metadata was written to handled, for their Finder
+    tags to be set. Files that were done are recorded in the manifest.
+    """
+    entries = journal.entries(file_paths)
+    # A PDF or video whose metadata was written just before the run stopped has changed since it
+    # was recorded as tagged; it only needs its Finder tags if its metadata holds the tags (the
+    # tags of text files are written next to them, so a changed text file was edited)
+    changed_tagged = [file_path for file_path, entry in entries.items()
+                      if not entry["unchanged"] and entry["stage"] == TAGGED and not file_path.endswith(".txt")]
+    metadata_tags = read_metadata_tags_many(changed_tagged, concurrency) if changed_tagged else {}
+    resumed = set()
+    for file_path, entry in entries.items():
+        stage = entry["stage"]
+        if not entry["unchanged"]:
+            if stage == TAGGED and metadata_tags.get(file_path) == entry["tags"]:
+                stage = WRITTEN
+            else:
+                continue
+        log(f"Resuming {os.path.basename(file_path)} after the {stage} stage")
+        if stage == EXTRACTED:
+            batch.append((file_path, entry["content_hash"], entry["text"], None))
+        elif stage == TAGGED:
+            to_write[file_path] = entry["tags"]
+            hashes[file_path] = entry["content_hash"]
+        elif stage == WRITTEN:
+            handled[file_path] = entry["tags"]
+        elif manifest is not None:
+            manifest.update(file_path, entry["tags"])
+        if stage != EXTRACTED:
+            metrics.file_done()
+        metrics.count("resumed")
+        resumed.add(file_path)
+    return [file_path for file_path in file_paths if file_path not in resumed]
+
+def process_files(file_paths, manifest, *, batch_size=DEFAULT_BATCH_SIZE, cache=None, top_n=DEFAULT_TOP_N,
+                  extract_workers=DEFAULT_EXTRACT_WORKERS, whisper_workers=DEFAULT_WHISPER_WORKERS, pdf_options=None,
+                  workers=1, concurrency=DEFAULT_CONCURRENCY, keyword_backends=None, phrase_cache_dir=None,
+                  onnx_model=None, keep_audio=False, transcription_options=None, journal=None):
+    """Generate tags for the given files of the manifest's folder and update their metadata.
+
+    The texts of untagged files are collected into batches of batch_size documents so that
+    KeyBERT embeds a whole batch in a single forward pass. When a cache is given, files whose
+    content was tagged before reuse the cached tags, text and embedding instead. Files that
+    already have Finder tags get the tags of their own metadata copied back to the Finder.
+    Finder tags are read and written BULK_SIZE files at a time, and every handled file is
+    recorded in the manifest (which is not saved).
+
+    Untagged videos are set aside and transcribed at the end by the transcribe_videos pipeline,
+    with extract_workers threads running ffprobe/ffmpeg and whisper_workers Whisper processes.
+    Their audio is streamed from ffmpeg to Whisper, unless keep_audio is set to first copy it
+    (and save the transcript) to a folder next to each video. transcription_options can skip
+    their silence and bound how much of each is transcribed (see transcribe_audio_stream).
+    pdf_options bounds how much of each PDF is read (see extract_text_from_pdf).
+
+    With workers > 1, text extraction and keyword generation run in that many processes.
+    Reading the metadata tags of already tagged files and any tag command line calls run up to
+    concurrency at once. keyword_backends picks the keyword extractor of each file type (see
+    keyword_backend); KeyBERT is used for all of them by default. When phrase_cache_dir is given,
+    the embeddings of KeyBERT's candidate keyphrases are stored there and reused across files.
+    With an onnx_model folder, KeyBERT embeds with that ONNX export instead of the PyTorch model.
+
+    With a journal, the stages every file goes through are recorded, and the files an interrupted
+    run recorded resume from where they stopped: their transcripts are not made again, and their
+    tags are written to the files that did not get them yet. Tags are written back BULK_SIZE
+    files (or a batch) at a time.
+    """
+    use_onnx_model(onnx_model)
+    runner = BatchRunner(workers=workers, cache=cache, top_n=top_n, manifest=manifest, pdf_options=pdf_options,
+                         keyword_backends=keyword_backends, phrase_cache_dir=phrase_cache_dir, journal=journal,
+                         concurrency=concurrency)
+    batch = []
+    videos = {}
+    try:
+        for chunk in chunked(file_paths, BULK_SIZE):
+            handled = {}
+            to_write = {}
+            hashes = {}
+            if journal is not None:
+                chunk = resume_files(chunk, journal, manifest, batch, handled, to_write, hashes, concurrency)
+                while len(batch) >= batch_size:
+                    runner.submit(batch[:batch_size])
+                    batch = batch[batch_size:]
+            with metrics.stage("finder tags", files=len(chunk)):
+                finder_tags = get_finder_tags_bulk(chunk, concurrency)
+            tagged_paths = [file_path for file_path in chunk if finder_tags[file_path]]
+            with metrics.stage("read metadata", files=len(tagged_paths)):
+                metadata_tags = read_metadata_tags_many(tagged_paths, concurrency)
+            for file_path in chunk:
+                file_name = os.path.basename(file_path)
+
+                # If the file is already tagged, then copy its metadata tags back to the Finder
+                tagged = len(finder_tags[file_path]) > 0
+
+                try:
+                    if tagged:
+                        if isinstance(metadata_tags[file_path], Exception):
+                            raise metadata_tags[file_path]
+                        handled[file_path] = metadata_tags[file_path]
+                        metrics.count("already tagged")
+                        metrics.file_done()
+                        log("----------------")
+                        continue
+
+                    content_hash = None
+                    cached = None
+                    if cache is not None:
+                        with metrics.stage("cache", file_path):
+                            content_hash = hash_file(file_path)
+                            model_name = cache_model_name(keyword_backend(file_path, keyword_backends))
+                            cached = cache.get(content_hash, model_name, top_n)
+                            if cached is None or cached["tags"] is None:
+                                cached = cache.get_partial(content_hash, model_name)
+                        if cached is not None and cached.get("tags") is not None:
+                            log(f"Cached tags for {file_name}: {cached['tags']}")
+                            to_write[file_path] = cached["tags"]
+                            hashes[file_path] = content_hash
+                            metrics.count("cache hits")
+                            metrics.file_done()
+                            log("----------------")
+                            continue
+
+                    if cached is not None and cached["text"] is not None:
+                        metrics.count("cached texts")
+                        batch.append((file_path, content_hash, cached["text"], cached["embedding"]))
+                    elif file_name.endswith((".mp4", ".mkv", ".webm")):
+                        videos[file_path] = content_hash
+                    else:
+                        # The text is extracted along with the rest of the batch
+                        batch.append((file_path, content_hash, None, None))
+                except pdf_errors() as e:
+                    error(f"Error processing PDF {file_name}: {str(e)}", file_path)
+                    metrics.file_done()
+                except Exception as e:
+                    error(f"Unexpected error processing {file_name}: {str(e)}", file_path)
+                    metrics.file_done()
+
+                if len(batch) >= batch_size:
+                    runner.submit(batch)
+                    batch = []
+            write_back_batch(to_write, hashes, cache, manifest, journal, concurrency)
+            set_tags_and_record(handled, manifest, concurrency, journal)
+            if cache is not None:
+                # Write the access times of the chunk's cache hits in one transaction
+                cache.flush()
+
+        if videos:
+            for file_path, chapter_titles, transcription, transcribe_error in transcribe_videos(videos, extract_workers, whisper_workers,
+                                                                                              keep_audio=keep_audio,
+                                                                                              transcription_options=transcription_options):
+                file_name = os.path.basename(file_path)
+                try:
+                    if transcribe_error is not None:
+                        raise transcribe_error
+                    text = video_text(file_path, chapter_titles, transcription)
+                    if journal is not None:
+                        journal.record(EXTRACTED, {file_path: None}, videos, {file_path: text})
+                    batch.append((file_path, videos[file_path], text, None))
+                except Exception as e:
+                    error(f"Unexpected error processing {file_name}: {str(e)}", file_path, "transcribe")
+                    metrics.file_done()
+
+                if len(batch) >= batch_size:
+                    runner.submit(batch)
+                    batch = []
+
+        runner.submit(batch)
+    finally:
+        runner.close()
+
+def process_folder(folder_path, full_scan=False, resume=True, **options):
+    """Process all PDFs and videos in a folder and its sub-folders to generate tags and update metadata.
+
+    Files that have not changed since the previous run, according to the folder's manifest,
+    are skipped unless full_scan is set. The changed files are tagged by process_files, which
+    takes the other keyword arguments (options). With resume, the run is recorded in a journal at the root
+    of the folder, from which a run that was interrupted, or files that failed, pick up.
+    """
+    manifest = Manifest(folder_path, "tag", force=full_scan)
+    journal = RunJournal(folder_path) if resume else None
+    try:
+        with metrics.stage("scan"):
+            changed_paths = [file_path for file_path, stat, changed in manifest.scan() if changed]
+        metrics.set_total(len(changed_paths))
+        process_files(changed_paths, manifest, journal=journal, **options)
+        manifest.prune()
+        manifest.save()
+        if journal is not None:
+            journal.forget_done()
+    finally:
+        if journal is not None:
+            journal.close()
+    log("Tagging completed.", NORMAL)
+    metrics.print_summary(note="extract, embed and keywords are summed over the workers" if options.get("workers", 1) > 1 else None)
+
+def parse_keywords_for(value):
+    """Parse an EXT=EXTRACTOR --keywords-for option into (extension, extractor)."""
+    extension, _, backend = value.partition("=")
+    if not extension or backend not in KEYWORD_BACKENDS:
+        raise argparse.ArgumentTypeError(f"expected EXT=EXTRACTOR with EXTRACTOR one of {', '.join(KEYWORD_BACKENDS)}, got {value!r}")
+    extension = extension.lower()
+    return (extension if extension.startswith(".") else "." + extension), backend
+
+def add_tagging_arguments(parser):
+    """Add the options controlling how files are tagged to a command line parser."""
+    parser.add_argument("--keywords", choices=KEYWORD_BACKENDS, default=DEFAULT_KEYWORD_BACKEND,
+                        help="keyword extractor: KeyBERT, or the much faster TF-IDF against the word frequencies "
+                             "of all the files tagged so far (default: %(default)s)")
+    parser.add_argument("--keywords-for", type=parse_keywords_for, action="append", default=[], metavar="EXT=EXTRACTOR",
+                        help="keyword extractor for the files with this extension, for instance .txt=tfidf (can be repeated)")
+    parser.add_argument("--embeddings", choices=EMBEDDING_BACKENDS, default=DEFAULT_EMBEDDING_BACKEND,
+                        help="model computing KeyBERT's embeddings: the PyTorch sentence-transformer, or its "
+                             "int8 ONNX export in --onnx-model-path, several times faster on CPUs (default: %(default)s)")
+    parser.add_argument("--onnx-model-path", default=DEFAULT_ONNX_MODEL_DIR,
+                        help=f"folder of the ONNX export and its tokenizer.json (default: {DEFAULT_ONNX_MODEL_DIR})")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"number of documents sent to KeyBERT at once (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH,
+                        help=f"location of the text/embedding/tags cache (default: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="maximum size of the cache in MB")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the cache")
+    parser.add_argument("--phrase-cache-path", default=DEFAULT_PHRASE_CACHE_DIR,
+                        help=f"folder of the stored embeddings of KeyBERT's candidate keyphrases (default: {DEFAULT_PHRASE_CACHE_DIR})")
+    parser.add_argument("--no-phrase-cache", action="store_true", help="embed every candidate keyphrase of every file again")
+    parser.add_argument("--extract-workers", type=int, default=DEFAULT_EXTRACT_WORKERS,
+                        help=f"number of threads extracting audio and chapters from videos (default: {DEFAULT_EXTRACT_WORKERS})")
+    parser.add_argument("--whisper-workers", type=int, default=DEFAULT_WHISPER_WORKERS,
+                        help=f"number of Whisper transcription processes (default: {DEFAULT_WHISPER_WORKERS})")
+    parser.add_argument("--keep-audio", action="store_true",
+                        help="copy the audio track and save the transcript of each video to a folder next to it, "
+                             "instead of streaming the audio to Whisper")
+    parser.add_argument("--vad", action="store_true",
+                        help="only transcribe the speech of videos, skipping their silence and most of their music")
+    parser.add_argument("--transcribe-minutes", type=float, default=0,
+                        help="transcribe at most this many minutes of each video, in evenly spaced segments, 0 for all of it")
+    parser.add_argument("--segment-seconds", type=int, default=DEFAULT_SEGMENT_SECONDS,
+                        help=f"length of the segments transcribed with --transcribe-minutes (default: {DEFAULT_SEGMENT_SECONDS})")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="do not record the run in a journal, nor resume an interrupted run from it")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes extracting text and generating tags (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"number of ffprobe/tag calls and metadata reads run at once (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--pdf-sampling", choices=PDF_SAMPLING_STRATEGIES, default=DEFAULT_PDF_SAMPLING,
+                        help="which pages to read from PDFs longer than --pdf-max-pages (default: %(default)s)")
+    parser.add_argument("--pdf-max-pages", type=int, default=0,
+                        help="maximum number of pages read from each PDF, 0 for all pages")
+    parser.add_argument("--pdf-max-chars", type=int, default=DEFAULT_PDF_MAX_CHARS,
+                        help=f"maximum number of characters read from each PDF, 0 for no limit (default: {DEFAULT_PDF_MAX_CHARS})")
+
+def tagging_options(args):
+    """Return the process_folder keyword arguments set by the options of add_tagging_arguments.
+
+    The cache it opens (unless --no-cache is given) must be closed by the caller.
+    """
+    return {
+        "batch_size": max(1, args.batch_size),
+        "cache": None if args.no_cache else TagCache(args.cache_path, args.cache_size * 1024 * 1024),
+        "extract_workers": max(1, args.extract_workers),
+        "whisper_workers": max(1, args.whisper_workers),
+        "pdf_options": {
+            "sampling": args.pdf_sampling,
+            "max_pages": args.pdf_max_pages or None,
+            "max_chars": args.pdf_max_chars or None,
+        },
+        "workers": max(1, args.workers),
+        "concurrency": max(1, args.concurrency),
+        "keyword_backends": {"": args.keywords, **dict(args.keywords_for)},
+        "phrase_cache_dir": None if args.no_phrase_cache else args.phrase_cache_path,
+        "onnx_model": args.onnx_model_path if args.embeddings == "onnx" else None,
+        "keep_audio": args.keep_audio,
+        "resume": not args.no_resume,
+        "transcription_options": {
+            "vad": args.vad,
+            "budget": args.transcribe_minutes * 60 or None,
+            "segment_seconds": max(1, args.segment_seconds),
+        },
+    }
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        folder_path = sys.argv[1]
-        process_folder(folder_path)
-        sys.exit(0) # Exit with status code 0 indicating success
+def main(argv=None):
+    """Generate tags for the folder given on the command line (or in argv) and return the exit status."""
+    parser = argparse.ArgumentParser(description="Generate tags for the files in a folder and its sub-folders.")
+    parser.add_argument("folder_path", nargs="?", help="folder containing the files to tag")
+    parser.add_argument("--full", action="store_true", help="process every file, even those unchanged since the last run")
+    add_tagging_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+
+    if args.folder_path:
+        options = tagging_options(args)
+        try:
+            process_folder(args.folder_path, full_scan=args.full, **options)
+        finally:
+            if options["cache"] is not None:
+                options["cache"].close()
+            metrics.close()
+        return 0 # Status code 0 indicating success
     else:
         print("No folder path provided.")
-        sys.exit(1)  # Exit with status code 1 indicating an error
\ No newline at end of file
+        return 1  # Status code 1 indicating an error
+
+if __name__ == "__main__":
+    sys.exit(main())
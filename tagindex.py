@@ -0,0 +1,323 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import contextlib
+import numpy as np
+from manifest import Manifest
+from metadata import read_metadata_tags_many
+from tagstore import get_finder_tags_bulk, chunked, BULK_SIZE
+from asyncrun import DEFAULT_CONCURRENCY
+from metrics import metrics, log, error, add_arguments, configure_from_args, NORMAL
+
+# Name of the index database written at the root of every indexed folder
+INDEX_NAME = ".tagify_index.sqlite3"
+
+# Postings key of the bitmap of every indexed file, which NOT queries complement against
+# (a Finder tag cannot be empty, so it cannot clash with a real tag)
+ALL_FILES = ""
+
+# Query tokens: parentheses, quoted tags and bare words
+QUERY_TOKEN = re.compile(r"""\s*(?:(\()|(\))|"([^"]*)"|'([^']*)'|([^\s()]+))""")
+
+def bitmap_from_ids(ids):
+    """Return the integer bitmap with the bits of the given ids set."""
+    if len(ids) == 0:
+        return 0
+    bits = np.zeros(max(ids) + 1, dtype=np.uint8)
+    bits[list(ids)] = 1
+    return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+def ids_from_bitmap(bitmap):
+    """Return the sorted ids whose bits are set in an integer bitmap."""
+    if bitmap == 0:
+        return []
+    data = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder="little")).tolist()
+
+class TagIndex:
+    """Persistent inverted index of the tags of every file under a folder.
+
+    Every file gets a stable integer id, and every tag is stored as a bitmap of the ids of the
+    files that carry it, so AND, OR and NOT queries are integer bitwise operations that only load
+    the bitmaps of the tags they name. The index is stored as INDEX_NAME at the root of the folder
+    and keyed by path relative to it, like the folder's manifest, so the folder can be moved.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, INDEX_NAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                tags TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                tag TEXT PRIMARY KEY,
+                bitmap BLOB NOT NULL
+            );
+        """)
+        # Indexes made by earlier versions were keyed by full path: start them over
+        if any(os.path.isabs(path) for (path,) in self.conn.execute("SELECT path FROM files LIMIT 1")):
+            self.conn.executescript("DELETE FROM files; DELETE FROM postings;")
+        self.conn.commit()
+        self.bitmaps = {}
+        # Pending changes per tag as {tag: (ids to add, ids to remove)}, applied by save()
+        self.pending = {}
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self.folder_path)
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def bitmap(self, tag):
+        """Return the bitmap of the files carrying a tag."""
+        if tag not in self.bitmaps:
+            row = self.conn.execute("SELECT bitmap FROM postings WHERE tag = ?", (tag,)).fetchone()
+            self.bitmaps[tag] = int.from_bytes(row[0], "little") if row else 0
+        return self.bitmaps[tag]
+
+    def _change(self, tag, file_id, present):
+        added, removed = self.pending.setdefault(tag, (set(), set()))
+        (added if present else removed).add(file_id)
+        (removed if present else added).discard(file_id)
+
+    def set_tags(self, file_path, tags):
+        """Record the current tags of a file."""
+        tags = list(dict.fromkeys(tags))
+        key = self._key(file_path)
+        row = self.conn.execute("SELECT id, tags FROM files WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            file_id = self.conn.execute("INSERT INTO files (path, tags) VALUES (?, ?)", (key, json.dumps(tags))).lastrowid
+            old_tags = []
+            self._change(ALL_FILES, file_id, True)
+        else:
+            file_id, old_tags = row[0], json.loads(row[1])
+            if old_tags == tags:
+                return
+            self.conn.execute("UPDATE files SET tags = ? WHERE id = ?", (json.dumps(tags), file_id))
+        for tag in set(old_tags) - set(tags):
+            self._change(tag, file_id, False)
+        for tag in set(tags) - set(old_tags):
+            self._change(tag, file_id, True)
+
+    def remove(self, file_path):
+        """Forget a file that no longer exists."""
+        row = self.conn.execute("SELECT id, tags FROM files WHERE path = ?", (self._key(file_path),)).fetchone()
+        if row is None:
+            return
+        file_id, tags = row[0], json.loads(row[1])
+        for tag in tags + [ALL_FILES]:
+            self._change(tag, file_id, False)
+        self.conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def file_paths(self):
+        return [os.path.join(self.folder_path, row[0]) for row in self.conn.execute("SELECT path FROM files")]
+
+    def save(self):
+        """Apply the pending changes to the stored bitmaps and commit them."""
+        for tag, (added, removed) in self.pending.items():
+            ids = (set(ids_from_bitmap(self.bitmap(tag))) | added) - removed
+            bitmap = bitmap_from_ids(ids)
+            self.bitmaps[tag] = bitmap
+            if bitmap:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO postings (tag, bitmap) VALUES (?, ?)",
+                    (tag, bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"))
+                )
+            else:
+                self.conn.execute("DELETE FROM postings WHERE tag = ?", (tag,))
+        self.pending = {}
+        self.conn.commit()
+
+    def tags(self):
+        """Return [(tag, number of files)] sorted by decreasing number of files."""
+        counts = [(tag, int.from_bytes(bitmap, "little").bit_count())
+                  for tag, bitmap in self.conn.execute("SELECT tag, bitmap FROM postings WHERE tag != ?", (ALL_FILES,))]
+        return sorted(counts, key=lambda count: (-count[1], count[0]))
+
+    def paths(self, bitmap, chunk_size=900):
+        """Return the sorted paths of the files whose bits are set in a bitmap."""
+        paths = []
+        for ids in chunked(ids_from_bitmap(bitmap), chunk_size):
+            placeholders = ", ".join("?" * len(ids))
+            paths.extend(os.path.join(self.folder_path, row[0])
+                         for row in self.conn.execute(f"SELECT path FROM files WHERE id IN ({placeholders})", ids))
+        return sorted(paths)
+
+    def query(self, expression):
+        """Return the bitmap of the files matching a boolean tag expression.
+
+        Tags are combined with AND, OR and NOT (in any case) and parentheses; adjacent tags are
+        ANDed, and tags containing spaces must be quoted. Raises ValueError on a malformed query.
+        """
+        tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = QUERY_TOKEN.match(expression, position)
+            if match is None:
+                raise ValueError(f"Unterminated quote in query: {expression[position:]}")
+            open_paren, close_paren, double_quoted, single_quoted, word = match.groups()
+            if open_paren or close_paren:
+                tokens.append((open_paren or close_paren, None))
+            elif word is not None and word.upper() in ("AND", "OR", "NOT"):
+                tokens.append((word.upper(), None))
+            else:
+                tokens.append(("TAG", next(value for value in (double_quoted, single_quoted, word) if value is not None)))
+            position = match.end()
+        tokens.append(("END", None))
+        self._tokens = tokens
+        self._position = 0
+        result = self._parse_or()
+        if self._peek() != "END":
+            raise ValueError(f"Unexpected {self._peek()} in query")
+        return result
+
+    def _peek(self):
+        return self._tokens[self._position][0]
+
+    def _next(self):
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+    def _parse_or(self):
+        result = self._parse_and()
+        while self._peek() == "OR":
+            self._next()
+            result |= self._parse_and()
+        return result
+
+    def _parse_and(self):
+        result = self._parse_not()
+        while self._peek() in ("AND", "NOT", "TAG", "("):
+            if self._peek() == "AND":
+                self._next()
+            result &= self._parse_not()
+        return result
+
+    def _parse_not(self):
+        kind, value = self._next()
+        if kind == "NOT":
+            return self.bitmap(ALL_FILES) & ~self._parse_not()
+        if kind == "(":
+            result = self._parse_or()
+            if self._next()[0] != ")":
+                raise ValueError("Missing ) in query")
+            return result
+        if kind == "TAG":
+            return self.bitmap(value)
+        raise ValueError(f"Expected a tag, NOT or ( but found {'the end of the query' if kind == 'END' else kind}")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def update_index(folder_path, full_scan=False, read_metadata=True, concurrency=DEFAULT_CONCURRENCY):
+    """Bring the tag index of a folder up to date and return it.
+
+    Only the files added or modified since the previous update are read again, unless full_scan
+    is set. A file's indexed tags are its Finder tags followed by the tags found in its own
+    metadata, when read_metadata is set, with up to concurrency files read at once.
+    """
+    index = TagIndex(folder_path)
+    # A missing or deleted index must be rebuilt whatever the manifest says
+    manifest = Manifest(folder_path, "index", force=full_scan or index.is_empty())
+    updated = 0
+    for chunk in chunked(manifest.scan(), BULK_SIZE):
+        changed_paths = [file_path for file_path, stat, changed in chunk if changed]
+        with metrics.stage("finder tags", files=len(changed_paths)):
+            finder_tags = get_finder_tags_bulk(changed_paths, concurrency)
+        metadata_tags = {}
+        if read_metadata and changed_paths:
+            with metrics.stage("metadata tags", files=len(changed_paths)):
+                metadata_tags = read_metadata_tags_many(changed_paths, concurrency)
+        for file_path, stat, changed in chunk:
+            if not changed:
+                continue
+            tags = list(finder_tags[file_path])
+            if file_path.endswith(".txt") and isinstance(metadata_tags.get(file_path), FileNotFoundError):
+                pass  # A text file without a metadata file has no metadata tags
+            elif isinstance(metadata_tags.get(file_path), Exception):
+                error(f"Failed to read the metadata of {file_path}: {metadata_tags[file_path]}", file_path, "metadata tags")
+            elif read_metadata:
+                tags.extend(metadata_tags[file_path])
+            index.set_tags(file_path, tags)
+            manifest.update(file_path, tags, stat)
+            updated += 1
+        metrics.file_done(len(chunk))
+    seen = {os.path.join(folder_path, key) for key in manifest.seen}
+    removed = [file_path for file_path in index.file_paths() if file_path not in seen]
+    for file_path in removed:
+        index.remove(file_path)
+    index.save()
+    manifest.prune()
+    manifest.save()
+    log(f"Indexed {updated} changed files, removed {len(removed)} missing files", NORMAL)
+    return index
+
+def main(argv=None):
+    """Query the tag index of the folder given on the command line (or in argv) and return the exit status."""
+    parser = argparse.ArgumentParser(description="Query the tags of the files in a folder.",
+                                     epilog="Example: tagindex.py ~/Documents '\"machine learning\" and (report or memo) and not draft'")
+    parser.add_argument("folder_path", help="indexed folder")
+    parser.add_argument("query", nargs="?", help="boolean tag query using AND, OR, NOT and parentheses")
+    parser.add_argument("--update", action="store_true", help="read the tags of the files changed since the last update before querying")
+    parser.add_argument("--full", action="store_true", help="rebuild the index from the tags of every file")
+    parser.add_argument("--no-metadata", action="store_true", help="index only Finder tags, not the tags in the files' own metadata")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"number of files whose tags are read at once during an update (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--count", action="store_true", help="print only the number of matching files")
+    parser.add_argument("--tags", action="store_true", help="list the indexed tags and their number of files")
+    add_arguments(parser)
+    args = parser.parse_intermixed_args(argv)
+    configure_from_args(args)
+
+    # Only the results go to standard output, so that they can be piped into other commands;
+    # messages, the progress line and the summary go to standard error
+    results = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        folder_path = os.path.abspath(args.folder_path)
+        if not os.path.isdir(folder_path):
+            error(f"Not a folder: {folder_path}")
+            return 1
+        index = TagIndex(folder_path)
+        # A new index, or one made by an earlier version, is built before the first query
+        if args.update or args.full or index.is_empty():
+            index.close()
+            index = update_index(folder_path, full_scan=args.full, read_metadata=not args.no_metadata,
+                                 concurrency=max(1, args.concurrency))
+            metrics.print_summary()
+
+        try:
+            if args.tags:
+                for tag, count in index.tags():
+                    print(f"{count}\t{tag}", file=results)
+            if args.query:
+                start = time.perf_counter()
+                try:
+                    bitmap = index.query(args.query)
+                except ValueError as e:
+                    error(f"Invalid query: {e}", stage="query")
+                    return 1
+                if args.count:
+                    print(bitmap.bit_count(), file=results)
+                else:
+                    for file_path in index.paths(bitmap):
+                        print(file_path, file=results)
+                log(f"{bitmap.bit_count()} files in {(time.perf_counter() - start) * 1000:.1f} ms", NORMAL)
+        finally:
+            index.close()
+            metrics.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
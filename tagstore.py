@@ -0,0 +1,342 @@
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+import plistlib
+import subprocess
+from asyncrun import run_commands, DEFAULT_CONCURRENCY
+from metrics import log, error
+
+# Extended attribute in which macOS stores Finder tags as a binary plist array of strings
+FINDER_TAGS_XATTR = "com.apple.metadata:_kMDItemUserTags"
+
+# Linux only accepts user-defined extended attributes in the "user." namespace
+XATTR_NAME = FINDER_TAGS_XATTR if sys.platform == "darwin" else "user." + FINDER_TAGS_XATTR
+
+# errno values meaning "no such attribute" (ENOATTR on macOS, ENODATA on Linux)
+NO_ATTRIBUTE_ERRNOS = {getattr(errno, "ENOATTR", 93) if sys.platform == "darwin" else errno.ENODATA}
+
+# errno values meaning the filesystem does not support extended attributes
+UNSUPPORTED_ERRNOS = {errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM}
+
+# Number of paths read or written together by the bulk functions
+BULK_SIZE = 256
+
+class XattrUnavailable(Exception):
+    """Raised when Finder tags cannot be accessed through extended attributes."""
+
+def _load_libc():
+    """Load libc's xattr functions on macOS, where the os module does not expose them."""
+    if sys.platform != "darwin":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.getxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int]
+        libc.getxattr.restype = ctypes.c_ssize_t
+        libc.setxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int]
+        libc.setxattr.restype = ctypes.c_int
+        libc.removexattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+        libc.removexattr.restype = ctypes.c_int
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = None if hasattr(os, "getxattr") else _load_libc()
+
+def _raise_errno(file_path):
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), file_path)
+
+def _getxattr(file_path, name):
+    if hasattr(os, "getxattr"):
+        return os.getxattr(file_path, name)
+    if _libc is None:
+        raise XattrUnavailable("extended attributes are not supported on this platform")
+    path, attr = os.fsencode(file_path), name.encode("utf-8")
+    size = _libc.getxattr(path, attr, None, 0, 0, 0)
+    if size < 0:
+        _raise_errno(file_path)
+    buffer = ctypes.create_string_buffer(size)
+    size = _libc.getxattr(path, attr, buffer, size, 0, 0)
+    if size < 0:
+        _raise_errno(file_path)
+    return buffer.raw[:size]
+
+def _setxattr(file_path, name, value):
+    if hasattr(os, "setxattr"):
+        os.setxattr(file_path, name, value)
+        return
+    if _libc is None:
+        raise XattrUnavailable("extended attributes are not supported on this platform")
+    if _libc.setxattr(os.fsencode(file_path), name.encode("utf-8"), value, len(value), 0, 0) < 0:
+        _raise_errno(file_path)
+
+def _removexattr(file_path, name):
+    if hasattr(os, "removexattr"):
+        os.removexattr(file_path, name)
+        return
+    if _libc is None:
+        raise XattrUnavailable("extended attributes are not supported on this platform")
+    if _libc.removexattr(os.fsencode(file_path), name.encode("utf-8"), 0) < 0:
+        _raise_errno(file_path)
+
+def _read_raw_tags(file_path):
+    """Return the raw Finder tag strings of a file, including their "\\n<color>" suffixes."""
+    try:
+        data = _getxattr(file_path, XATTR_NAME)
+    except OSError as e:
+        if e.errno in NO_ATTRIBUTE_ERRNOS:
+            return []
+        if e.errno in UNSUPPORTED_ERRNOS:
+            raise XattrUnavailable(str(e))
+        raise
+    try:
+        raw_tags = plistlib.loads(data)
+    except plistlib.InvalidFileException:
+        return []
+    return [tag for tag in raw_tags if isinstance(tag, str)] if isinstance(raw_tags, list) else []
+
+def _tag_name(raw_tag):
+    # Finder appends "\n" and a color number to colored tags
+    return raw_tag.split("\n", 1)[0]
+
+def read_tags(file_path):
+    """Read the Finder tags of a file from its extended attribute."""
+    return [_tag_name(raw_tag) for raw_tag in _read_raw_tags(file_path)]
+
+def write_tags(file_path, tags):
+    """Write the Finder tags of a file to its extended attribute, keeping the colors of existing tags."""
+    try:
+        colors = {_tag_name(raw_tag): raw_tag for raw_tag in _read_raw_tags(file_path)}
+        if not tags:
+            if colors:
+                _removexattr(file_path, XATTR_NAME)
+            return
+        raw_tags = [colors.get(tag, tag) for tag in tags]
+        _setxattr(file_path, XATTR_NAME, plistlib.dumps(raw_tags, fmt=plistlib.FMT_BINARY))
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            raise XattrUnavailable(str(e))
+        raise
+
+def parse_tag_list(tags_str):
+    """Split the comma-separated tags printed by the tag command line tool."""
+    return [tag.strip() for tag in tags_str.split(",") if tag.strip()]
+
+def cli_read_tags(file_path):
+    """Read the Finder tags of a file using the tag command line tool."""
+    tag_cmd = ["tag", "--list", "--no-name", file_path]
+    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise OSError(result.stderr.strip())
+    return parse_tag_list(result.stdout.strip())
+
+def cli_write_tags(file_path, tags):
+    """Set the Finder tags of a file using the tag command line tool."""
+    tag_cmd = ["tag", "--set", ",".join(tags), file_path]
+    result = subprocess.run(tag_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise OSError(result.stderr.strip())
+
+def get_finder_tags(file_path):
+    """Get Finder tags from the file's extended attribute, falling back to the tag command line tool."""
+    try:
+        try:
+            tags = read_tags(file_path)
+        except XattrUnavailable:
+            tags = cli_read_tags(file_path)
+    except OSError as e:
+        error(f"Failed to get Finder tags for {file_path}: {e}", file_path, "finder tags")
+        return []
+    if len(tags) > 0:
+        log(f"Retrieved Finder tags for {file_path}: {', '.join(tags)}")
+    else:
+        log(f"No Finder tags found for {file_path}")
+    return tags
+
+def set_finder_tags(file_path, tags):
+    """Set Finder tags in the file's extended attribute, falling back to the tag command line tool."""
+    try:
+        try:
+            write_tags(file_path, tags)
+        except XattrUnavailable:
+            cli_write_tags(file_path, tags)
+    except OSError as e:
+        error(f"Failed to set Finder tags for {file_path}: {e}", file_path, "finder tags")
+        return False
+    log(f"Set Finder tags for {file_path}: {','.join(tags)}")
+    return True
+
+def chunked(iterable, size):
+    """Yield lists of at most size items from iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _argument_budget():
+    """Return how many bytes of paths can safely be passed on a single command line."""
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = 256 * 1024
+    environment_size = sum(len(key) + len(value) + 2 for key, value in os.environ.items())
+    # Leave half of the remaining space as headroom for pointers and the fixed arguments
+    return max(4096, (arg_max - environment_size) // 2)
+
+def chunk_arguments(paths):
+    """Split paths into lists that each fit within the ARG_MAX budget."""
+    budget = _argument_budget()
+    chunk, size = [], 0
+    for path in paths:
+        path_size = len(os.fsencode(path)) + 1 + ctypes.sizeof(ctypes.c_void_p)
+        if chunk and size + path_size > budget:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(path)
+        size += path_size
+    if chunk:
+        yield chunk
+
+def parse_bulk_list(output, paths):
+    """Match the NUL-terminated records of `tag --list --nul` to the paths passed on its command line.
+
+    tag prints one record per path, in argument order, made of the path followed by its
+    comma-separated tags. Paths it failed to read are missing from the output, so each record
+    is matched against the next paths in order rather than by position.
+    """
+    results = {}
+    index = 0
+    for record in output.split("\0"):
+        record = record.strip("\n")
+        if not record:
+            continue
+        for candidate in range(index, len(paths)):
+            path = paths[candidate]
+            rest = record[len(path):]
+            if record.startswith(path) and (not rest or rest[0] in "\t "):
+                results[path] = parse_tag_list(rest.strip())
+                index = candidate + 1
+                break
+    return results
+
+def cli_read_tags_bulk(paths, concurrency=DEFAULT_CONCURRENCY):
+    """Read the Finder tags of many files with as few tag invocations as the ARG_MAX limit allows.
+
+    The invocations for successive chunks of paths run concurrently.
+    """
+    chunks = list(chunk_arguments(paths))
+    results = {}
+    for chunk, result in zip(chunks, run_commands([["tag", "--list", "--nul"] + chunk for chunk in chunks], concurrency)):
+        if result.returncode != 0 and not result.stdout:
+            raise OSError(result.stderr.strip())
+        results.update(parse_bulk_list(result.stdout, chunk))
+    return results
+
+def cli_read_tags_each(paths, concurrency=DEFAULT_CONCURRENCY):
+    """Read the Finder tags of files with one concurrent tag invocation per file."""
+    results = {}
+    for file_path, result in zip(paths, run_commands([["tag", "--list", "--no-name", file_path] for file_path in paths], concurrency)):
+        if result.returncode != 0:
+            error(f"Failed to get Finder tags for {file_path}: {result.stderr.strip()}", file_path, "finder tags")
+            results[file_path] = []
+        else:
+            results[file_path] = parse_tag_list(result.stdout.strip())
+    return results
+
+def cli_write_tags_bulk(files_tags, concurrency=DEFAULT_CONCURRENCY):
+    """Set Finder tags with one tag invocation per distinct tag set and ARG_MAX-sized chunk of paths.
+
+    The invocations run concurrently.
+    """
+    groups = {}
+    for file_path, tags in files_tags.items():
+        groups.setdefault(tuple(tags), []).append(file_path)
+    commands = []
+    chunks = []
+    for tags, paths in groups.items():
+        for chunk in chunk_arguments(paths):
+            commands.append(["tag", "--set", ",".join(tags)] + chunk)
+            chunks.append(chunk)
+    results = {}
+    for chunk, result in zip(chunks, run_commands(commands, concurrency)):
+        if result.returncode != 0:
+            error(f"Failed to set Finder tags for {len(chunk)} files: {result.stderr.strip()}", stage="finder tags")
+        for file_path in chunk:
+            results[file_path] = result.returncode == 0
+    return results
+
+def get_finder_tags_bulk(paths, concurrency=DEFAULT_CONCURRENCY):
+    """Get the Finder tags of many files, reading extended attributes and batching any tag fallback.
+
+    At most concurrency tag invocations run at once.
+    """
+    results = {}
+    cli_paths = []
+    for file_path in paths:
+        try:
+            results[file_path] = read_tags(file_path)
+        except XattrUnavailable:
+            cli_paths.append(file_path)
+        except OSError as e:
+            error(f"Failed to get Finder tags for {file_path}: {e}", file_path, "finder tags")
+            results[file_path] = []
+
+    if cli_paths:
+        try:
+            cli_results = cli_read_tags_bulk(cli_paths, concurrency)
+        except OSError as e:
+            error(f"Failed to list Finder tags of {len(cli_paths)} files, reading them one by one: {e}", stage="finder tags")
+            cli_results = {}
+        # Read the files tag skipped (or every file with a tag without --nul) individually
+        missing_paths = [file_path for file_path in cli_paths if file_path not in cli_results]
+        if missing_paths:
+            try:
+                cli_results.update(cli_read_tags_each(missing_paths, concurrency))
+            except OSError as e:
+                error(f"Failed to get Finder tags for {len(missing_paths)} files: {e}", stage="finder tags")
+                cli_results.update({file_path: [] for file_path in missing_paths})
+        for file_path in cli_paths:
+            results[file_path] = cli_results[file_path]
+
+    for file_path in paths:
+        tags = results[file_path]
+        if len(tags) > 0:
+            log(f"Retrieved Finder tags for {file_path}: {', '.join(tags)}")
+        else:
+            log(f"No Finder tags found for {file_path}")
+    return results
+
+def set_finder_tags_bulk(files_tags, concurrency=DEFAULT_CONCURRENCY):
+    """Set the Finder tags of many files, returning whether each write succeeded.
+
+    At most concurrency tag invocations run at once.
+    """
+    results = {}
+    cli_files_tags = {}
+    for file_path, tags in files_tags.items():
+        try:
+            write_tags(file_path, tags)
+            results[file_path] = True
+        except XattrUnavailable:
+            cli_files_tags[file_path] = tags
+        except OSError as e:
+            error(f"Failed to set Finder tags for {file_path}: {e}", file_path, "finder tags")
+            results[file_path] = False
+
+    if cli_files_tags:
+        try:
+            results.update(cli_write_tags_bulk(cli_files_tags, concurrency))
+        except OSError as e:
+            error(f"Failed to set Finder tags of {len(cli_files_tags)} files: {e}", stage="finder tags")
+            results.update({file_path: False for file_path in cli_files_tags})
+
+    for file_path, tags in files_tags.items():
+        if results[file_path]:
+            log(f"Set Finder tags for {file_path}: {','.join(tags)}")
+    return results
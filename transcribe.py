@@ -0,0 +1,526 @@
+import os
+import json
+import time
+import queue
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from probe import probe_video, ProbeError
+from metrics import metrics, log, error, NORMAL
+
+# Whisper model used to transcribe the audio of videos
+WHISPER_MODEL = "base"
+
+# Sample rate of the audio Whisper takes
+SAMPLE_RATE = 16000
+
+# Length of the windows of audio decoded and transcribed at once when streaming
+WINDOW_SECONDS = 300
+
+# Length of the segments transcribed when a time budget is set (Whisper works on 30 second spans)
+DEFAULT_SEGMENT_SECONDS = 30
+
+# Voice activity detection: frames of 30 ms are speech when they are louder than an absolute
+# floor, not too far below the loudest frames around them, and have most of their energy in
+# the voice band (which leaves out most music, hum and noise)
+VAD_FRAME_SECONDS = 0.03
+VAD_FLOOR_DB = -50
+VAD_RELATIVE_DB = 35
+VAD_VOICE_BAND = (300, 3400)
+VAD_VOICE_BAND_RATIO = 0.5
+
+# Non-speech frames within this much of speech are kept, so that words and short pauses are not cut
+VAD_HANGOVER_SECONDS = 0.5
+
+# Windows with less speech than this are not transcribed
+VAD_MIN_SPEECH_SECONDS = 1
+
+# Whisper model loaded by this process (each transcription worker loads its own once)
+_whisper_model = None
+
+# Transcription worker processes kept between calls of transcribe_videos, so that a long-lived
+# process (such as main.py's background worker) only loads the Whisper models once
+_transcription_pool = None
+_transcription_pool_key = None
+
+# Queue on which the transcription workers announce each video they start, so that when one
+# dies, the videos it may have been transcribing can be told from those still waiting
+_transcription_started = None
+
+# Number of times a video is transcribed again after the worker transcribing it died
+WORKER_CRASH_RETRIES = 1
+
+def load_whisper_model(model_name=WHISPER_MODEL):
+    """Load the Whisper model once per process and return it."""
+    global _whisper_model
+    if _whisper_model is None:
+        # Whisper (and torch) are only imported once a video has to be transcribed
+        import whisper
+        _whisper_model = whisper.load_model(model_name)
+    return _whisper_model
+
+def extract_chapter_titles(video_file):
+    """Return the chapter titles of a video from its probe record."""
+    try:
+        return probe_video(video_file)["chapters"]
+    except (OSError, ProbeError) as e:
+        error(f"Failed to extract chapter titles from {video_file}: {e}", video_file, "probe")
+        return []
+
+def get_filename_without_extension(video_path):
+    """Extract the filename without extension from a video path."""
+    filename_with_extension = os.path.basename(video_path)  # Get the filename with extension
+    filename_without_extension = os.path.splitext(filename_with_extension)[0]  # Remove the extension
+    return filename_without_extension
+
+def extract_audio_with_original_format(video_path, output_dir):
+    """Extract audio from a video file, preserving the original format."""
+    # Get the audio codec from the video's probe record
+    try:
+        audio_codec = probe_video(video_path)["audio_codec"]
+    except (OSError, ProbeError) as e:
+        error(f"Failed to probe {video_path}: {e}", video_path, "probe")
+        audio_codec = None
+    
+    # Map codec to file extension
+    codec_to_extension = {
+        "aac": "m4a",  # Use m4a for AAC audio
+        "mp3": "mp3",
+        "vorbis": "ogg",
+        "opus": "opus",
+        "flac": "flac",
+        "pcm_s16le": "wav",
+    }
+    file_extension = codec_to_extension.get(audio_codec, "m4a")  # Default to m4a if unknown
+    
+    # Create the output directory if it doesn't exist
+    video_name_without_extension = get_filename_without_extension(video_path)
+    output_dir = os.path.join(output_dir, video_name_without_extension)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    audio_output_path = os.path.join(output_dir, f"{video_name_without_extension}.{file_extension}")
+
+    # Check if the audio file already exists
+    if os.path.exists(audio_output_path):
+        log(f"Audio already extracted: {audio_output_path}")
+        return audio_output_path
+
+    # Extract audio if it doesn't already exist
+    ffmpeg_cmd = [
+        "ffmpeg", "-i", video_path, "-vn", "-acodec", "copy", audio_output_path
+    ]
+    subprocess.run(ffmpeg_cmd, stdin=subprocess.DEVNULL)
+    return audio_output_path
+    
+def transcribe_audio_with_language_detection(audio_path, model=None, transcription_options=None, duration=None):
+    """Transcribe audio with language detection and save as JSON.
+
+    transcription_options holds the vad, budget and segment_seconds arguments of transcribe_audio_stream,
+    and duration the length of the audio, if known.
+    """
+    # Extract the file extension from audio_path
+    output_dir = os.path.dirname(audio_path)
+    output_json_path = os.path.join(output_dir, f"{get_filename_without_extension(audio_path)}_transcription.json")
+
+    
+    # Check if the transcription file already exists
+    if os.path.exists(output_json_path):
+        log(f"Transcription already exists: {output_json_path}")
+        return output_json_path
+    
+    if model is None:
+        model = load_whisper_model()
+    if transcription_options and (transcription_options.get("vad") or transcription_options.get("budget")):
+        # Only transcribe the speech, or part of the audio
+        transcription_data = transcribe_audio_stream(audio_path, model, duration=duration, **transcription_options)
+    else:
+        result = model.transcribe(audio_path)
+        detected_language = result.get("language", "unknown")
+        transcript = result["text"]
+
+        # Create the JSON structure
+        transcription_data = {
+            "language": detected_language,
+            "transcript": transcript
+        }
+
+    # Save the transcription data to a JSON file
+    with open(output_json_path, 'w') as json_file:
+        json.dump(transcription_data, json_file, ensure_ascii=False, indent=4)
+
+    log(f"Transcription saved to {output_json_path}")
+    return output_json_path
+
+def video_duration(video_path):
+    """Return the duration of a video (or audio file) in seconds, or None if it is unknown."""
+    try:
+        return probe_video(video_path)["duration"]
+    except (OSError, ProbeError):
+        return None
+
+def stream_audio(video_path, window_seconds=WINDOW_SECONDS, start=None, seconds=None):
+    """Decode the audio of a video with ffmpeg and yield it in windows of window_seconds.
+
+    The windows are float32 NumPy arrays of 16 kHz mono samples, as Whisper takes them, so the
+    audio is decoded once, on a pipe, without being written to disk or held in memory whole.
+    Only the given number of seconds from start are decoded, if given; ffmpeg seeks to start
+    without decoding what comes before.
+    """
+    ffmpeg_cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0"]
+    if start is not None:
+        ffmpeg_cmd += ["-ss", f"{start:.3f}"]
+    ffmpeg_cmd += ["-i", video_path]
+    if seconds is not None:
+        ffmpeg_cmd += ["-t", f"{seconds:.3f}"]
+    ffmpeg_cmd += ["-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+    window_bytes = int(window_seconds * SAMPLE_RATE) * 2
+    samples = 0
+    # ffmpeg's errors go to a file, as a full stderr pipe would block it
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = process.stdout.read(window_bytes)
+                if len(data) < 2:
+                    break
+                window = np.frombuffer(data[:len(data) // 2 * 2], np.int16).astype(np.float32) / 32768.0
+                samples += len(window)
+                yield window
+            if process.wait() != 0 and not samples:
+                stderr.seek(0)
+                message = stderr.read().decode(errors="replace").strip()
+                raise RuntimeError(f"ffmpeg could not decode the audio of {video_path}: {message}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+
+def read_ahead(iterator):
+    """Yield the items of iterator while a thread already produces the next one."""
+    items = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(("item", item)):
+                    return
+            put(("end", None))
+        except Exception as e:
+            put(("error", e))
+        finally:
+            iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def speech_frames(samples):
+    """Return which VAD_FRAME_SECONDS frames of 16 kHz samples hold speech, by their energy and spectrum."""
+    frame_length = int(VAD_FRAME_SECONDS * SAMPLE_RATE)
+    frames = samples[:len(samples) // frame_length * frame_length].reshape(-1, frame_length)
+    if not len(frames):
+        return np.zeros(0, dtype=bool)
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_length).astype(np.float32), axis=1)) ** 2
+    frequencies = np.fft.rfftfreq(frame_length, 1 / SAMPLE_RATE)
+    in_band = (frequencies >= VAD_VOICE_BAND[0]) & (frequencies <= VAD_VOICE_BAND[1])
+    band_ratio = spectrum[:, in_band].sum(axis=1) / (spectrum.sum(axis=1) + 1e-10)
+    speech = ((energy_db > VAD_FLOOR_DB)
+              & (energy_db > np.percentile(energy_db, 95) - VAD_RELATIVE_DB)
+              & (band_ratio > VAD_VOICE_BAND_RATIO))
+    hangover = int(VAD_HANGOVER_SECONDS / VAD_FRAME_SECONDS)
+    return np.convolve(speech, np.ones(2 * hangover + 1), mode="same") > 0
+
+def speech_audio(samples):
+    """Return the speech of 16 kHz samples, with the silence and music between it cut out."""
+    frame_length = int(VAD_FRAME_SECONDS * SAMPLE_RATE)
+    speech = speech_frames(samples)
+    return samples[:len(speech) * frame_length].reshape(-1, frame_length)[speech].ravel()
+
+def sample_segments(duration, budget, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    """Return the (start, seconds) of evenly spaced segments of a recording adding up to budget seconds.
+
+    Returns None when the budget covers the whole recording.
+    """
+    if duration is None or budget >= duration:
+        return None
+    # Whole seconds, at least one, as the budget may be a fraction of a minute
+    seconds = max(1, int(min(segment_seconds, budget)))
+    count = max(1, int(budget // seconds))
+    spacing = duration / count
+    return [(i * spacing + (spacing - seconds) / 2, seconds) for i in range(count)]
+
+def transcribe_audio_stream(video_path, model=None, vad=False, budget=None, segment_seconds=DEFAULT_SEGMENT_SECONDS,
+                            window_seconds=WINDOW_SECONDS, duration=None):
+    """Transcribe the audio of a video streamed from ffmpeg and return its language and transcript.
+
+    The language is detected on the first window and used for the following ones. Each window
+    is decoded while Whisper transcribes the previous one. With vad, only the speech of each
+    window is transcribed. With a budget (in seconds), only that much of the audio is decoded
+    and transcribed, in evenly spaced segments of segment_seconds, or from the start when the
+    duration of the video is unknown. The duration is probed unless given. The result also
+    holds the number of seconds of audio decoded and transcribed.
+    """
+    if model is None:
+        model = load_whisper_model()
+    segments = None
+    if budget:
+        if duration is None:
+            duration = video_duration(video_path)
+        segments = sample_segments(duration, budget, segment_seconds)
+    if segments is not None:
+        windows = (window for start, seconds in segments for window in stream_audio(video_path, seconds, start, seconds))
+    else:
+        windows = stream_audio(video_path, window_seconds)
+    windows = read_ahead(windows)
+    language = None
+    texts = []
+    audio_seconds = 0
+    transcribed_seconds = 0
+    try:
+        for window in windows:
+            audio_seconds += len(window) / SAMPLE_RATE
+            if vad:
+                window = speech_audio(window)
+                if len(window) < VAD_MIN_SPEECH_SECONDS * SAMPLE_RATE:
+                    continue
+            if budget and segments is None:
+                window = window[:int((budget - transcribed_seconds) * SAMPLE_RATE)]
+            result = model.transcribe(window, language=language)
+            language = language or result.get("language")
+            texts.append(result["text"].strip())
+            transcribed_seconds += len(window) / SAMPLE_RATE
+            if budget and segments is None and transcribed_seconds >= budget:
+                break
+    finally:
+        windows.close()
+    if not audio_seconds:
+        raise RuntimeError(f"No audio found in {video_path}")
+    return {
+        "language": language or "unknown",
+        "transcript": " ".join(text for text in texts if text),
+        "audio_seconds": round(audio_seconds, 1),
+        "transcribed_seconds": round(transcribed_seconds, 1),
+    }
+
+def prepare_video(video_path, keep_audio=False):
+    """Probe the chapter titles and duration of a video, and with keep_audio extract its audio track next to it.
+
+    Returns the chapter titles, the duration (None if unknown) and the path of the extracted
+    audio, or None when the audio is to be streamed from the video.
+    """
+    with metrics.stage("probe", video_path):
+        chapter_titles = extract_chapter_titles(video_path)
+        # From the same probe record
+        duration = video_duration(video_path)
+    audio_path = None
+    if keep_audio:
+        with metrics.stage("extract audio", video_path):
+            audio_path = extract_audio_with_original_format(video_path, os.path.dirname(video_path))
+    return chapter_titles, duration, audio_path
+
+def transcribe_prepared(video_path, audio_path, model=None, transcription_options=None, duration=None):
+    """Transcribe a video prepared by prepare_video.
+
+    Returns the path of the transcription JSON saved next to the extracted audio, if any, or
+    else the transcription itself (see video_text in tag.py). transcription_options holds the
+    vad, budget and segment_seconds arguments of transcribe_audio_stream, and duration the one
+    prepare_video probed, so that it is not probed again.
+    """
+    if audio_path is not None:
+        return transcribe_audio_with_language_detection(audio_path, model, transcription_options, duration)
+    return transcribe_audio_stream(video_path, model, duration=duration, **(transcription_options or {}))
+
+def transcribe_video(video_path, model=None, keep_audio=False, transcription_options=None):
+    """Return the chapter titles and the transcription of a video (see transcribe_prepared)."""
+    chapter_titles, duration, audio_path = prepare_video(video_path, keep_audio)
+    return chapter_titles, transcribe_prepared(video_path, audio_path, model, transcription_options, duration)
+
+def _init_transcription_worker(model_name, verbosity, started):
+    global _transcription_started
+    metrics.verbosity = verbosity
+    _transcription_started = started
+    load_whisper_model(model_name)
+
+def _transcribe_in_worker(video_path, audio_path, transcription_options, duration):
+    _transcription_started.put(video_path)
+    start = time.perf_counter()
+    # The parent probed the video already: the worker's own probe cache is empty
+    transcription = transcribe_prepared(video_path, audio_path, transcription_options=transcription_options, duration=duration)
+    return transcription, time.perf_counter() - start
+
+def get_transcription_pool(whisper_workers=1, model_name=WHISPER_MODEL):
+    """Return the pool of transcription processes, starting it (again) if its settings changed."""
+    global _transcription_pool, _transcription_pool_key, _transcription_started
+    key = (whisper_workers, model_name, metrics.verbosity)
+    if _transcription_pool is None or _transcription_pool_key != key:
+        close_transcription_pool()
+        # Spawn the workers so they do not inherit the parent's model or tokenizer state
+        context = multiprocessing.get_context("spawn")
+        _transcription_started = context.Queue()
+        _transcription_pool = ProcessPoolExecutor(max_workers=whisper_workers, mp_context=context,
+                                                  initializer=_init_transcription_worker,
+                                                  initargs=(model_name, metrics.verbosity, _transcription_started))
+        _transcription_pool_key = key
+    return _transcription_pool
+
+def started_transcriptions():
+    """Return the videos the transcription workers started since the last call."""
+    started = []
+    while _transcription_started is not None:
+        try:
+            started.append(_transcription_started.get_nowait())
+        except queue.Empty:
+            break
+    return started
+
+def close_transcription_pool():
+    """Shut the transcription processes down."""
+    global _transcription_pool, _transcription_pool_key, _transcription_started
+    if _transcription_pool is not None:
+        _transcription_pool.shutdown()
+        _transcription_pool = None
+        _transcription_pool_key = None
+        _transcription_started.close()
+        _transcription_started = None
+
+def transcribe_videos(video_paths, extract_workers=2, whisper_workers=1, queue_size=None, model_name=WHISPER_MODEL,
+                      keep_audio=False, transcription_options=None):
+    """Extract and transcribe videos in a staged pipeline.
+
+    A thread pool of extract_workers runs ffprobe to get the chapter titles and duration of each
+    video (and with keep_audio, ffmpeg to copy its audio track next to it), and hands the video
+    over to whisper_workers long-lived processes which each load the Whisper model once and are
+    kept for the next call. They stream the audio from ffmpeg, or read the copy, without probing
+    the video again. At most queue_size prepared videos wait for a transcription worker.
+    transcription_options can make them skip the silence or only transcribe part of each video
+    (see transcribe_audio_stream). When a worker dies (for instance out of memory), the pool is
+    started again and the videos in flight are transcribed again; only a video whose worker
+    died more than WORKER_CRASH_RETRIES times while transcribing it fails.
+
+    Yields (video_path, chapter_titles, transcription, error) in completion order, with the
+    transcription as returned by transcribe_prepared; error is None when the video was transcribed.
+    """
+    if queue_size is None:
+        queue_size = 2 * whisper_workers
+    max_in_flight = extract_workers + whisper_workers + queue_size
+    video_paths = iter(video_paths)
+    extracting = {}
+    # Videos being transcribed by future, and their chapter titles, duration and audio by path
+    transcribing = {}
+    prepared = {}
+    started = set()
+    crashes = Counter()
+    transcribers = get_transcription_pool(whisper_workers, model_name)
+
+    def submit(video_path):
+        _, duration, audio_path = prepared[video_path]
+        transcribing[transcribers.submit(_transcribe_in_worker, video_path, audio_path, transcription_options, duration)] = video_path
+
+    def restart(lost_paths):
+        """Start a new pool after a worker died, and submit the videos it lost again.
+
+        Only the videos a worker had started can have brought it down: they are given up, and
+        returned, once they were running during more than WORKER_CRASH_RETRIES crashes.
+        """
+        nonlocal transcribers
+        started.update(started_transcriptions())
+        close_transcription_pool()
+        transcribers = get_transcription_pool(whisper_workers, model_name)
+        failed = []
+        for video_path in lost_paths:
+            if video_path in started:
+                started.discard(video_path)
+                crashes[video_path] += 1
+                if crashes[video_path] > WORKER_CRASH_RETRIES:
+                    failed.append(video_path)
+                    continue
+                log(f"Transcribing {video_path} again after its transcription worker died", NORMAL)
+            submit(video_path)
+        return failed
+
+    def lost_futures():
+        """Pop the futures of the broken pool that did not complete, and return their videos."""
+        lost = [future for future in transcribing if not future.done() or isinstance(future.exception(), BrokenProcessPool)]
+        return [transcribing.pop(future) for future in lost]
+
+    with ThreadPoolExecutor(max_workers=extract_workers) as extractors:
+        exhausted = False
+        while True:
+            while not exhausted and len(extracting) + len(transcribing) < max_in_flight:
+                video_path = next(video_paths, None)
+                if video_path is None:
+                    exhausted = True
+                    break
+                extracting[extractors.submit(prepare_video, video_path, keep_audio)] = video_path
+            if not extracting and not transcribing:
+                break
+
+            done, _ = wait(list(extracting) + list(transcribing), return_when=FIRST_COMPLETED)
+            started.update(started_transcriptions())
+            broken = []
+            for future in done:
+                if future in extracting:
+                    video_path = extracting.pop(future)
+                    try:
+                        chapter_titles, duration, audio_path = future.result()
+                    except Exception as e:
+                        yield video_path, [], None, e
+                        continue
+                    if audio_path is not None:
+                        log(f"Audio extracted from {video_path} to {audio_path}")
+                    prepared[video_path] = (chapter_titles, duration, audio_path)
+                    try:
+                        submit(video_path)
+                    except BrokenProcessPool:
+                        broken.append(video_path)
+                    except Exception as e:
+                        yield video_path, prepared.pop(video_path)[0], None, e
+                elif future in transcribing:
+                    video_path = transcribing.pop(future)
+                    try:
+                        transcription, seconds = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (for instance out of memory), and with it every video in flight
+                        broken.append(video_path)
+                        continue
+                    except Exception as e:
+                        started.discard(video_path)
+                        yield video_path, prepared.pop(video_path)[0], None, e
+                        continue
+                    started.discard(video_path)
+                    metrics.record("transcribe", seconds, video_path)
+                    if isinstance(transcription, dict) and "audio_seconds" in transcription:
+                        metrics.count("audio seconds", round(transcription["audio_seconds"]))
+                        metrics.count("transcribed seconds", round(transcription["transcribed_seconds"]))
+                    yield video_path, prepared.pop(video_path)[0], transcription, None
+            if broken:
+                for video_path in restart(broken + lost_futures()):
+                    yield video_path, prepared.pop(video_path)[0], None, BrokenProcessPool(
+                        f"The transcription worker died {crashes[video_path]} times while transcribing {video_path}")
@@ -0,0 +1,392 @@
+import os
+import struct
+import subprocess
+from probe import probe_video, ProbeError
+from manifest import TEMP_MARKER
+from metrics import log, error, NORMAL
+
+# MP4 boxes that only hold other boxes on the way from moov to the iTunes metadata list
+MP4_COMMENT_PATH = [b"udta", b"meta", b"ilst"]
+
+# iTunes metadata item holding the comment, as written by ffmpeg's "comment" key
+MP4_COMMENT_ITEM = b"\xa9cmt"
+
+# Top-level MP4 boxes that are padding and can be overwritten
+MP4_PADDING_BOXES = (b"free", b"skip")
+
+# Matroska element IDs
+EBML_HEADER_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+CLUSTER_ID = 0x1F43B675
+TAGS_ID = 0x1254C367
+TAG_ID = 0x7373
+TARGETS_ID = 0x63C0
+SIMPLE_TAG_ID = 0x67C8
+TAG_NAME_ID = 0x45A3
+TAG_STRING_ID = 0x4487
+VOID_ID = 0xEC
+
+# Targets children that attach a tag to a track, edition, chapter or attachment instead of the whole file
+TARGET_UID_IDS = (0x63C5, 0x63C9, 0x63C4, 0x63C6)
+
+# ffmpeg output format of each video extension, for remuxing to a temporary file without one
+REMUX_FORMATS = {".mp4": "mp4", ".mkv": "matroska", ".webm": "webm"}
+
+# Size value reserved by EBML for elements of unknown size (e.g. live streams)
+EBML_UNKNOWN_SIZE = object()
+
+def add_tags_to_video_metadata(video_path, tags):
+    """Add generated tags to the metadata of the video.
+
+    Returns False when the comment already held the tags and nothing was written, and raises
+    RuntimeError when they could not be written.
+    """
+    tags_str = ", ".join(tags)
+    try:
+        if probe_video(video_path)["comment"] == tags_str:
+            log(f"Video metadata already up to date: {video_path}")
+            return False
+    except (OSError, ProbeError) as e:
+        error(f"Failed to probe {video_path}: {e}", video_path, "probe")
+    if write_video_comment_in_place(video_path, tags_str):
+        log(f"Updated metadata in place: {video_path}")
+    else:
+        remux_with_comment(video_path, tags_str)
+    return True
+
+def write_video_comment_in_place(video_path, comment):
+    """Rewrite only the comment metadata of an MP4 or Matroska/WebM file, if its layout allows it."""
+    try:
+        if video_path.endswith(".mp4"):
+            return write_mp4_comment_in_place(video_path, comment)
+        if video_path.endswith((".mkv", ".webm")):
+            return write_matroska_comment_in_place(video_path, comment)
+    except (OSError, ValueError, struct.error) as e:
+        log(f"Failed to update metadata in place for {video_path}, remuxing it instead: {e}", NORMAL)
+    return False
+
+def remux_with_comment(video_path, comment):
+    """Copy the streams of a video to a temporary file with the new comment, then atomically replace it.
+
+    Raises RuntimeError when ffmpeg fails, leaving the video as it was. The temporary file does
+    not end with a video extension, so that the folder scan and the watcher never take it for a
+    video to tag; ffmpeg is told the output format instead.
+    """
+    root, file_name = os.path.split(video_path)
+    extension = os.path.splitext(file_name)[1].lower()
+    temp_path = os.path.join(root, f".{file_name}{TEMP_MARKER}")
+    ffmpeg_cmd = [
+        "ffmpeg", "-loglevel", "quiet", "-y", "-nostdin", "-i", video_path, "-map", "0", "-map_metadata", "0",
+        "-metadata", f"comment={comment}", "-c", "copy", "-f", REMUX_FORMATS.get(extension, "matroska"), temp_path
+    ]
+    result = subprocess.run(ffmpeg_cmd)
+    if result.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise RuntimeError(f"ffmpeg failed to write the metadata of {video_path}")
+    os.replace(temp_path, video_path)
+
+def _write_region(file, start, data, truncate=False):
+    """Write data at start and flush it to disk, cutting the file right after it if truncate is set."""
+    file.seek(start)
+    file.write(data)
+    if truncate:
+        file.truncate(start + len(data))
+    file.flush()
+    os.fsync(file.fileno())
+    return True
+
+# ---------------------------------------------------------------------------
+# MP4
+# ---------------------------------------------------------------------------
+
+def _mp4_box(box_type, payload):
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+def _mp4_header(data, offset, end):
+    """Return (box_type, header_size, box_end) for the box starting at offset in data."""
+    size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+    header_size = 8
+    if size == 1:
+        size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_size or offset + size > end:
+        raise ValueError(f"invalid {box_type!r} box")
+    return box_type, header_size, offset + size
+
+def _mp4_children_offset(box_type, box, header_size):
+    """Return where the children of a container box start."""
+    if box_type == b"meta":
+        # ISO meta boxes carry version and flags before their children, QuickTime ones do not
+        if box[header_size + 4:header_size + 8] != b"hdlr":
+            return header_size + 4
+    return header_size
+
+def _mp4_children(box, start):
+    children = []
+    offset = start
+    while offset + 8 <= len(box):
+        box_type, _, box_end = _mp4_header(box, offset, len(box))
+        children.append((box_type, box[offset:box_end]))
+        offset = box_end
+    return children
+
+def _mp4_empty_box(box_type):
+    if box_type == b"meta":
+        # Full box with the handler that marks the iTunes metadata list
+        handler = _mp4_box(b"hdlr", b"\x00" * 8 + b"mdir" + b"appl" + b"\x00" * 8 + b"\x00")
+        return _mp4_box(b"meta", b"\x00" * 4 + handler)
+    return _mp4_box(box_type, b"")
+
+def _mp4_edit(box, path, edit):
+    """Return box with the descendant at path (created if missing) replaced by edit(descendant)."""
+    if not path:
+        return edit(box)
+    box_type, header_size, _ = _mp4_header(box, 0, len(box))
+    children_offset = _mp4_children_offset(box_type, box, header_size)
+    children = _mp4_children(box, children_offset)
+    for index, (child_type, child) in enumerate(children):
+        if child_type == path[0]:
+            children[index] = (child_type, _mp4_edit(child, path[1:], edit))
+            break
+    else:
+        children.append((path[0], _mp4_edit(_mp4_empty_box(path[0]), path[1:], edit)))
+    prefix = box[header_size:children_offset]
+    return _mp4_box(box_type, prefix + b"".join(child for _, child in children))
+
+def set_mp4_comment(moov, comment):
+    """Return a copy of a moov box whose iTunes metadata list holds comment."""
+    item = _mp4_box(MP4_COMMENT_ITEM, _mp4_box(b"data", struct.pack(">II", 1, 0) + comment.encode("utf-8")))
+
+    def edit_ilst(ilst):
+        children = [child for child_type, child in _mp4_children(ilst, 8) if child_type != MP4_COMMENT_ITEM]
+        return _mp4_box(b"ilst", b"".join(children) + item)
+
+    return _mp4_edit(moov, MP4_COMMENT_PATH, edit_ilst)
+
+def _mp4_top_level_boxes(file, file_size):
+    """Return (box_type, start, end) for the top-level boxes of an MP4 file without reading their payloads."""
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        file.seek(offset)
+        header = file.read(16)
+        box_type, _, box_end = _mp4_header(header + b"\x00" * (16 - len(header)), 0, file_size - offset)
+        boxes.append((box_type, offset, offset + box_end))
+        offset += box_end
+    return boxes
+
+def write_mp4_comment_in_place(video_path, comment):
+    """Rewrite the moov box of an MP4 file with a new comment without moving the media data.
+
+    The new moov is written over the old one and any padding boxes that follow it. It may only
+    grow into that padding, or freely when it is the last box of the file. Any space left over
+    is turned into a free box.
+    """
+    with open(video_path, "r+b") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        boxes = _mp4_top_level_boxes(file, file_size)
+        moov_index = next((index for index, box in enumerate(boxes) if box[0] == b"moov"), None)
+        if moov_index is None:
+            return False
+        _, moov_start, moov_end = boxes[moov_index]
+        region_end = moov_end
+        for box_type, _, box_end in boxes[moov_index + 1:]:
+            if box_type not in MP4_PADDING_BOXES:
+                break
+            region_end = box_end
+
+        file.seek(moov_start)
+        moov = set_mp4_comment(file.read(moov_end - moov_start), comment)
+        if region_end == file_size:
+            return _write_region(file, moov_start, moov, truncate=True)
+        padding = region_end - moov_start - len(moov)
+        if padding == 0:
+            return _write_region(file, moov_start, moov)
+        if padding >= 8:
+            return _write_region(file, moov_start, moov + _mp4_box(b"free", b"\x00" * (padding - 8)))
+        return False
+
+# ---------------------------------------------------------------------------
+# Matroska / WebM
+# ---------------------------------------------------------------------------
+
+def _read_vint(data, offset, keep_marker):
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML variable-size integer")
+    if len(data) < offset + length:
+        raise ValueError("truncated EBML variable-size integer")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[offset + 1:offset + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = EBML_UNKNOWN_SIZE
+    return value, offset + length
+
+def _encode_size(size, width=None):
+    """Encode an element size as an EBML variable-size integer of the minimal (or given) width."""
+    if width is None:
+        width = 1
+        while size >= (1 << (7 * width)) - 1:
+            width += 1
+    if width > 8 or size >= (1 << (7 * width)) - 1:
+        raise ValueError(f"size {size} does not fit in {width} bytes")
+    return (size | (1 << (7 * width))).to_bytes(width, "big")
+
+def _encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+
+def _ebml_element(element_id, payload, size_width=None):
+    return _encode_id(element_id) + _encode_size(len(payload), size_width) + payload
+
+def _ebml_void(total_size):
+    """Return a Void element of exactly total_size bytes (at least 2)."""
+    for width in range(1, 9):
+        payload_size = total_size - 1 - width
+        if payload_size >= 0 and payload_size < (1 << (7 * width)) - 1:
+            return _ebml_element(VOID_ID, b"\x00" * payload_size, width)
+    raise ValueError(f"cannot build a Void element of {total_size} bytes")
+
+def _ebml_children(data):
+    """Return (element_id, payload) for the elements in data."""
+    children = []
+    offset = 0
+    while offset < len(data):
+        element_id, offset = _read_vint(data, offset, True)
+        size, offset = _read_vint(data, offset, False)
+        if size is EBML_UNKNOWN_SIZE or offset + size > len(data):
+            raise ValueError("invalid element inside Tags")
+        children.append((element_id, data[offset:offset + size]))
+        offset += size
+    return children
+
+def _is_global_tag(tag_payload):
+    for element_id, payload in _ebml_children(tag_payload):
+        if element_id == TARGETS_ID:
+            return not any(child_id in TARGET_UID_IDS for child_id, _ in _ebml_children(payload))
+    return True
+
+def _is_comment(simple_tag_payload):
+    for element_id, payload in _ebml_children(simple_tag_payload):
+        if element_id == TAG_NAME_ID:
+            return payload.decode("utf-8", "replace").upper() == "COMMENT"
+    return False
+
+def set_matroska_comment(tags_payload, comment):
+    """Return the payload of a Tags element whose file-level COMMENT tag is set to comment."""
+    simple_tag = _ebml_element(SIMPLE_TAG_ID, _ebml_element(TAG_NAME_ID, b"COMMENT") +
+                               _ebml_element(TAG_STRING_ID, comment.encode("utf-8")))
+    tags = []
+    replaced = False
+    for element_id, payload in _ebml_children(tags_payload):
+        if element_id == TAG_ID and not replaced and _is_global_tag(payload):
+            children = [
+                _ebml_element(child_id, child)
+                for child_id, child in _ebml_children(payload)
+                if not (child_id == SIMPLE_TAG_ID and _is_comment(child))
+            ]
+            payload = b"".join(children) + simple_tag
+            replaced = True
+        tags.append(_ebml_element(element_id, payload))
+    if not replaced:
+        tags.append(_ebml_element(TAG_ID, _ebml_element(TARGETS_ID, b"") + simple_tag))
+    return b"".join(tags)
+
+def _fit_element(element_id, payload, region_size):
+    """Return the element followed by Void padding so that it fills exactly region_size bytes, or None."""
+    element = _ebml_element(element_id, payload)
+    padding = region_size - len(element)
+    if padding == 0:
+        return element
+    if padding >= 2:
+        return element + _ebml_void(padding)
+    if padding == 1:
+        # Too small for a Void element: encode the size one byte wider instead
+        width = len(_encode_size(len(payload))) + 1
+        if width <= 8:
+            return _ebml_element(element_id, payload, width)
+    return None
+
+def _read_element_header(file, offset):
+    file.seek(offset)
+    header = file.read(12)
+    element_id, position = _read_vint(header, 0, True)
+    size, position = _read_vint(header, position, False)
+    return element_id, size, offset + position
+
+def write_matroska_comment_in_place(video_path, comment):
+    """Rewrite the Tags element of a Matroska/WebM file with a new comment without moving the clusters.
+
+    The new Tags element replaces the old one together with any Void elements that follow it, or
+    is written into a Void element placed before the first cluster when the file has no Tags yet.
+    It may also grow freely when it is the last element of the file.
+    """
+    with open(video_path, "r+b") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        element_id, size, data_start = _read_element_header(file, 0)
+        if element_id != EBML_HEADER_ID or size is EBML_UNKNOWN_SIZE:
+            return False
+        segment_start = data_start + size
+        element_id, segment_size, segment_data_start = _read_element_header(file, segment_start)
+        if element_id != SEGMENT_ID:
+            return False
+        if segment_size is EBML_UNKNOWN_SIZE:
+            segment_end = file_size
+        else:
+            segment_end = min(segment_data_start + segment_size, file_size)
+
+        # List the top-level elements of the segment without reading their payloads
+        elements = []
+        offset = segment_data_start
+        while offset < segment_end:
+            element_id, size, data_start = _read_element_header(file, offset)
+            if size is EBML_UNKNOWN_SIZE:
+                # The rest of the segment cannot be walked (live-streamed clusters)
+                break
+            elements.append((element_id, offset, data_start, data_start + size))
+            offset = data_start + size
+
+        tags_index = next((index for index, element in enumerate(elements) if element[0] == TAGS_ID), None)
+        if tags_index is not None:
+            _, tags_start, tags_data_start, tags_end = elements[tags_index]
+            file.seek(tags_data_start)
+            payload = set_matroska_comment(file.read(tags_end - tags_data_start), comment)
+            region_end = tags_end
+            for element_id, _, _, element_end in elements[tags_index + 1:]:
+                if element_id != VOID_ID:
+                    break
+                region_end = element_end
+        else:
+            # Use the first Void element ahead of the clusters that is large enough
+            payload = set_matroska_comment(b"", comment)
+            needed = len(_ebml_element(TAGS_ID, payload))
+            tags_start = region_end = None
+            for element_id, element_start, _, element_end in elements:
+                if element_id == CLUSTER_ID:
+                    break
+                if element_id == VOID_ID and (element_end - element_start == needed or element_end - element_start >= needed + 2):
+                    tags_start, region_end = element_start, element_end
+                    break
+            if tags_start is None:
+                return False
+
+        if region_end == file_size and region_end == segment_end:
+            # Last element of the file: grow or shrink the file and the segment with it
+            element = _ebml_element(TAGS_ID, payload)
+            if segment_size is EBML_UNKNOWN_SIZE:
+                return _write_region(file, tags_start, element, truncate=True)
+            size_offset = segment_start + len(_encode_id(SEGMENT_ID))
+            segment_size_field = _encode_size(tags_start + len(element) - segment_data_start, segment_data_start - size_offset)
+            _write_region(file, tags_start, element, truncate=True)
+            return _write_region(file, size_offset, segment_size_field)
+
+        element = _fit_element(TAGS_ID, payload, region_end - tags_start)
+        if element is None:
+            return False
+        return _write_region(file, tags_start, element)
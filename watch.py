@@ -0,0 +1,386 @@
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import argparse
+from contextlib import contextmanager
+from manifest import Manifest, scan_folder, is_supported
+from journal import RunJournal
+from tag import process_files, add_tagging_arguments, tagging_options
+from metrics import metrics, log, error, add_arguments, configure_from_args, NORMAL
+
+# Seconds without any event on a file before it is checked, and seconds its size and mtime
+# must stay the same across two checks before it is tagged
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_SETTLE = 2.0
+
+# Seconds between two scans of the directories by the polling watcher
+DEFAULT_POLL_INTERVAL = 10.0
+
+# Longest time the daemon waits for events before checking the pending files again
+TICK = 0.5
+
+# Events of the inotify API (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyWatcher:
+    """Report the supported files created, modified or moved under some folders, using inotify.
+
+    Every directory gets its own watch; directories created or moved in are watched as they
+    appear and the files already in them are reported. Raises OSError when inotify is not
+    available (for instance on macOS) or when the watch limit is reached.
+    """
+
+    def __init__(self, roots):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if self.libc is None or not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.roots = roots
+        self.directories = {}
+        try:
+            for root in roots:
+                self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                raise OSError(code, "inotify watch limit reached (see /proc/sys/fs/inotify/max_user_watches)")
+            if code not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(code, os.strerror(code), directory)
+            return
+        self.directories[wd] = directory
+
+    def _watch_tree(self, root):
+        """Watch a directory and its sub-directories, and return the supported files already in them."""
+        file_paths = []
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            self._watch(directory)
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and is_supported(entry.name):
+                        file_paths.append(entry.path)
+                except OSError:
+                    continue
+        return file_paths
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return the paths of the files that changed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        file_paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: report every file and let the manifest tell which ones changed
+                log("Too many events, rescanning the watched folders", NORMAL)
+                for root in self.roots:
+                    file_paths.extend(file_path for file_path, stat in scan_folder(root))
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    file_paths.extend(self._watch_tree(path))
+            elif mask & (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) and is_supported(name):
+                file_paths.append(path)
+        return file_paths
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Report the supported files added to some folders by checking the directories' mtimes.
+
+    Only the directories whose mtime changed since the previous scan are listed again, so files
+    modified in place without being replaced are not noticed (they are at the next tag.py run).
+    """
+
+    def __init__(self, roots, interval=DEFAULT_POLL_INTERVAL):
+        self.roots = roots
+        self.interval = interval
+        self.directories = {}
+        self.files = {}
+        self.last_scan = time.monotonic()
+        for root in roots:
+            self._add_tree(root)
+
+    def _list(self, directory):
+        """Record a directory's mtime and its files' size and mtime, and return its new sub-directories and changed files."""
+        stat = os.stat(directory)
+        self.directories[directory] = stat.st_mtime_ns
+        new_directories = []
+        file_paths = []
+        for entry in os.scandir(directory):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in self.directories:
+                        new_directories.append(entry.path)
+                elif entry.is_file() and is_supported(entry.name):
+                    entry_stat = entry.stat()
+                    state = (entry_stat.st_size, entry_stat.st_mtime_ns)
+                    if self.files.get(entry.path) != state:
+                        self.files[entry.path] = state
+                        file_paths.append(entry.path)
+            except OSError:
+                continue
+        return new_directories, file_paths
+
+    def _add_tree(self, root):
+        file_paths = []
+        stack = [root]
+        while stack:
+            try:
+                new_directories, new_files = self._list(stack.pop())
+            except OSError:
+                continue
+            stack.extend(new_directories)
+            file_paths.extend(new_files)
+        return file_paths
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return the paths of the files that changed."""
+        remaining = self.interval - (time.monotonic() - self.last_scan)
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            return []
+        self.last_scan = time.monotonic()
+        file_paths = []
+        for directory, mtime_ns in list(self.directories.items()):
+            try:
+                if os.stat(directory).st_mtime_ns == mtime_ns:
+                    continue
+                new_directories, new_files = self._list(directory)
+            except OSError:
+                # The directory is gone: forget it along with its files
+                del self.directories[directory]
+                prefix = directory + os.sep
+                for file_path in [file_path for file_path in self.files if file_path.startswith(prefix)]:
+                    del self.files[file_path]
+                continue
+            file_paths.extend(new_files)
+            for new_directory in new_directories:
+                file_paths.extend(self._add_tree(new_directory))
+        return file_paths
+
+    def close(self):
+        pass
+
+def make_watcher(roots, poll_interval=DEFAULT_POLL_INTERVAL, polling=False):
+    """Return an inotify watcher for roots, or a polling watcher where inotify cannot be used."""
+    if not polling:
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            log(f"Watching by polling every {poll_interval:g}s ({e})", NORMAL)
+    return PollingWatcher(roots, poll_interval)
+
+class PendingFiles:
+    """Files waiting for their events to stop and their content to settle before being tagged.
+
+    A file is ready once no event was seen on it for debounce seconds and its size and mtime
+    were the same in two checks at least settle seconds apart, so that files still being
+    copied or scanned in are left alone.
+    """
+
+    def __init__(self, debounce=DEFAULT_DEBOUNCE, settle=DEFAULT_SETTLE):
+        self.debounce = debounce
+        self.settle = settle
+        self.files = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def touch(self, file_path, now=None):
+        """Record an event on a file."""
+        now = time.monotonic() if now is None else now
+        entry = self.files.setdefault(file_path, {"event": now, "checked": None, "state": None})
+        entry["event"] = now
+
+    def ready(self, now=None):
+        """Return (file_path, stat) for the files that settled, and forget them."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for file_path, entry in list(self.files.items()):
+            if now - entry["event"] < self.debounce:
+                continue
+            if entry["checked"] is not None and now - entry["checked"] < self.settle:
+                continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # Removed or renamed before it settled
+                del self.files[file_path]
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if entry["checked"] is not None and state == entry["state"]:
+                del self.files[file_path]
+                ready.append((file_path, stat))
+            else:
+                entry["checked"] = now
+                entry["state"] = state
+        return ready
+
+def root_of(file_path, roots):
+    """Return the watched folder a file belongs to (the deepest one if they are nested)."""
+    matches = [root for root in roots if file_path.startswith(root.rstrip(os.sep) + os.sep)]
+    return max(matches, key=len) if matches else None
+
+@contextmanager
+def batch_metrics():
+    """Time a batch in metrics of its own, then print their summary and start them over.
+
+    The daemon runs for weeks, so its metrics only ever hold one batch rather than growing with
+    every file it tags.
+    """
+    metrics.reset()
+    try:
+        yield
+    finally:
+        metrics.print_summary()
+        metrics.reset()
+
+def watch_folders(roots, debounce=DEFAULT_DEBOUNCE, settle=DEFAULT_SETTLE, poll_interval=DEFAULT_POLL_INTERVAL,
+                  polling=False, catch_up=True, resume=True, **options):
+    """Tag the files created or changed under roots as they arrive, until interrupted.
+
+    The files changed while the daemon was not running are tagged first (unless catch_up is
+    False). Files then wait in PendingFiles until they settle, and only those that changed
+    since they were last handled, according to each root's manifest, are tagged by
+    tag.process_files with the given options. The manifests are saved, and the metrics
+    summarised and reset, after every batch. With resume, each root also has a journal of the
+    files being tagged (see tag.process_folder).
+    """
+    roots = [os.path.abspath(root) for root in roots]
+    manifests = {root: Manifest(root, "tag") for root in roots}
+    journals = {root: RunJournal(root) for root in roots} if resume else {}
+
+    def save(root):
+        manifests[root].save()
+        if root in journals:
+            journals[root].forget_done()
+
+    watcher = make_watcher(roots, poll_interval, polling)
+    pending = PendingFiles(debounce, settle)
+    try:
+        if catch_up:
+            for root, manifest in manifests.items():
+                with metrics.stage("scan"):
+                    changed_paths = [file_path for file_path, stat, changed in manifest.scan() if changed]
+                if changed_paths:
+                    log(f"Tagging {len(changed_paths)} files changed in {root} since the last run", NORMAL)
+                    with batch_metrics():
+                        process_files(changed_paths, manifest, journal=journals.get(root), **options)
+                save(root)
+        log(f"Watching {', '.join(roots)}", NORMAL)
+        while True:
+            for file_path in watcher.poll(TICK if len(pending) else 2 * TICK):
+                pending.touch(file_path)
+            batches = {}
+            for file_path, stat in pending.ready():
+                root = root_of(file_path, roots)
+                # Skip the files whose own tags were just written, or that were touched but not changed
+                if root is not None and manifests[root].changed(file_path, stat):
+                    batches.setdefault(root, []).append(file_path)
+            for root, file_paths in batches.items():
+                log(f"Tagging {len(file_paths)} new or changed files in {root}", NORMAL)
+                with batch_metrics():
+                    try:
+                        process_files(file_paths, manifests[root], journal=journals.get(root), **options)
+                    except Exception as e:
+                        error(f"Failed to tag files in {root}: {e}", stage="watch")
+                save(root)
+    finally:
+        watcher.close()
+        for root in roots:
+            save(root)
+        for journal in journals.values():
+            journal.close()
+
+def main(argv=None):
+    """Watch the folders given on the command line (or in argv) until interrupted and return the exit status."""
+    parser = argparse.ArgumentParser(description="Tag the files added to or changed in folders as they arrive.")
+    parser.add_argument("folder_paths", nargs="+", metavar="folder_path", help="folder to watch, with its sub-folders")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                        help=f"seconds without events on a file before it is checked (default: {DEFAULT_DEBOUNCE:g})")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                        help=f"seconds a file's size and mtime must stay the same before it is tagged (default: {DEFAULT_SETTLE:g})")
+    parser.add_argument("--polling", action="store_true", help="poll the folders even where inotify is available")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f"seconds between two polls of the folders (default: {DEFAULT_POLL_INTERVAL:g})")
+    parser.add_argument("--no-catch-up", action="store_true", help="do not tag the files changed while the daemon was not running")
+    add_tagging_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+
+    for folder_path in args.folder_paths:
+        if not os.path.isdir(folder_path):
+            print(f"Not a folder: {folder_path}")
+            return 1
+
+    # Stop cleanly, saving the manifests, when the service manager stops the daemon
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    options = tagging_options(args)
+    try:
+        watch_folders(args.folder_paths, debounce=args.debounce, settle=args.settle, poll_interval=args.poll_interval,
+                      polling=args.polling, catch_up=not args.no_catch_up, **options)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if options["cache"] is not None:
+            options["cache"].close()
+        # Each batch printed its own summary
+        if metrics.done or metrics.errors:
+            metrics.print_summary()
+        metrics.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import queue
+import atexit
+import importlib
+import threading
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+
+# Scripts the background worker can run; each one has a main(argv) returning an exit status
+JOBS = ("tag", "sync", "graph")
+
+class _MessageWriter:
+    """File-like object sending every line written to it as an "output" message."""
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = ""
+
+    def write(self, text):
+        # Progress lines end with a carriage return rather than a newline
+        self.buffer += text.replace("\r", "\n")
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                self.send("output", line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def serve(connection):
+    """Run the jobs received on connection one after the other until it is closed.
+
+    Each request is a (job, argv) tuple. While a job runs, its progress, as reported by the
+    shared metrics, and its printed lines are sent back as ("progress", dict) and ("output", line)
+    messages, and it ends with a ("done", {"status", "summary"}) message. The modules of the
+    jobs, and the models they load (KeyBERT, Whisper), stay in memory between jobs.
+    """
+    from metrics import metrics
+
+    send_lock = threading.Lock()
+
+    def send(kind, payload):
+        with send_lock:
+            connection.send((kind, payload))
+
+    metrics.progress_callback = lambda progress: send("progress", progress)
+    writer = _MessageWriter(send)
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        job, argv = request
+        status = 1
+        metrics.reset()
+        with redirect_stdout(writer), redirect_stderr(writer):
+            try:
+                if job not in JOBS:
+                    raise ValueError(f"Unknown job: {job}")
+                status = importlib.import_module(job).main(list(argv))
+            except SystemExit as e:
+                # argparse exits on invalid arguments
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+        send("done", {"status": status or 0, "summary": metrics.summary()})
+    connection.close()
+
+class Worker:
+    """Client side of the background worker, started on first use and kept for later jobs.
+
+    Messages from the running job are collected by a reader thread; the GUI takes them with
+    messages() from its own thread, so that it never blocks on the worker.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.queue = queue.Queue()
+        self.busy = False
+
+    def start(self):
+        """Start the worker process in the background."""
+        if self.process is not None and self.process.is_alive():
+            return
+        # Spawn the worker so that it does not inherit the GUI's state; it is not a daemon
+        # because the jobs start processes of their own
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_connection,), name="tagify-worker")
+        self.process.start()
+        child_connection.close()
+        # Stop the worker if the GUI exits without closing it. Registered after starting the
+        # process, so that it runs before multiprocessing waits for its non-daemon children
+        atexit.unregister(self.close)
+        atexit.register(self.close)
+
+    def submit(self, job, argv):
+        """Start a job; its messages then become available through messages()."""
+        if self.busy:
+            raise RuntimeError("The worker is already running a job")
+        self.start()
+        self.connection.send((job, list(argv)))
+        self.busy = True
+        threading.Thread(target=self._read, args=(self.connection,), daemon=True).start()
+
+    def _read(self, connection):
+        while True:
+            try:
+                kind, payload = connection.recv()
+            except (EOFError, OSError):
+                # The worker died (or was closed) in the middle of the job
+                self.queue.put(("done", {"status": 1, "summary": None, "error": "The background worker stopped unexpectedly."}))
+                return
+            self.queue.put((kind, payload))
+            if kind == "done":
+                return
+
+    def messages(self, timeout=0):
+        """Return the messages received since the last call, in order, waiting up to timeout seconds for one."""
+        received = []
+        try:
+            received.append(self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait())
+            while True:
+                received.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        for kind, payload in received:
+            if kind == "done":
+                self.busy = False
+                if payload.get("error"):
+                    # Start a fresh worker for the next job
+                    self.process = None
+        return received
+
+    def close(self, timeout=5):
+        """Ask the worker to exit once its current job is done, and stop it if it does not."""
+        if self.process is None:
+            return
+        if not self.busy:
+            try:
+                self.connection.send(None)
+            except (OSError, ValueError):
+                pass
+        self.process.join(timeout if not self.busy else 0)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+        self.process = None